@@ -1,5 +1,6 @@
 import asyncio
 import threading
+import signal
 from gevent.pywsgi import WSGIServer
 
 from src.logic.reducer import Reducer
@@ -32,5 +33,10 @@ if __name__=='__main__':
     l = asyncio.new_event_loop()
     r = Reducer('reducer')
 
+    signal.signal(signal.SIGTERM, signal.default_int_handler) # so that the checkpoint is written on shutdown
+
     threading.Thread(target=admin_thread, args=(l, r), daemon=True).start()
-    reducer_thread(l, r)
\ No newline at end of file
+    try:
+        reducer_thread(l, r)
+    finally:
+        r.write_checkpoint()
\ No newline at end of file
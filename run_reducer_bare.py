@@ -1,9 +1,15 @@
 import asyncio
+import signal
 
 from src.logic.reducer import Reducer
 from src import utils
 
 if __name__=='__main__':
     utils.fix_zmq_asyncio_windows()
+    signal.signal(signal.SIGTERM, signal.default_int_handler) # so that the checkpoint is written on shutdown
+
     reducer = Reducer('reducer')
-    asyncio.run(reducer.run_forever())
\ No newline at end of file
+    try:
+        asyncio.run(reducer.run_forever())
+    finally:
+        reducer.write_checkpoint()
\ No newline at end of file
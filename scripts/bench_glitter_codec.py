@@ -0,0 +1,55 @@
+import pickle
+import timeit
+from pathlib import Path
+import sys
+from typing import Any, Callable, List, Tuple
+
+sys.path.append(str(Path('.').resolve()))
+
+from src.logic import glitter
+
+N_ROUNDS = 20000
+
+SAMPLES: List[Any] = [
+    glitter.WorkerHelloReq(client='worker#0', protocol_ver=glitter.PROTOCOL_VER),
+    glitter.WorkerHeartbeatReq(client='worker#0', telemetry={
+        'state_counter': 12345, 'game_available': True, 'cur_tick': 1000, 'n_users': 4321, 'n_submissions': 98765,
+        'ws_online_uids': 321, 'ws_online_clients': 456,
+    }),
+    glitter.RegUserReq(client='worker#0', login_key='iaaa:2500012345', login_properties={
+        'type': 'iaaa', 'info': {'name': '张三', 'dept': '信息科学技术学院', 'detailType': 'undergraduate', 'identityStatus': '在校'},
+    }, group='pku'),
+    glitter.UpdateProfileReq(client='worker#0', uid=1234, profile={'nickname': 'player', 'tel': '13800138000', 'qq': '10001', 'comment': 'friends'}),
+    glitter.AgreeTermReq(client='worker#0', uid=1234),
+    glitter.SubmitFlagReq(client='worker#0', uid=1234, challenge_key='prob01', flag='flag{this-is-a-reasonably-long-flag-for-benchmark}'),
+    glitter.SubmitFeedbackReq(client='worker#0', uid=1234, challenge_key='prob01', feedback='反馈内容'*20),
+    glitter.ActionRep(error_msg=None, state_counter=12345),
+    glitter.ActionRep(error_msg='Flag错误', state_counter=12345),
+]
+
+def bench(fn: Callable[[], Any]) -> float: # -> us per call
+    return min(timeit.repeat(fn, number=N_ROUNDS, repeat=3)) / N_ROUNDS * 1e6
+
+def bench_one(msg: Any) -> Tuple[str, int, int, float, float, float, float]:
+    pickled = pickle.dumps(msg)
+    encoded = glitter.codec.encode(msg)
+
+    assert pickle.loads(pickled)==msg
+    assert glitter.codec.decode(encoded)==msg
+
+    return (
+        type(msg).__name__,
+        len(pickled),
+        len(encoded),
+        bench(lambda: pickle.dumps(msg)),
+        bench(lambda: glitter.codec.encode(msg)),
+        bench(lambda: pickle.loads(pickled)),
+        bench(lambda: glitter.codec.decode(encoded)),
+    )
+
+if __name__=='__main__':
+    print(f'{"message":<20} {"size (pickle/codec)":>20} {"encode us (pickle/codec)":>26} {"decode us (pickle/codec)":>26}')
+
+    for sample in SAMPLES:
+        name, sz_p, sz_c, enc_p, enc_c, dec_p, dec_c = bench_one(sample)
+        print(f'{name:<20} {sz_p:>9}B / {sz_c:>6}B {enc_p:>12.2f} / {enc_c:>9.2f} {dec_p:>12.2f} / {dec_c:>9.2f}')
@@ -0,0 +1,116 @@
+import gc
+import random
+import timeit
+import tracemalloc
+from pathlib import Path
+import sys
+from typing import Any, Dict, List
+
+sys.path.append(str(Path('.').resolve()))
+
+from src.store import *
+from src.state import Game, Submission, User, Flag, Challenge
+from src.state import challenge_state, user_state
+from src import utils
+
+N_USERS = 10000
+N_CHALLENGES = 40
+N_SUBMISSIONS = 200000
+N_ROUNDS = 1000000
+
+class BenchWorker:
+    # only what `Game` uses in a scoreboard reload
+    def log(self, level: utils.LogLevel, module: str, message: str) -> None:
+        if level in ['error', 'critical']:
+            print(f'[{level}] {module}: {message}')
+
+    def emit_local_message(self, msg: Dict[str, Any]) -> None:
+        pass
+
+def make_stores() -> Dict[str, List[Any]]:
+    rnd = random.Random(42)
+
+    users = []
+    for uid in range(1, N_USERS+1):
+        u = UserStore(id=uid, login_key=f'iaaa:{uid}', login_properties={'type': 'iaaa'}, enabled=True, group=rnd.choice(['pku', 'thu', 'other']), token=f'token{uid}', auth_token=f'auth{uid}', profile_id=uid, terms_agreed=True)
+        u.profile = UserProfileStore(id=uid, user_id=uid, timestamp_ms=0, nickname_or_null=f'player{uid}')
+        users.append(u)
+
+    challenges = []
+    for cid in range(1, N_CHALLENGES+1):
+        flags = [{'name': f'flag{i}', 'type': 'static', 'val': f'flag{{prob{cid}-{i}}}', 'base_score': 200} for i in range(2)]
+        challenges.append(ChallengeStore(id=cid, effective_after=0, key=f'prob{cid:02d}', title=f'Problem {cid}', category=rnd.choice(['Web', 'Binary', 'Misc']), sorting_index=cid, desc_template='', chall_metadata={}, actions=[], flags=flags))
+
+    submissions = []
+    for sid in range(1, N_SUBMISSIONS+1):
+        ch = rnd.choice(challenges)
+        flag = rnd.choice(ch.flags)['val'] if rnd.random()<.3 else 'flag{wrong}'
+        submissions.append(SubmissionStore(id=sid, user_id=rnd.randint(1, N_USERS), challenge_key=ch.key, flag=flag, timestamp_ms=1000*sid, score_override_or_null=None, percentage_override_or_null=None))
+
+    triggers = [TriggerStore(id=1, tick=1000, timestamp_s=0, name='start'), TriggerStore(id=2, tick=9000, timestamp_s=2**40, name='end')]
+    policies = [GamePolicyStore(id=1, effective_after=0, can_view_problem=True, can_submit_flag=True, can_submit_writeup=True, is_submission_deducted=False)]
+
+    return {'users': users, 'challenges': challenges, 'submissions': submissions, 'triggers': triggers, 'policies': policies}
+
+def unslotted(cls: Any) -> Any: # a copy of a slotted class that stores attributes in __dict__, i.e., the baseline before __slots__
+    ns = {k: v for k, v in cls.__dict__.items() if k not in ['__slots__', '__dict__', '__weakref__', *cls.__slots__]}
+    return type(cls)(cls.__name__, cls.__bases__, ns)
+
+def use_unslotted() -> None: # patch the names used to create state objects
+    for mod, name in [
+        (sys.modules[__name__], 'Submission'),
+        (challenge_state, 'Challenge'),
+        (challenge_state, 'Flag'),
+        (user_state, 'User'),
+        (user_state, 'ScoreHistory'),
+    ]:
+        setattr(mod, name, unslotted(getattr(mod, name)))
+
+def build_game(stores: Dict[str, List[Any]]) -> Game:
+    game = Game(BenchWorker(), 1000, stores['policies'], stores['triggers'], stores['challenges'], [], stores['users'], use_boards=False) # type: ignore
+    game.on_tick_change()
+    game.on_scoreboard_reset()
+    for s in stores['submissions']:
+        game.submission_table.set(s)
+    for row in game.submission_table:
+        game.on_scoreboard_update(Submission(game, row), in_batch=True)
+    game.on_scoreboard_batch_update_done()
+    return game
+
+def shallow_size(obj: Any) -> int: # the object and its __dict__, if any
+    return sys.getsizeof(obj) + (sys.getsizeof(obj.__dict__) if hasattr(obj, '__dict__') else 0)
+
+def bench(stmt: str, env: Dict[str, Any]) -> float: # -> ns per op
+    return min(timeit.repeat(stmt, globals=env, number=N_ROUNDS, repeat=3)) / N_ROUNDS * 1e9
+
+if __name__=='__main__':
+    if '--unslotted' in sys.argv:
+        print('using unslotted copies of state classes')
+        use_unslotted()
+
+    stores = make_stores()
+
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    game = build_game(stores)
+    gc.collect()
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    print(f'game state: {(after-before)/2**20:.1f}MB for {N_USERS} users, {N_CHALLENGES} challenges, {N_SUBMISSIONS} submissions')
+    for cls, objs in [
+        (User, game.users.list),
+        (Challenge, game.challenges.list),
+        (Flag, [f for ch in game.challenges.list for f in ch.flags]),
+        (Submission, list(game.submissions.values())),
+    ]:
+        print(f'  {cls.__name__:<12} {len(objs):>8} objects, {shallow_size(objs[0]):>5}B each (shallow)')
+
+    u = max(game.users.list, key=lambda u: len(u.passed_flags))
+    sub = next(iter(u.passed_flags.values()))
+    f = sub.matched_flag
+    env = {'u': u, 'sub': sub, 'f': f, 'users': f.passed_users if f else set()}
+    print('attribute access:')
+    for stmt in ['u.tot_score', 'sub.matched_flag', 'u.passed_flags', 'u in users', 'f in u.passed_flags']:
+        print(f'  {stmt:<24} {bench(stmt, env):>6.1f}ns')
@@ -0,0 +1,57 @@
+import gc
+import random
+import tracemalloc
+from pathlib import Path
+import sys
+from typing import Any, Callable, Dict, List
+
+sys.path.append(str(Path('.').resolve()))
+
+from src.store import SubmissionStore
+from src.state.submission_table import SubmissionTable
+
+N_SUBMISSIONS = [10000, 100000, 300000]
+N_USERS = 5000
+N_CHALLENGES = 40
+
+def make_snapshots(n: int) -> List[Dict[str, Any]]:
+    rnd = random.Random(n)
+    return [{
+        'id': sid,
+        'user_id': rnd.randint(1, N_USERS),
+        'challenge_key': f'prob{rnd.randint(1, N_CHALLENGES):02d}',
+        'flag': f'flag{{{rnd.getrandbits(128):032x}}}',
+        'timestamp_ms': 1700000000000 + sid*1000,
+        'score_override_or_null': None,
+        'percentage_override_or_null': 50 if rnd.random()<.05 else None,
+    } for sid in range(1, n+1)]
+
+def measure(build: Callable[[], Any]) -> int: # -> bytes allocated and kept by the result
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    result = build()
+    gc.collect()
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del result
+    return after-before
+
+def build_orm(snapshots: List[Dict[str, Any]]) -> Dict[int, SubmissionStore]:
+    # detached rows, like the ones loaded from db
+    return {s['id']: SubmissionStore.from_snapshot(s) for s in snapshots}
+
+def build_table(snapshots: List[Dict[str, Any]]) -> SubmissionTable:
+    table = SubmissionTable()
+    for s in snapshots:
+        table.set(SubmissionStore.from_snapshot(s)) # the orm row is dropped after it is copied into the table
+    return table
+
+if __name__=='__main__':
+    print(f'{"submissions":>12} {"orm rows":>12} {"table":>12} {"ratio":>8}')
+
+    for n in N_SUBMISSIONS:
+        snapshots = make_snapshots(n)
+        sz_orm = measure(lambda: build_orm(snapshots))
+        sz_table = measure(lambda: build_table(snapshots))
+        print(f'{n:>12} {sz_orm/2**20:>10.1f}MB {sz_table/2**20:>10.1f}MB {sz_orm/sz_table:>7.1f}x')
@@ -53,8 +53,16 @@ class StatusView(AdminIndexView):  # type: ignore
             'cur_tick': 'Tick',
             'n_users': '用户数',
             'n_submissions': '提交数',
+            'cached_views': '视图缓存',
         }
 
+        def describe_cached_views(stats: Dict[str, Dict[str, int]]) -> str:
+            n_hit = sum(st['hit'] for st in stats.values())
+            n_miss = sum(st['miss'] for st in stats.values())
+            n_invalidated = sum(st['invalidated'] for st in stats.values())
+            n_prewarmed = sum(st.get('prewarmed', 0) for st in stats.values())
+            return f'hit={n_hit}, miss={n_miss}, invalidated={n_invalidated}, prewarmed={n_prewarmed}'
+
         st = utils.sys_status()
         sys_status = {
             'process': f'{st["process"]}',
@@ -99,6 +107,7 @@ class StatusView(AdminIndexView):  # type: ignore
                 worker_name: {
                     'last_update': f'{int(time.time()-last_update):d}s',
                     **tel_dict,
+                    **({'cached_views': describe_cached_views(tel_dict['cached_views'])} if 'cached_views' in tel_dict else {}),
                 } for worker_name, (last_update, tel_dict) in sorted(reducer.received_telemetries.items())
             },
         )
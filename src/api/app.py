@@ -48,6 +48,10 @@ async def setup_game_state(cur_app: Sanic[Any, Any], _loop: Any) -> None:
     await worker._before_run()
     cur_app.ctx._worker_task = asyncio.create_task(worker._mainloop())
 
+@app.after_server_stop
+async def flush_worker_logs(cur_app: Sanic[Any, Any], _loop: Any) -> None:
+    cur_app.ctx.worker.flush_logs()
+
 async def handle_error(req: Request, exc: Exception) -> HTTPResponse:
     try:
         user = get_cur_user(req)
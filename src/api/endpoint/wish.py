@@ -6,11 +6,12 @@ import time
 import json
 import re
 import hashlib
-from typing import Optional, Dict, Any, List, Tuple
+from typing import Optional, Dict, Any, List, Tuple, Union
 
 from .. import store_anticheat_log
-from ..wish import wish_endpoint
+from ..wish import wish_endpoint, dump_wish_response
 from ...state import User, ScoreBoard, Submission
+from ...state.cached_view import CacheDeps
 from ...logic import Worker, glitter
 from ...store import UserProfileStore, UserStore, ChallengeStore, SubmissionStore, FeedbackStore
 from ... import utils
@@ -23,6 +24,8 @@ TEMPLATE_LIST = [
     ('credits', '工作人员', 9000),
 ]
 
+SCORE_HISTORY_BUCKETS = 500 # for the score chart in submission lists
+
 @wish_endpoint(bp, '/game_info')
 async def game_info(_req: Request, worker: Worker, user: Optional[User]) -> Dict[str, Any]:
     if worker.game is None:
@@ -291,7 +294,7 @@ async def submit_flag(req: Request, body: SubmitFlagParam, worker: Worker, user:
     return {}
 
 @wish_endpoint(bp, '/get_touched_users/<challenge_key:str>')
-async def get_touched_users(_req: Request, challenge_key: str, worker: Worker, user: Optional[User]) -> Dict[str, Any]:
+async def get_touched_users(_req: Request, challenge_key: str, worker: Worker, user: Optional[User]) -> Union[Dict[str, Any], bytes]:
     if user is None:
         return {'error': 'NO_USER', 'error_msg': '未登录'}
     if worker.game is None:
@@ -307,35 +310,23 @@ async def get_touched_users(_req: Request, challenge_key: str, worker: Worker, u
 
     is_admin = secret.IS_ADMIN(user._store)
 
-    users: Dict[User, List[Optional[Submission]]] = {}
-    users_sort_key: List[Tuple[Tuple[int, int], User]] = []
-    for u in ch.touched_users:
-        li: List[Optional[Submission]] = []
-        tot_score = 0
-        last_sub_ts = 0
-        for f in ch.flags:
-            sub = u.passed_flags.get(f, None)
-            if sub is not None:
-                li.append(sub)
-                last_sub_ts = max(last_sub_ts, sub._store.timestamp_ms)
-                tot_score += sub.gained_score()
-            else:
-                li.append(None)
-        users[u] = li
-        users_sort_key.append(((-tot_score, last_sub_ts), u))
-
-    users_sort_key.sort(key=lambda x: x[0])
+    def render(deps: CacheDeps) -> bytes:
+        touched_users = ch.touched_users_sorted()
+        deps.uids.update(u._store.id for u, _subs in touched_users) # for tot_score and profiles
 
-    return {
-        'list': [{
-            'uid': u._store.id,
-            'tot_score': u.tot_score,
-            'nickname': u._store.profile.nickname_or_null or '',
-            'group_disp': u._store.group_disp(),
-            'badges': u._store.badges() + (u.admin_badges() if is_admin else []),
-            'flags': [None if sub is None else int(sub._store.timestamp_ms/1000) for sub in users[u]],
-        } for _sort_key, u in users_sort_key],
-    }
+        return dump_wish_response({
+            'list': [{
+                'uid': u._store.id,
+                'tot_score': u.tot_score,
+                'nickname': u._store.profile.nickname_or_null or '',
+                'group_disp': u._store.group_disp(),
+                'badges': u._store.badges() + (u.admin_badges() if is_admin else []),
+                'flags': [None if sub is None else int(sub._store.timestamp_ms/1000) for sub in subs],
+            } for u, subs in touched_users],
+        })
+
+    # invalidated by `Challenges.on_scores_changed` and profile updates
+    return worker.game.challenges.touched_users_resp_cache.get((ch._store.key, is_admin), render)
 
 @wish_endpoint(bp, '/board/<board_name:str>')
 async def get_board(_req: Request, board_name: str, worker: Worker, user: Optional[User]) -> Dict[str, Any]:
@@ -394,7 +385,7 @@ async def get_my_submissions(_req: Request, worker: Worker, user: Optional[User]
         'topstars': [{
             'uid': user._store.id,
             'nickname': user._store.profile.nickname_or_null or '--',
-            'history': user.score_history_diff,
+            'history': user.score_history_diff_downsampled(SCORE_HISTORY_BUCKETS),
         }],
 
         'time_range': [
@@ -428,7 +419,7 @@ async def get_others_submissions(_req: Request, uid: int, worker: Worker) -> Dic
         'topstars': [{
             'uid': user._store.id,
             'nickname': user._store.profile.nickname_or_null or '--',
-            'history': user.score_history_diff,
+            'history': user.score_history_diff_downsampled(SCORE_HISTORY_BUCKETS),
         }],
 
         'time_range': [
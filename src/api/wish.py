@@ -1,4 +1,5 @@
 from sanic import Blueprint, Request, HTTPResponse, response
+from sanic.response import json_dumps
 from sanic.models.handler_types import RouteHandler
 from functools import wraps
 from inspect import isawaitable
@@ -6,7 +7,14 @@ from typing import Callable, Dict, Any, Union, Awaitable, List, Optional
 
 ACCEPTED_WISH_VERS = ['2025.v1']
 
-WishHandler = Callable[..., Union[Dict[str, Any], Awaitable[Dict[str, Any]]]]
+WishRetval = Union[Dict[str, Any], bytes] # bytes if pre-serialized by `dump_wish_response`
+WishHandler = Callable[..., Union[WishRetval, Awaitable[WishRetval]]]
+
+def dump_wish_response(retval: Dict[str, Any]) -> bytes: # so that a response can be cached and sent as is
+    return json_dumps({
+        'error': None, # may be overridden by retval
+        **retval,
+    }).encode('utf-8')
 
 def wish_endpoint(bp: Blueprint, uri: str, *, methods: Optional[List[str]] = None) -> Callable[[WishHandler], RouteHandler]:
     if methods is None:
@@ -25,6 +33,9 @@ def wish_endpoint(bp: Blueprint, uri: str, *, methods: Optional[List[str]] = Non
             retval_ = fn(req, *args, **kwargs)
             retval = (await retval_) if isawaitable(retval_) else retval_
 
+            if isinstance(retval, bytes):
+                return response.raw(retval, content_type='application/json')
+
             return response.json({
                 'error': None, # may be overridden by retval
                 **retval,
@@ -1,20 +1,30 @@
-from sqlalchemy import create_engine, select
+from sqlalchemy import create_engine, select, insert
 from sqlalchemy.orm import sessionmaker
 from zmq.asyncio import Context
 # noinspection PyUnresolvedReferences
 from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
 import asyncio
+import atexit
 import datetime
-from typing import Type, TypeVar, List, Optional, Dict, Callable, Any, Tuple
-
-from . import glitter, pusher
+import functools
+import time
+from collections import deque
+import json
+import zlib
+from dataclasses import dataclass, fields
+from typing import Type, TypeVar, List, Optional, Dict, Set, Callable, Any, Tuple, Deque, Iterable, Union
+
+from . import glitter, pusher, checkpoint
 from ..state import *
+from ..state.submission_table import SubmissionRow
 from ..store import *
 from .. import utils
 from .. import secret
 
 T = TypeVar('T', bound=Table)
-CbMethod = Callable[[Any, Any], Any]
+R = TypeVar('R')
+CbMethod = Callable[..., Any]
 
 def make_callback_decorator() -> Tuple[Callable[[Any], Callable[[CbMethod], CbMethod]], Dict[Any, CbMethod]]:
     listeners: Dict[Any, CbMethod] = {}
@@ -33,20 +43,46 @@ def make_callback_decorator() -> Tuple[Callable[[Any], Callable[[CbMethod], CbMe
 
 on_event, event_listeners = make_callback_decorator()
 
+@dataclass
+class GameStores:
+    game_policy: List[GamePolicyStore]
+    trigger: List[TriggerStore]
+    challenge: List[ChallengeStore]
+    announcement: List[AnnouncementStore]
+    user: List[UserStore]
+    submission: List[SubmissionStore]
+
 class StateContainerBase(ABC):
     RECOVER_THROTTLE_S = 3
+    STATE_SNAPSHOT_VER = 1 # bump this if the snapshot format or any store schema changes
     RELOAD_SCOREBOARD_DEBOUNCE_S = 1
     MAX_KEEPING_MESSAGES = 50
+    DB_THREADS = 2 # also the size of the connection pool
+    LOG_FLUSH_INTERVAL_S = 1
+    LOG_FLUSH_BATCH = 200 # flush before the interval if this many rows are pending
+    LOG_QUEUE_MAX = 10000 # further rows are dropped and only counted until the next flush
 
-    def __init__(self, process_name: str, receiving_messages: bool = False, use_boards: bool = True):
+    def __init__(self, process_name: str, receiving_messages: bool = False, use_boards: bool = True, prewarm_views: bool = False):
         self.process_name: str = process_name
         self.listening_local_messages: bool = receiving_messages
         self.use_boards = use_boards
+        self.prewarm_views = prewarm_views # render views of the next tick on `TICK_PREVIEW`, for processes serving requests
 
         self.push_message = pusher.Pusher().push_message
 
         # https://docs.sqlalchemy.org/en/20/core/pooling.html#using-fifo-vs-lifo
-        self.SqlSession = sessionmaker(create_engine(secret.DB_CONNECTOR, future=True, pool_size=2, pool_use_lifo=True, pool_pre_ping=True), expire_on_commit=False, future=True)
+        self.SqlSession = sessionmaker(create_engine(secret.DB_CONNECTOR, future=True, pool_size=self.DB_THREADS, pool_use_lifo=True, pool_pre_ping=True), expire_on_commit=False, future=True)
+
+        # blocking db calls are run here (see `run_sql`), so that a slow query does not stall the event loop
+        self.sql_executor: ThreadPoolExecutor = ThreadPoolExecutor(max_workers=self.DB_THREADS, thread_name_prefix=f'{process_name}-sql')
+        self.loop: Optional[asyncio.AbstractEventLoop] = None # set in _before_run
+
+        # db log rows are buffered here and inserted in batches by `_log_flush_daemon`
+        self._log_queue: Deque[Dict[str, Any]] = deque()
+        self._log_dropped: Dict[str, int] = {}
+        self._log_flush_event: asyncio.Event = asyncio.Event()
+        self._log_flush_task: Optional[asyncio.Task[None]] = None
+        atexit.register(self.flush_logs)
 
         self.log('debug', 'base.__init__', f'{self.process_name} started')
 
@@ -56,16 +92,16 @@ class StateContainerBase(ABC):
         self._game: Game = None # type: ignore
         self.game_dirty: bool = True
 
-        self._submission_stores: Dict[int, SubmissionStore] = {}
-
         self.local_messages: Dict[int, Dict[str, Any]] = {}
         self.next_message_id: int = 1
         self.message_cond: asyncio.Condition = None  # type: ignore
+        self.event_lock: asyncio.Lock = asyncio.Lock()
 
         self.state_counter: int = 1
         self.custom_telemetry_data: Dict[str, Any] = {}
 
         self._reload_scoreboard_task: Optional[asyncio.Task[None]] = None
+        self._prewarm_tick_task: Optional[asyncio.Task[None]] = None
 
     @property
     def game(self) -> Optional[Game]:
@@ -73,31 +109,41 @@ class StateContainerBase(ABC):
             return None
         return self._game
 
-    async def init_game(self, tick: int) -> None:
+    async def init_game(self, tick: int, stores: Optional[GameStores] = None) -> None:
+        # stores are loaded from db if not provided (e.g., from a state snapshot)
         while True:
             try:
+                if stores is None:
+                    stores = await self.load_all_stores()
+
                 self._game = Game(
                     worker=self,
                     cur_tick=tick,
-                    game_policy_stores=self.load_all_data(GamePolicyStore),
-                    trigger_stores=self.load_all_data(TriggerStore),
-                    challenge_stores=self.load_all_data(ChallengeStore),
-                    announcement_stores=self.load_all_data(AnnouncementStore),
-                    user_stores=self.load_all_data(UserStore),
+                    game_policy_stores=stores.game_policy,
+                    trigger_stores=stores.trigger,
+                    challenge_stores=stores.challenge,
+                    announcement_stores=stores.announcement,
+                    user_stores=stores.user,
                     use_boards=self.use_boards,
                 )
                 self._game.on_tick_change()
 
-                self._submission_stores = {sub.id: sub for sub in self.load_all_data(SubmissionStore)}
+                for sub_store in stores.submission:
+                    self._game.submission_table.set(sub_store)
+                self.load_checkpoint()
+                await self.warm_correct_flags(row for row in self._game.submission_table if row.valid_flag_hint is None)
                 self.reload_scoreboard_if_needed()
             except Exception as e:
                 self.log('error', 'base.init_game', f'exception during initialization, will try again: {utils.get_traceback(e)}')
+                stores = None
                 await asyncio.sleep(self.RECOVER_THROTTLE_S)
             else:
                 break
 
     async def _before_run(self) -> None:
+        self.loop = asyncio.get_running_loop()
         self.message_cond = asyncio.Condition()
+        self._log_flush_task = asyncio.create_task(self._log_flush_daemon())
 
     @abstractmethod
     async def _mainloop(self) -> None:
@@ -113,32 +159,32 @@ class StateContainerBase(ABC):
         await self._mainloop()
 
     @on_event(glitter.EventType.SYNC)
-    def on_sync(self, event: glitter.Event) -> None:
+    async def on_sync(self, event: glitter.Event) -> None:
         if self._game.cur_tick!=event.data:
             self.log('error', 'base.on_sync', f'tick is inconsistent: ours {self._game.cur_tick}, synced {event.data}')
             self._game.cur_tick = event.data
             self._game.on_tick_change()
 
     @on_event(glitter.EventType.RELOAD_GAME_POLICY)
-    def on_reload_game_policy(self, _event: glitter.Event) -> None:
-        self._game.policy.on_store_reload(self.load_all_data(GamePolicyStore))
+    async def on_reload_game_policy(self, _event: glitter.Event) -> None:
+        self._game.policy.on_store_reload(await self.load_all_data(GamePolicyStore))
 
     @on_event(glitter.EventType.RELOAD_TRIGGER)
-    def on_reload_trigger(self, _event: glitter.Event) -> None:
-        self._game.trigger.on_store_reload(self.load_all_data(TriggerStore))
+    async def on_reload_trigger(self, _event: glitter.Event) -> None:
+        self._game.trigger.on_store_reload(await self.load_all_data(TriggerStore))
 
     @on_event(glitter.EventType.UPDATE_ANNOUNCEMENT)
-    def on_update_announcement(self, event: glitter.Event) -> None:
-        self._game.announcements.on_store_update(event.data, self.load_one_data(AnnouncementStore, event.data))
+    async def on_update_announcement(self, event: glitter.Event) -> None:
+        self._game.announcements.on_store_update(event.data, await self.load_event_data(AnnouncementStore, event))
 
     @on_event(glitter.EventType.UPDATE_CHALLENGE)
-    def on_update_challenge(self, event: glitter.Event) -> None:
-        self._game.challenges.on_store_update(event.data, self.load_one_data(ChallengeStore, event.data))
+    async def on_update_challenge(self, event: glitter.Event) -> None:
+        self._game.challenges.on_store_update(event.data, await self.load_event_data(ChallengeStore, event))
 
     @on_event(glitter.EventType.UPDATE_USER)
-    def on_update_user(self, event: glitter.Event) -> None:
+    async def on_update_user(self, event: glitter.Event) -> None:
         uid = event.data
-        reload_frontend = self._game.users.on_store_update(uid, self.load_one_data(UserStore, event.data))
+        reload_frontend = self._game.users.on_store_update(uid, await self.load_event_data(UserStore, event))
         if reload_frontend:
             self.emit_local_message({
                 'type': 'push',
@@ -149,28 +195,45 @@ class StateContainerBase(ABC):
             })
 
     @on_event(glitter.EventType.NEW_SUBMISSION)
-    def on_new_submission(self, event: glitter.Event) -> None:
-        sub_store = self.load_one_data(SubmissionStore, event.data)
+    async def on_new_submission(self, event: glitter.Event) -> None:
+        sub_store = await self.load_event_data(SubmissionStore, event)
         assert sub_store is not None, 'submission not found'
-        self._submission_stores[event.data] = sub_store
 
-        sub = Submission(self._game, sub_store)
+        await self.warm_correct_flags([sub_store])
+        sub = Submission(self._game, self._game.submission_table.set(sub_store))
         self._game.on_scoreboard_update(sub, in_batch=False)
 
         self.emit_local_message({'type': 'new_submission', 'submission': sub})
 
     @on_event(glitter.EventType.UPDATE_SUBMISSION)
-    def on_update_submission(self, event: glitter.Event) -> None:
-        sub_store = self.load_one_data(SubmissionStore, event.data)
+    async def on_update_submission(self, event: glitter.Event) -> None:
+        sub_store = await self.load_event_data(SubmissionStore, event)
         if sub_store is None: # remove sub, not likely, but possible
-            self._submission_stores.pop(event.data, None)
+            self._game.submission_table.remove(event.data)
+            self._game.need_reloading_scoreboard = True
         else:
-            self._submission_stores[event.data] = sub_store
-
-        self._game.need_reloading_scoreboard = True
+            if not self._game.on_submission_override_update(sub_store): # structural change
+                self._game.submission_table.set(sub_store)
+                self._game.need_reloading_scoreboard = True
+
+    @on_event(glitter.EventType.TICK_PREVIEW)
+    async def on_tick_preview(self, event: glitter.Event) -> None:
+        if self.prewarm_views and event.data!=self._game.cur_tick:
+            # not awaited, so that later events are not blocked
+            self._prewarm_tick_task = asyncio.create_task(self._prewarm_tick(self._game, event.data))
+
+    async def _prewarm_tick(self, game: Game, tick: int) -> None:
+        t1 = time.monotonic()
+        for _ in game.prewarm_tick(tick):
+            await asyncio.sleep(0) # serve requests between steps
+            if self._game is not game: # reloaded
+                return
+
+        if game.prewarmed_tick==tick:
+            self.log('debug', 'base.prewarm_tick', f'prewarmed tick {tick} in {time.monotonic()-t1:.2f}s')
 
     @on_event(glitter.EventType.TICK_UPDATE)
-    def on_tick_update(self, event: glitter.Event) -> None:
+    async def on_tick_update(self, event: glitter.Event) -> None:
         old_tick = self._game.cur_tick
         if old_tick!=event.data:
             self._game.cur_tick = event.data
@@ -193,18 +256,55 @@ class StateContainerBase(ABC):
         with utils.log_slow(self.log, 'base.reload_scoreboard_if_needed', 'reload scoreboard'):
             self._game.on_scoreboard_reset()
 
-            for sub_store in self._submission_stores.values():
-                submission = Submission(self._game, sub_store)
+            for sub_row in self._game.submission_table:
+                submission = Submission(self._game, sub_row)
                 self._game.on_scoreboard_update(submission, in_batch=True)
 
             self._game.on_scoreboard_batch_update_done()
 
+        self._game.submission_table.clear_valid_flag_hints() # from checkpoint, only used in the first reload
+
+    async def warm_correct_flags(self, subs: Iterable[Union[SubmissionStore, SubmissionRow]]) -> None:
+        # generate dynamic flags checked by these submissions in bulk, so that validating them does not block the loop
+        game = self._game
+        dyn_flags = {ch._store.key: [f for f in ch.flags if f.type=='dynamic'] for ch in game.challenges.list}
+        users_by_flag: Dict[Flag, Set[User]] = {}
+
+        for sub in subs:
+            flags = dyn_flags.get(sub.challenge_key, None)
+            if flags:
+                user = game.users.user_by_id.get(sub.user_id, None)
+                if user is not None:
+                    for f in flags:
+                        users_by_flag.setdefault(f, set()).add(user)
+
+        for f, users in users_by_flag.items():
+            await f.warm_correct_flags(users)
+
+    def load_checkpoint(self) -> None:
+        path = secret.DERIVED_STATE_CHECKPOINT_PATH
+        if path is None or not path.is_file():
+            return
+
+        try:
+            with utils.log_slow(self.log, 'base.load_checkpoint', 'load checkpoint'):
+                hints = checkpoint.load_hints(path.read_bytes(), self._game, self._game.submission_table)
+                for sid, idx0 in hints.items():
+                    self._game.submission_table.set_valid_flag_hint(sid, idx0)
+        except Exception as e:
+            self.log('warning', 'base.load_checkpoint', f'cannot load checkpoint, will ignore: {utils.get_traceback(e)}')
+            self._game.submission_table.clear_valid_flag_hints()
+        else:
+            self.log('info', 'base.load_checkpoint', f'loaded checkpoint for {len(hints)} out of {len(self._game.submission_table)} submissions')
+
     def reload_scoreboard_if_needed_later(self) -> None:
         if not self._game.need_reloading_scoreboard or self._reload_scoreboard_task:
             return
 
         async def task() -> None:
             await asyncio.sleep(self.RELOAD_SCOREBOARD_DEBOUNCE_S)
+            if self._game.need_reloading_scoreboard:
+                await self.warm_correct_flags(self._game.submission_table)
             self.reload_scoreboard_if_needed()
             self._reload_scoreboard_task = None
 
@@ -215,33 +315,164 @@ class StateContainerBase(ABC):
             print(f'{datetime.datetime.now().strftime("%m%d-%H%M%S")} {self.process_name} [{level}] {module}: {message}')
 
         if level in secret.DB_LOG_LEVEL:
-            with self.SqlSession() as session:
-                log = LogStore(level=level, process=self.process_name, module=module, message=message)
-                session.add(log)
-                session.commit()
+            self._enqueue_log(level, module, message)
 
         if level in secret.PUSH_LOG_LEVEL:
-            asyncio.get_event_loop().create_task(
-                self.push_message(f'[{level.upper()} {module}]\n{message}', f'log-{level}')
+            # may be called from the sql executor, so schedule it on the loop in a thread-safe way
+            asyncio.run_coroutine_threadsafe(
+                self.push_message(f'[{level.upper()} {module}]\n{message}', f'log-{level}'),
+                self.loop or asyncio.get_event_loop(),
             )
 
-    def load_all_data(self, cls: Type[T]) -> List[T]:
+    def _enqueue_log(self, level: utils.LogLevel, module: str, message: str) -> None:
+        # may be called from any thread: deque operations are atomic, and the wakeup is scheduled on the loop
+        if len(self._log_queue)>=self.LOG_QUEUE_MAX:
+            self._log_dropped[level] = self._log_dropped.get(level, 0)+1
+            return
+
+        self._log_queue.append({
+            'timestamp_ms': int(1000*time.time()),
+            'level': level,
+            'process': self.process_name,
+            'module': module,
+            'message': message,
+        })
+
+        if len(self._log_queue)==self.LOG_FLUSH_BATCH and self.loop is not None:
+            self.loop.call_soon_threadsafe(self._log_flush_event.set)
+
+    def flush_logs(self) -> None: # blocking, also called on shutdown
+        rows = []
+        while self._log_queue:
+            rows.append(self._log_queue.popleft())
+
+        dropped, self._log_dropped = self._log_dropped, {}
+        if dropped:
+            rows.append({
+                'timestamp_ms': int(1000*time.time()),
+                'level': 'error',
+                'process': self.process_name,
+                'module': 'base.flush_logs',
+                'message': f'log queue is full, dropped {sum(dropped.values())} rows: ' + ', '.join(f'{k}={v}' for k, v in dropped.items()),
+            })
+
+        if not rows:
+            return
+
+        try:
+            with self.SqlSession() as session:
+                session.execute(insert(LogStore), rows)
+                session.commit()
+        except Exception as e:
+            print(f'{datetime.datetime.now().strftime("%m%d-%H%M%S")} {self.process_name} [error] base.flush_logs: cannot write {len(rows)} log rows to db: {e!r}')
+
+    async def _log_flush_daemon(self) -> None:
+        while True:
+            try:
+                await asyncio.wait_for(self._log_flush_event.wait(), self.LOG_FLUSH_INTERVAL_S)
+            except asyncio.TimeoutError:
+                pass
+            self._log_flush_event.clear()
+
+            await self.run_sql(self.flush_logs)
+
+    async def run_sql(self, fn: Callable[..., R], *args: Any) -> R:
+        # run a blocking db call in the sql executor, the time is reported separately by `utils.log_slow`
+        t1 = time.monotonic()
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self.sql_executor, functools.partial(fn, *args))
+        finally:
+            utils.count_db_wait(time.monotonic()-t1)
+
+    def _load_all_data_sync(self, cls: Type[T]) -> List[T]:
         with self.SqlSession() as session:
             return list(session.execute(select(cls).order_by(cls.id)).scalars().all())
 
-    def load_one_data(self, cls: Type[T], id: int) -> Optional[T]:
+    def _load_one_data_sync(self, cls: Type[T], id: int) -> Optional[T]:
         with self.SqlSession() as session:
             return session.execute(select(cls).where(cls.id==id)).scalar()
 
+    async def load_all_data(self, cls: Type[T]) -> List[T]:
+        return await self.run_sql(self._load_all_data_sync, cls)
+
+    async def load_one_data(self, cls: Type[T], id: int) -> Optional[T]:
+        return await self.run_sql(self._load_one_data_sync, cls, id)
+
+    async def load_all_stores(self) -> GameStores:
+        return GameStores(
+            game_policy=await self.load_all_data(GamePolicyStore),
+            trigger=await self.load_all_data(TriggerStore),
+            challenge=await self.load_all_data(ChallengeStore),
+            announcement=await self.load_all_data(AnnouncementStore),
+            user=await self.load_all_data(UserStore),
+            submission=await self.load_all_data(SubmissionStore),
+        )
+
+    def current_stores(self) -> GameStores:
+        # in the same order as `load_all_stores`
+        def by_id(stores: List[T]) -> List[T]:
+            return sorted(stores, key=lambda s: s.id)
+
+        return GameStores(
+            game_policy=by_id(self._game.policy._stores),
+            trigger=by_id(self._game.trigger._stores),
+            challenge=by_id([ch._store for ch in self._game.challenges.list]),
+            announcement=by_id([ann._store for ann in self._game.announcements.list]),
+            user=by_id([u._store for u in self._game.users.list]),
+            submission=by_id([row.to_store() for row in self._game.submission_table]),
+        )
+
+    def dump_state_snapshot(self) -> bytes:
+        stores = self.current_stores()
+        data = {
+            'ver': self.STATE_SNAPSHOT_VER,
+            'state_counter': self.state_counter,
+            'tick': self._game.cur_tick,
+            'stores': {f.name: [s.to_snapshot() for s in getattr(stores, f.name)] for f in fields(GameStores)},
+        }
+        return zlib.compress(json.dumps(data, ensure_ascii=False, separators=(',', ':')).encode('utf-8'), 1)
+
+    @classmethod
+    def parse_state_snapshot(cls, snapshot: bytes) -> Tuple[int, int, GameStores]: # -> (state_counter, tick, stores)
+        data = json.loads(zlib.decompress(snapshot))
+        if data['ver']!=cls.STATE_SNAPSHOT_VER:
+            raise ValueError(f'state snapshot version mismatch: ours {cls.STATE_SNAPSHOT_VER}, got {data["ver"]}')
+
+        def load(store_cls: Type[T], key: str) -> List[T]:
+            return [store_cls.from_snapshot(s) for s in data['stores'][key]]
+
+        stores = GameStores(
+            game_policy=load(GamePolicyStore, 'game_policy'),
+            trigger=load(TriggerStore, 'trigger'),
+            challenge=load(ChallengeStore, 'challenge'),
+            announcement=load(AnnouncementStore, 'announcement'),
+            user=load(UserStore, 'user'),
+            submission=load(SubmissionStore, 'submission'),
+        )
+        return data['state_counter'], data['tick'], stores
+
+    async def load_event_data(self, cls: Type[T], event: glitter.Event) -> Optional[T]:
+        if event.payload is None: # not attached by the sender
+            return await self.load_one_data(cls, event.data)
+
+        snapshot = glitter.unpack_snapshot(event.payload)
+        if snapshot is None: # row is deleted
+            return None
+
+        assert snapshot['id']==event.data, 'event payload mismatch'
+        return cls.from_snapshot(snapshot)
+
     async def process_event(self, event: glitter.Event) -> None:
-        def default(_self: Any, ev: glitter.Event) -> None:
+        async def default(_self: Any, ev: glitter.Event) -> None:
             self.log('warning', 'base.process_event', f'unknown event: {ev.type!r}')
 
         listener: CbMethod = event_listeners.get(event.type, default)
 
         try:
             with utils.log_slow(self.log, 'base.process_event', f'handle event {event.type}'):
-                listener(self, event)
+                # events must be applied in order, but listeners may now wait for db
+                async with self.event_lock:
+                    await listener(self, event)
             self.reload_scoreboard_if_needed_later()
 
         except Exception as e:
@@ -280,6 +511,7 @@ class StateContainerBase(ABC):
                 'cur_tick': self._game.cur_tick,
                 'n_users': len(self._game.users.list),
                 'n_submissions': len(self._game.submissions),
+                'cached_views': self._game.cached_view_stats(),
             } if not self.game_dirty else {}),
             **self.custom_telemetry_data,
         }
\ No newline at end of file
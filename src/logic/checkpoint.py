@@ -0,0 +1,90 @@
+from __future__ import annotations
+import hashlib
+import json
+import os
+import time
+import zlib
+from pathlib import Path
+from typing import TYPE_CHECKING, Any, Dict, List
+
+from ..state import dyn_flag
+
+if TYPE_CHECKING:
+    from ..state import Game, Challenge
+    from ..state.submission_table import SubmissionTable, SubmissionRow
+
+# a checkpoint of derived game state, so that flags of old submissions need not be validated again after restart.
+# only the valid flag of each submission is stored. other derived states (passed users, scores, histories) are cheap
+# to rebuild from them, and rebuilding keeps them consistent with the current stores.
+
+CHECKPOINT_VER = 1
+
+def _digest(obj: Any) -> str:
+    return hashlib.sha256(json.dumps(obj, sort_keys=True, ensure_ascii=False).encode('utf-8')).hexdigest()
+
+def challenge_fingerprint(ch: Challenge) -> str:
+    # dynamic flags also depend on the generator script
+    dyn_scripts: Dict[str, str] = {}
+    for flag in ch.flags:
+        if flag.type=='dynamic':
+            assert isinstance(flag.val, str)
+            dyn_scripts[flag.val] = dyn_flag.script_digest(flag)
+
+    return _digest([ch._store.to_snapshot(), dyn_scripts])
+
+def game_fingerprint(game: Game) -> str:
+    return _digest([
+        CHECKPOINT_VER,
+        sorted([s.to_snapshot() for s in game.trigger._stores], key=lambda s: s['id']),
+        sorted([s.to_snapshot() for s in game.policy._stores], key=lambda s: s['id']),
+    ])
+
+def _submission_digest(store: SubmissionRow) -> int:
+    return zlib.crc32(f'{store.user_id}|{store.challenge_key}|{store.flag}'.encode('utf-8'))
+
+def dump(game: Game, state_counter: int) -> bytes:
+    subs: List[List[int]] = []
+    for sid, sub in game.submissions.items():
+        subs.append([sid, _submission_digest(sub._store), -1 if sub.valid_flag is None else sub.valid_flag.idx0])
+
+    data = {
+        'ver': CHECKPOINT_VER,
+        'created_at': int(time.time()),
+        'state_counter': state_counter,
+        'game': game_fingerprint(game),
+        'challenges': {ch._store.key: challenge_fingerprint(ch) for ch in game.challenges.list},
+        'submissions': subs,
+    }
+    return zlib.compress(json.dumps(data, separators=(',', ':')).encode('utf-8'), 1)
+
+def load_hints(checkpoint: bytes, game: Game, sub_stores: SubmissionTable) -> Dict[int, int]:
+    # -> {sid: idx0 of the valid flag, or -1}, only for submissions that are still valid
+    data = json.loads(zlib.decompress(checkpoint))
+    if data['ver']!=CHECKPOINT_VER or data['game']!=game_fingerprint(game):
+        return {}
+
+    n_flags: Dict[str, int] = {}
+    for ch in game.challenges.list:
+        if data['challenges'].get(ch._store.key, None)==challenge_fingerprint(ch):
+            n_flags[ch._store.key] = len(ch.flags)
+
+    hints: Dict[int, int] = {}
+    for sid, digest, idx0 in data['submissions']:
+        store = sub_stores.get(sid)
+        if (
+            store is not None
+            and store.challenge_key in n_flags
+            and idx0<n_flags[store.challenge_key]
+            and _submission_digest(store)==digest
+        ):
+            hints[sid] = idx0
+
+    return hints
+
+def write_file(path: Path, checkpoint: bytes) -> None:
+    tmp_path = path.with_name(path.name+'.tmp')
+    with tmp_path.open('wb') as f:
+        f.write(checkpoint)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
@@ -0,0 +1,182 @@
+from __future__ import annotations
+import json
+import struct
+import dataclasses
+from typing import Any, Callable, Dict, List, Tuple, Type, Union, get_args, get_origin, get_type_hints
+
+# a compact binary format for glitter messages, which are small dataclasses.
+# each message is encoded as one tag byte followed by its fields in declaration order.
+# the schema is derived from the type annotations, so both sides must agree on PROTOCOL_VER.
+
+Encoder = Callable[[Any, List[bytes]], None]
+Decoder = Callable[[bytes, int], Tuple[Any, int]] # (buf, pos) -> (value, new_pos)
+
+_U32 = struct.Struct('<I')
+_I64 = struct.Struct('<q')
+
+_json_encoder = json.JSONEncoder(ensure_ascii=False, separators=(',', ':'))
+_json_decoder = json.JSONDecoder()
+
+def _enc_int(v: int, out: List[bytes]) -> None:
+    out.append(_I64.pack(v))
+
+def _dec_int(buf: bytes, pos: int) -> Tuple[int, int]:
+    return _I64.unpack_from(buf, pos)[0], pos+_I64.size
+
+def _enc_bool(v: bool, out: List[bytes]) -> None:
+    out.append(b'\x01' if v else b'\x00')
+
+def _dec_bool(buf: bytes, pos: int) -> Tuple[bool, int]:
+    return buf[pos]!=0, pos+1
+
+def _enc_str(v: str, out: List[bytes]) -> None:
+    b = v.encode('utf-8')
+    out.append(_U32.pack(len(b)))
+    out.append(b)
+
+def _dec_str(buf: bytes, pos: int) -> Tuple[str, int]:
+    n = _U32.unpack_from(buf, pos)[0]
+    pos += _U32.size
+    if pos+n>len(buf):
+        raise ValueError('truncated str field')
+    return buf[pos:pos+n].decode('utf-8'), pos+n
+
+def _enc_bytes(v: bytes, out: List[bytes]) -> None:
+    out.append(_U32.pack(len(v)))
+    out.append(v)
+
+def _dec_bytes(buf: bytes, pos: int) -> Tuple[bytes, int]:
+    n = _U32.unpack_from(buf, pos)[0]
+    pos += _U32.size
+    if pos+n>len(buf):
+        raise ValueError('truncated bytes field')
+    return buf[pos:pos+n], pos+n
+
+def _enc_json(v: Any, out: List[bytes]) -> None: # for untyped values like telemetry
+    _enc_str(_json_encoder.encode(v), out)
+
+def _dec_json(buf: bytes, pos: int) -> Tuple[Any, int]:
+    s, pos = _dec_str(buf, pos)
+    return _json_decoder.decode(s), pos
+
+def _optional(enc: Encoder, dec: Decoder) -> Tuple[Encoder, Decoder]:
+    def encoder(v: Any, out: List[bytes]) -> None:
+        if v is None:
+            out.append(b'\x00')
+        else:
+            out.append(b'\x01')
+            enc(v, out)
+
+    def decoder(buf: bytes, pos: int) -> Tuple[Any, int]:
+        if buf[pos]==0:
+            return None, pos+1
+        return dec(buf, pos+1)
+
+    return encoder, decoder
+
+def _list(enc: Encoder, dec: Decoder) -> Tuple[Encoder, Decoder]:
+    def encoder(v: List[Any], out: List[bytes]) -> None:
+        out.append(_U32.pack(len(v)))
+        for x in v:
+            enc(x, out)
+
+    def decoder(buf: bytes, pos: int) -> Tuple[List[Any], int]:
+        n = _U32.unpack_from(buf, pos)[0]
+        pos += _U32.size
+        ret = []
+        for _ in range(n):
+            x, pos = dec(buf, pos)
+            ret.append(x)
+        return ret, pos
+
+    return encoder, decoder
+
+def _dict(k_codec: Tuple[Encoder, Decoder], v_codec: Tuple[Encoder, Decoder]) -> Tuple[Encoder, Decoder]:
+    enc_k, dec_k = k_codec
+    enc_v, dec_v = v_codec
+
+    def encoder(v: Dict[Any, Any], out: List[bytes]) -> None:
+        out.append(_U32.pack(len(v)))
+        for k, x in v.items():
+            enc_k(k, out)
+            enc_v(x, out)
+
+    def decoder(buf: bytes, pos: int) -> Tuple[Dict[Any, Any], int]:
+        n = _U32.unpack_from(buf, pos)[0]
+        pos += _U32.size
+        ret = {}
+        for _ in range(n):
+            k, pos = dec_k(buf, pos)
+            x, pos = dec_v(buf, pos)
+            ret[k] = x
+        return ret, pos
+
+    return encoder, decoder
+
+def field_codec(tp: Any) -> Tuple[Encoder, Decoder]:
+    if tp is Any:
+        return _enc_json, _dec_json
+    if tp is bool: # before int because bool is a subclass of int
+        return _enc_bool, _dec_bool
+    if tp is int:
+        return _enc_int, _dec_int
+    if tp is str:
+        return _enc_str, _dec_str
+    if tp is bytes:
+        return _enc_bytes, _dec_bytes
+
+    origin = get_origin(tp)
+    args = get_args(tp)
+
+    if origin is Union and len(args)==2 and type(None) in args:
+        inner = args[0] if args[1] is type(None) else args[1]
+        return _optional(*field_codec(inner))
+    if origin is list and len(args)==1 and args[0] is not Any:
+        return _list(*field_codec(args[0]))
+    if origin is dict and len(args)==2:
+        if args[1] is Any: # arbitrary json object
+            return _enc_json, _dec_json
+        return _dict(field_codec(args[0]), field_codec(args[1]))
+
+    raise TypeError(f'unsupported field type: {tp!r}')
+
+class MessageCodec:
+    def __init__(self, tags: Dict[int, Type[Any]]):
+        self._encoders: Dict[Type[Any], Tuple[bytes, List[Tuple[str, Encoder]]]] = {}
+        self._decoders: Dict[int, Tuple[Type[Any], List[Decoder]]] = {}
+
+        for tag, cls in tags.items():
+            assert 0<tag<256, f'tag of {cls.__name__} should be one byte'
+            assert dataclasses.is_dataclass(cls), f'{cls.__name__} should be a dataclass'
+
+            hints = get_type_hints(cls)
+            fields = [(f.name, field_codec(hints[f.name])) for f in dataclasses.fields(cls) if f.init]
+
+            self._encoders[cls] = (bytes([tag]), [(name, enc) for name, (enc, _dec) in fields])
+            self._decoders[tag] = (cls, [dec for _name, (_enc, dec) in fields])
+
+    def encode(self, msg: Any) -> bytes:
+        tag, encoders = self._encoders[type(msg)]
+        out = [tag]
+        for name, enc in encoders:
+            enc(getattr(msg, name), out)
+        return b''.join(out)
+
+    def decode(self, buf: bytes) -> Any:
+        if not buf or buf[0] not in self._decoders:
+            raise ValueError(f'unknown message tag: {buf[:1]!r}')
+
+        cls, decoders = self._decoders[buf[0]]
+        pos = 1
+        vals = []
+        try:
+            for dec in decoders:
+                val, pos = dec(buf, pos)
+                vals.append(val)
+        except (struct.error, IndexError, UnicodeDecodeError, json.JSONDecodeError) as e:
+            raise ValueError(f'malformed {cls.__name__} message: {e!r}')
+
+        if pos!=len(buf):
+            raise ValueError(f'malformed {cls.__name__} message: {len(buf)-pos} trailing bytes')
+
+        return cls(*vals)
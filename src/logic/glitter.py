@@ -1,16 +1,17 @@
 from __future__ import annotations
 from enum import Enum, unique
-import json
 from dataclasses import dataclass
 from zmq.asyncio import Socket
 import pickle
+import json
 import asyncio
 from typing import Dict, Any, Optional, List
 
+from .codec import MessageCodec
 from .. import utils
 from .. import secret
 
-PROTOCOL_VER = 'glitter.alpha.v2'
+PROTOCOL_VER = 'glitter.alpha.v4'
 
 @unique
 class EventType(Enum):
@@ -26,6 +27,7 @@ class EventType(Enum):
 
     NEW_SUBMISSION = b'\x31'
     TICK_UPDATE = b'\x32'
+    TICK_PREVIEW = b'\x33' # the tick that will come soon, so that workers can render it in advance
 
 @dataclass
 class ActionReq:
@@ -42,6 +44,15 @@ class WorkerHeartbeatReq(ActionReq):
 class WorkerHelloReq(ActionReq):
     protocol_ver: str
 
+@dataclass
+class FetchStateSnapshotReq(ActionReq):
+    pass
+
+@dataclass
+class FetchEventsReq(ActionReq):
+    first_counter: int
+    last_counter: int # inclusive
+
 @dataclass
 class RegUserReq(ActionReq):
     login_key: str
@@ -74,82 +85,182 @@ class ActionRep:
     error_msg: Optional[str]
     state_counter: int
 
+@dataclass
+class StateSnapshotRep(ActionRep):
+    snapshot: bytes # see `StateContainerBase.dump_state_snapshot`
+
+@dataclass
+class EventsRep(ActionRep):
+    events: List[List[bytes]] # see `Event.to_frames`
+
+# tags should never be reused. 0x7b ('{') and 0x80 (pickle) are avoided, so legacy peers can be detected.
+codec = MessageCodec({
+    0x01: WorkerHeartbeatReq,
+    0x02: WorkerHelloReq,
+    0x03: FetchStateSnapshotReq,
+    0x04: FetchEventsReq,
+    0x11: RegUserReq,
+    0x12: UpdateProfileReq,
+    0x13: AgreeTermReq,
+    0x14: SubmitFlagReq,
+    0x15: SubmitFeedbackReq,
+
+    0x21: ActionRep, # keep its layout stable so that version mismatch errors can always be decoded
+    0x22: StateSnapshotRep,
+    0x23: EventsRep,
+})
+
 CALL_TIMEOUT_MS = 5000
 
-class Action:
-    _lock: Optional[asyncio.Lock] = None
-    def __init__(self, req: ActionReq):
-        self.req: ActionReq = req
+def _decode_rep(body: bytes) -> ActionRep:
+    if body[:1]==b'{': # json error from a legacy reducer, which cannot parse our req
+        return ActionRep(error_msg=f'protocol version mismatch: worker {PROTOCOL_VER}, reducer replied {body[:100]!r}', state_counter=-1)
 
-    async def _send_req(self, sock: Socket) -> None:
-        await sock.send_multipart([secret.GLITTER_SSRF_TOKEN.encode(), pickle.dumps(self.req)])
-    @staticmethod
-    async def _recv_rep(sock: Socket) -> ActionRep:
-        parts = await sock.recv_multipart()
-        assert len(parts)==1, 'malformed action rep packet: should contain one part'
-        rep = pickle.loads(parts[0])
-        assert isinstance(rep, ActionRep)
-        return rep
+    rep = codec.decode(body)
+    assert isinstance(rep, ActionRep)
+    return rep
 
-    # client
+class ActionClient:
+    # runs on a DEALER socket, so many actions can be in flight at the same time.
+    # each req is prefixed with a request id, which the reducer echoes back in the reply envelope.
+
+    def __init__(self, sock: Socket):
+        self.sock: Socket = sock
+        self._next_req_id: int = 1
+        self._pending: Dict[bytes, asyncio.Future[ActionRep]] = {}
+        self._recv_task: Optional[asyncio.Task[None]] = None
+
+    async def _recv_loop(self) -> None:
+        try:
+            while True:
+                parts = await self.sock.recv_multipart()
+                if len(parts)!=3 or parts[1]!=b'':
+                    print('dropping malformed action rep packet')
+                    continue
+
+                req_id, _delim, body = parts
+                fut = self._pending.get(req_id, None)
+                if fut is None or fut.done(): # caller already timed out or cancelled
+                    continue
 
-    async def call(self, sock: Socket) -> ActionRep:
-        if Action._lock is None:
-            Action._lock = asyncio.Lock()
+                try:
+                    fut.set_result(_decode_rep(body))
+                except Exception as e:
+                    fut.set_exception(e)
+        except Exception as e: # socket failure, will be restarted by the next call
+            print(utils.get_traceback(e))
+            for fut in self._pending.values():
+                if not fut.done():
+                    fut.set_exception(e)
+
+    async def call(self, req: ActionReq, timeout_ms: int = CALL_TIMEOUT_MS) -> ActionRep:
+        if self._recv_task is None or self._recv_task.done():
+            self._recv_task = asyncio.create_task(self._recv_loop())
+
+        req_id = self._next_req_id.to_bytes(8, 'little')
+        self._next_req_id += 1
 
-        async with Action._lock:
-            await self._send_req(sock)
-            ret = await self._recv_rep(sock)
-            return ret
+        fut: asyncio.Future[ActionRep] = asyncio.get_running_loop().create_future()
+        self._pending[req_id] = fut
+        try:
+            await self.sock.send_multipart([req_id, b'', secret.GLITTER_SSRF_TOKEN.encode(), PROTOCOL_VER.encode(), codec.encode(req)])
+            return await asyncio.wait_for(fut, timeout_ms/1000)
+        finally:
+            del self._pending[req_id]
+
+class Action:
+    def __init__(self, req: ActionReq, envelope: Optional[List[bytes]] = None):
+        self.req: ActionReq = req
+        self.envelope: List[bytes] = envelope or [] # routing frames prepended by the ROUTER socket, plus the request id
 
     # server
 
     @classmethod
     async def listen(cls, sock: Socket) -> Optional[Action]:
         pkt = await sock.recv_multipart()
+
+        # the ROUTER socket prepends the peer identity, followed by the request id and an empty delimiter frame
+        if b'' not in pkt:
+            print('dropping unroutable action req packet')
+            return None
+        delim_idx = pkt.index(b'')
+        envelope, pkt = pkt[:delim_idx+1], pkt[delim_idx+1:]
+
+        if len(pkt)==2: # legacy worker that sends pickled req, reply in a way that it can understand
+            print('rejecting action req from legacy worker')
+            await sock.send_multipart([*envelope, pickle.dumps(ActionRep(
+                error_msg=f'protocol version mismatch: reducer {PROTOCOL_VER}, worker is legacy',
+                state_counter=-1,
+            ))])
+            return None
+
+        err = 'malformed packet'
         try:
-            assert len(pkt)==2, 'action req packet should contain one part'
+            assert len(pkt)==3, 'action req packet should contain three parts'
             assert pkt[0]==secret.GLITTER_SSRF_TOKEN.encode(), 'invalid ssrf token'
-            data = pickle.loads(pkt[1])
+            if pkt[1]!=PROTOCOL_VER.encode():
+                err = f'protocol version mismatch: reducer {PROTOCOL_VER}, worker {pkt[1][:100].decode("utf-8", "replace")}'
+                raise ValueError(err)
+            data = codec.decode(pkt[2])
             assert isinstance(data, ActionReq), 'malformed action req packet body'
-            return cls(data)
+            return cls(data, envelope)
         except Exception as e:
             print(utils.get_traceback(e))
-            await sock.send_multipart([json.dumps({
-                'error_msg': 'malformed packet',
-                'state_counter': -1,
-            }).encode('utf-8')])
+            await sock.send_multipart([*envelope, codec.encode(ActionRep(error_msg=err, state_counter=-1))])
             return None
 
-    @staticmethod
-    async def reply(rep: ActionRep, sock: Socket) -> None:
-        await sock.send_multipart([pickle.dumps(rep)])
+    async def reply(self, rep: ActionRep, sock: Socket) -> None:
+        await sock.send_multipart([*self.envelope, codec.encode(rep)])
 
 
 SYNC_TIMEOUT_MS = 7000
 
+# larger rows are not attached to the event, and the receiver will load them from db instead
+EVENT_PAYLOAD_MAX_BYTES = 32*1024
+
+def pack_snapshot(snapshot: Optional[Dict[str, Any]]) -> Optional[bytes]: # snapshot=None means the row is deleted
+    payload = json.dumps(snapshot, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+    return payload if len(payload)<=EVENT_PAYLOAD_MAX_BYTES else None
+
+def unpack_snapshot(payload: bytes) -> Optional[Dict[str, Any]]:
+    snapshot = json.loads(payload)
+    assert snapshot is None or isinstance(snapshot, dict), 'malformed event payload'
+    return snapshot
+
 class Event:
-    def __init__(self, type: EventType, state_counter: int, data: int):
+    def __init__(self, type: EventType, state_counter: int, data: int, payload: Optional[bytes] = None):
         self.type: EventType = type
         self.state_counter: int = state_counter
         self.data: int = data
-
-    # client
+        self.payload: Optional[bytes] = payload # snapshot of the changed row, see `pack_snapshot`
 
     @classmethod
-    async def next(cls, sock: Socket) -> Event:
-        type_str, ts, id = await sock.recv_multipart()
+    def from_frames(cls, parts: List[bytes]) -> Event:
+        assert len(parts) in [3, 4], f'malformed event packet: {len(parts)} parts'
+        type_str, ts, id = parts[:3]
         type = EventType(type_str)
         cnt = int(ts.decode('utf-8'))
         data = int(id.decode('utf-8'))
-        return cls(type=type, state_counter=cnt, data=data)
+        payload = parts[3] if len(parts)==4 else None
+        return cls(type=type, state_counter=cnt, data=data, payload=payload)
 
-    # server
-
-    async def send(self, sock: Socket) -> None:
+    def to_frames(self) -> List[bytes]:
         data: List[bytes] = [
             self.type.value,
             str(self.state_counter).encode('utf-8'),
             str(self.data).encode('utf-8'),
         ]
-        await sock.send_multipart(data)
\ No newline at end of file
+        if self.payload is not None:
+            data.append(self.payload)
+        return data
+
+    # client
+
+    @classmethod
+    async def next(cls, sock: Socket) -> Event:
+        return cls.from_frames(await sock.recv_multipart())
+
+    # server
+
+    async def send(self, sock: Socket) -> None:
+        await sock.send_multipart(self.to_frames())
\ No newline at end of file
@@ -3,31 +3,51 @@ import zmq
 from zmq.asyncio import Socket
 from typing import Optional
 from sqlalchemy import select
+from sqlalchemy.orm import Session
 import asyncio
 import time
 import datetime
 import json
 import sys
-from typing import Callable, Any, Awaitable, Dict, Tuple
+import itertools
+from collections import deque
+from dataclasses import dataclass
+from typing import Callable, Any, Awaitable, Dict, Tuple, List, Set, Union, Deque
 
-from . import glitter
+from . import glitter, checkpoint
 from .base import StateContainerBase, make_callback_decorator
-from ..state import Trigger
+from ..state import Trigger, Game, flag_table
 from ..store import *
 from .. import utils
 from .. import secret
 from .. import token_signer
 
 on_action, action_listeners = make_callback_decorator()
+on_write_action, write_action_listeners = make_callback_decorator()
+
+@dataclass
+class StagedWrite:
+    # a write action that is flushed into the group-commit transaction, and will emit one event after commit
+    event_type: glitter.EventType
+    event_data: int
+    check_after_emit: Optional[Callable[[], Optional[str]]] = None
+    event_payload: Optional[bytes] = None # snapshot of the changed row, so others need not load it from db
+
+WriteResult = Union[str, StagedWrite] # str for error message
+WriteFn = Callable[[Session], WriteResult] # db work of a write action, see `stage_write_actions`
+PreparedWrite = Union[str, WriteFn] # str for error message
 
 class Reducer(StateContainerBase):
     SYNC_THROTTLE_S = 1
     SYNC_INTERVAL_S = 3
+    EVENT_REPLAY_RING_SIZE = 1000
+    CHECKPOINT_INTERVAL_S = 600
+    TICK_PREVIEW_AHEAD_S = 60
 
     def __init__(self, process_name: str):
         super().__init__(process_name)
 
-        self.action_socket: Socket = self.glitter_ctx.socket(zmq.REP)
+        self.action_socket: Socket = self.glitter_ctx.socket(zmq.ROUTER)
         self.event_socket: Socket = self.glitter_ctx.socket(zmq.PUB)
 
         self.action_socket.setsockopt(zmq.RCVTIMEO, self.SYNC_INTERVAL_S*1000)
@@ -39,11 +59,26 @@ class Reducer(StateContainerBase):
 
         self.tick_updater_task: Optional[asyncio.Task[None]] = None
         self.health_check_task: Optional[asyncio.Task[None]] = None
+        self.checkpoint_task: Optional[asyncio.Task[None]] = None
+        self.flag_table_task: Optional[asyncio.Task[None]] = None
+        self._flag_tables_outdated = asyncio.Event()
 
         self.received_telemetries: Dict[str, Tuple[float, Dict[str, Any]]] = {process_name: (0, {})}
 
         self.last_emit_sync_time: float = 0
 
+        # action received while collecting a batch, but conflicts with an earlier action in that batch
+        self._deferred_action: Optional[glitter.Action] = None
+
+        # (state_counter, game, snapshot), shared by workers that resync at the same time
+        self._state_snapshot: Optional[Tuple[int, Game, bytes]] = None
+
+        # (state_counter, game) of the last written checkpoint
+        self._checkpoint_written: Optional[Tuple[int, Game]] = None
+
+        # recently emitted events with consecutive state counters, so workers can replay the ones they lost
+        self.recent_events: Deque[glitter.Event] = deque(maxlen=self.EVENT_REPLAY_RING_SIZE)
+
     async def _before_run(self) -> None:
         await super()._before_run()
 
@@ -61,12 +96,27 @@ class Reducer(StateContainerBase):
             await self.emit_sync()
             return None
 
-    @on_action(glitter.RegUserReq)
-    async def on_reg_user(self, req: glitter.RegUserReq) -> Optional[str]:
+    @on_action(glitter.FetchStateSnapshotReq)
+    async def on_fetch_state_snapshot(self, _req: glitter.FetchStateSnapshotReq) -> Optional[str]:
+        self.get_state_snapshot() # attached to the reply, see `make_reply`
+        return None
+
+    @on_action(glitter.FetchEventsReq)
+    async def on_fetch_events(self, req: glitter.FetchEventsReq) -> Optional[str]:
+        if self.get_recent_events(req.first_counter, req.last_counter) is None:
+            return 'events not available'
+        return None # attached to the reply, see `make_reply`
+
+    # write handlers check the request against the game state on the loop, and return the db work, which is run in
+    # the sql executor later (see `stage_write_actions`). the db work must not touch the game state, as it is changed by
+    # the loop meanwhile.
+
+    @on_write_action(glitter.RegUserReq)
+    def on_reg_user(self, req: glitter.RegUserReq) -> PreparedWrite:
         if req.login_key in self._game.users.user_by_login_key:
             return 'user already exists'
 
-        with self.SqlSession() as session:
+        def write(session: Session) -> WriteResult:
             user = UserStore(
                 login_key=req.login_key,
                 login_properties=req.login_properties,
@@ -90,18 +140,18 @@ class Reducer(StateContainerBase):
             user.token = token_signer.sign_token(secret.TOKEN_SIGNER, uid)
             user.auth_token = f'{uid}_{utils.gen_random_str(48, crypto=True)}'
             user.profile_id = profile.id
+            user.profile = profile # so the snapshot carries the new profile
+            session.flush()
 
-            session.commit()
-            self.state_counter += 1
+            return StagedWrite(glitter.EventType.UPDATE_USER, uid, event_payload=glitter.pack_snapshot(user.to_snapshot()))
 
-        await self.emit_event(glitter.Event(glitter.EventType.UPDATE_USER, self.state_counter, uid))
-        return None
+        return write
 
-    @on_action(glitter.UpdateProfileReq)
-    async def on_update_profile(self, req: glitter.UpdateProfileReq) -> Optional[str]:
+    @on_write_action(glitter.UpdateProfileReq)
+    def on_update_profile(self, req: glitter.UpdateProfileReq) -> PreparedWrite:
         uid = int(req.uid)
 
-        with self.SqlSession() as session:
+        def write(session: Session) -> WriteResult:
             user: Optional[UserStore] = session.execute(select(UserStore).where(UserStore.id==uid)).scalar()
             if user is None:
                 return 'user not found'
@@ -129,31 +179,31 @@ class Reducer(StateContainerBase):
 
             assert profile.id is not None, 'updated profile not in db'
             user.profile_id = profile.id
+            user.profile = profile # so the snapshot carries the new profile
+            session.flush()
 
-            session.commit()
-            self.state_counter += 1
+            return StagedWrite(glitter.EventType.UPDATE_USER, uid, event_payload=glitter.pack_snapshot(user.to_snapshot()))
 
-        await self.emit_event(glitter.Event(glitter.EventType.UPDATE_USER, self.state_counter, uid))
-        return None
+        return write
 
-    @on_action(glitter.AgreeTermReq)
-    async def on_agree_term(self, req: glitter.AgreeTermReq) -> Optional[str]:
+    @on_write_action(glitter.AgreeTermReq)
+    def on_agree_term(self, req: glitter.AgreeTermReq) -> PreparedWrite:
         uid = int(req.uid)
 
-        with self.SqlSession() as session:
+        def write(session: Session) -> WriteResult:
             user: Optional[UserStore] = session.execute(select(UserStore).where(UserStore.id==uid)).scalar()
             if user is None:
                 return 'user not found'
 
             user.terms_agreed = True
-            session.commit()
-            self.state_counter += 1
+            session.flush()
 
-        await self.emit_event(glitter.Event(glitter.EventType.UPDATE_USER, self.state_counter, uid))
-        return None
+            return StagedWrite(glitter.EventType.UPDATE_USER, uid, event_payload=glitter.pack_snapshot(user.to_snapshot()))
 
-    @on_action(glitter.SubmitFlagReq)
-    async def on_submit_flag(self, req: glitter.SubmitFlagReq) -> Optional[str]:
+        return write
+
+    @on_write_action(glitter.SubmitFlagReq)
+    def on_submit_flag(self, req: glitter.SubmitFlagReq) -> PreparedWrite:
         ch = self._game.challenges.chall_by_key.get(req.challenge_key, None)
         if not ch:
             return 'challenge not found'
@@ -168,44 +218,54 @@ class Reducer(StateContainerBase):
             if delta < SubmissionStore.SUBMIT_COOLDOWN_S - 1:
                 return '请求太频繁'
 
-        with self.SqlSession() as session:
+        uid = user._store.id
+        ch_key = ch._store.key
+        percentage_override = (
+            GamePolicyStore.DEDUCTION_PERCENTAGE_OVERRIDE if (
+                self._game.policy.cur_policy.is_submission_deducted
+                and (ch._store.chall_metadata is None or ch._store.chall_metadata.get('score_deduction_eligible', True))
+            ) else None
+        )
+
+        def write(session: Session) -> WriteResult:
             submission = SubmissionStore(
-                user_id=user._store.id,
-                challenge_key=ch._store.key,
+                user_id=uid,
+                challenge_key=ch_key,
                 flag=str(req.flag),
-                percentage_override_or_null=(
-                    GamePolicyStore.DEDUCTION_PERCENTAGE_OVERRIDE if (
-                        self._game.policy.cur_policy.is_submission_deducted
-                        and (ch._store.chall_metadata is None or ch._store.chall_metadata.get('score_deduction_eligible', True))
-                    ) else None
-                ),
+                percentage_override_or_null=percentage_override,
             )
             session.add(submission)
-            session.commit()
-            self.state_counter += 1
+            session.flush()
 
             sid = submission.id
             assert sid is not None, 'created submission not in db'
 
-        await self.emit_event(glitter.Event(glitter.EventType.NEW_SUBMISSION, self.state_counter, sid))
+            def check_after_emit() -> Optional[str]: # on the loop
+                sub = self._game.submissions.get(sid, None)
+                assert sub is not None, 'submission not found'
 
-        sub = self._game.submissions.get(sid, None)
-        assert sub is not None, 'submission not found'
+                if sub.duplicate_submission:
+                    return '已经提交过此Flag'
+                if sub.matched_flag is None:
+                    return 'Flag错误'
 
-        if sub.duplicate_submission:
-            return '已经提交过此Flag'
-        if sub.matched_flag is None:
-            return 'Flag错误'
+                return None
 
-        return None
+            return StagedWrite(
+                glitter.EventType.NEW_SUBMISSION, sid, check_after_emit,
+                event_payload=glitter.pack_snapshot(submission.to_snapshot()),
+            )
 
-    @on_action(glitter.SubmitFeedbackReq)
-    async def on_submit_feedback(self, req: glitter.SubmitFeedbackReq) -> Optional[str]:
+        return write
+
+    @on_write_action(glitter.SubmitFeedbackReq)
+    def on_submit_feedback(self, req: glitter.SubmitFeedbackReq) -> PreparedWrite:
         uid = int(req.uid)
-        ts = int(1000*time.time())
 
-        with self.SqlSession() as session:
-            user: Optional[UserStore] = session.execute(select(UserStore).where(UserStore.id == req.uid)).scalar()
+        def write(session: Session) -> WriteResult:
+            ts = int(1000*time.time())
+
+            user: Optional[UserStore] = session.execute(select(UserStore).where(UserStore.id==uid)).scalar()
             if user is None:
                 return 'user not found'
 
@@ -218,12 +278,11 @@ class Reducer(StateContainerBase):
                 content=req.feedback,
             )
             session.add(feedback)
+            session.flush()
 
-            session.commit()
-            self.state_counter += 1
+            return StagedWrite(glitter.EventType.UPDATE_USER, uid, event_payload=glitter.pack_snapshot(user.to_snapshot()))
 
-        await self.emit_event(glitter.Event(glitter.EventType.UPDATE_USER, self.state_counter, uid))
-        return None
+        return write
 
     @on_action(glitter.WorkerHeartbeatReq)
     async def on_worker_heartbeat(self, req: glitter.WorkerHeartbeatReq) -> Optional[str]:
@@ -246,14 +305,79 @@ class Reducer(StateContainerBase):
 
         return expires
 
+    async def _preview_tick(self, ts: int) -> None:
+        next_tick, _expires = self._game.trigger.get_tick_at_time(ts)
+        if next_tick!=self._game.cur_tick:
+            self.log('info', 'reducer.preview_tick', f'preview tick {self._game.cur_tick} -> {next_tick}')
+
+            self.state_counter += 1
+            await self.emit_event(glitter.Event(glitter.EventType.TICK_PREVIEW, self.state_counter, next_tick))
+
     async def _tick_updater_daemon(self) -> None:
         ts = time.time()
         while True:
             expires = await self._update_tick(int(ts))
             self.log('debug', 'reducer.tick_updater_daemon', f'next tick in {"+INF" if expires==Trigger.TS_INF_S else int(expires-ts)} seconds')
-            await asyncio.sleep(expires-ts+.2)
+
+            if expires!=Trigger.TS_INF_S and expires-ts>self.TICK_PREVIEW_AHEAD_S:
+                # let workers render the next tick in advance
+                await asyncio.sleep(expires-ts-self.TICK_PREVIEW_AHEAD_S)
+                await self._preview_tick(int(expires))
+                await asyncio.sleep(self.TICK_PREVIEW_AHEAD_S+.2)
+            else:
+                await asyncio.sleep(expires-ts+.2)
+
             ts = expires
 
+    async def _checkpoint_daemon(self) -> None:
+        while True:
+            await asyncio.sleep(self.CHECKPOINT_INTERVAL_S)
+            self.write_checkpoint()
+
+    def write_checkpoint(self) -> None: # also called on shutdown
+        path = secret.DERIVED_STATE_CHECKPOINT_PATH
+        if path is None or self._game is None or self.game_dirty or self._game.need_reloading_scoreboard: # derived state may be stale
+            return
+        if self._checkpoint_written is not None and self._checkpoint_written==(self.state_counter, self._game):
+            return
+
+        try:
+            with utils.log_slow(self.log, 'reducer.write_checkpoint', 'write checkpoint'):
+                checkpoint.write_file(path, checkpoint.dump(self._game, self.state_counter))
+        except Exception as e:
+            self.log('error', 'reducer.write_checkpoint', f'cannot write checkpoint: {utils.get_traceback(e)}')
+        else:
+            self._checkpoint_written = (self.state_counter, self._game)
+            self.log('info', 'reducer.write_checkpoint', f'written checkpoint for {len(self._game.submissions)} submissions at count={self.state_counter}')
+
+    async def _flag_table_daemon(self) -> None:
+        while True:
+            await self._flag_tables_outdated.wait()
+            self._flag_tables_outdated.clear()
+            await self.build_flag_tables()
+
+    async def build_flag_tables(self) -> None:
+        if self._game is None:
+            return
+
+        # snapshot them, because the game may be changed while building
+        users = list(self._game.users.list)
+        flags = [f for ch in self._game.challenges.list for f in ch.flags]
+
+        for f in flags:
+            try:
+                path = flag_table.table_path(f)
+                if path is None or path.is_file():
+                    continue
+
+                t1 = time.monotonic()
+                n = await asyncio.get_running_loop().run_in_executor(None, flag_table.build_table, f, users, path)
+                t2 = time.monotonic()
+            except Exception as e:
+                self.log('error', 'reducer.build_flag_tables', f'cannot build flag table of {f!r}: {utils.get_traceback(e)}')
+            else:
+                self.log('info', 'reducer.build_flag_tables', f'built flag table of {f!r} for {n} users in {t2-t1:.2f}s')
+
     async def _health_check_daemon(self) -> None:
         while True:
             await asyncio.sleep(60)
@@ -325,6 +449,84 @@ class Reducer(StateContainerBase):
         with utils.log_slow(self.log, 'reducer.handle_action', f'handle action {action.req.type}'):
             return await listener(self, action.req)
 
+    def prepare_write_action(self, action: glitter.Action) -> PreparedWrite: # on the loop
+        listener: Callable[[Any, glitter.ActionReq], PreparedWrite] = write_action_listeners[type(action.req)]
+
+        try:
+            return listener(self, action.req)
+        except Exception as e:
+            self.log('critical', 'reducer.prepare_write_action', f'exception, will report as internal error: {utils.get_traceback(e)}')
+            return '内部错误，已记录日志'
+
+    def stage_write_actions(self, write_fns: List[WriteFn]) -> List[WriteResult]:
+        # in the sql executor, so only the db is touched here.
+        # write all actions in one transaction (group commit), each in a savepoint so that a failing action does not
+        # abort others. events are NOT emitted here, because other processes can only load the data after commit.
+
+        results: List[WriteResult] = []
+
+        with utils.log_slow(self.log, 'reducer.stage_write_actions', f'stage {len(write_fns)} write actions'):
+            with self.SqlSession() as session:
+                for write_fn in write_fns:
+                    savepoint = session.begin_nested()
+                    try:
+                        res = write_fn(session)
+                    except Exception as e:
+                        savepoint.rollback()
+                        self.log('critical', 'reducer.stage_write_actions', f'exception, will report as internal error: {utils.get_traceback(e)}')
+                        res = '内部错误，已记录日志'
+                    else:
+                        if isinstance(res, str):
+                            savepoint.rollback()
+                        else:
+                            savepoint.commit()
+
+                    results.append(res)
+
+                session.commit()
+
+        return results
+
+    def get_state_snapshot(self) -> bytes:
+        cached = self._state_snapshot
+        if cached is None or cached[0]!=self.state_counter or cached[1] is not self._game:
+            with utils.log_slow(self.log, 'reducer.get_state_snapshot', f'dump state snapshot'):
+                snapshot = self.dump_state_snapshot()
+            self.log('debug', 'reducer.get_state_snapshot', f'dumped state snapshot ({len(snapshot)} bytes) at count={self.state_counter}')
+            cached = self._state_snapshot = (self.state_counter, self._game, snapshot)
+
+        return cached[2]
+
+    def get_recent_events(self, first_counter: int, last_counter: int) -> Optional[List[glitter.Event]]:
+        # None if some of them are already dropped from the ring (or not emitted yet)
+        if first_counter>last_counter:
+            return []
+        if not self.recent_events or first_counter<self.recent_events[0].state_counter or last_counter>self.recent_events[-1].state_counter:
+            return None
+
+        offset = self.recent_events[0].state_counter
+        return list(itertools.islice(self.recent_events, first_counter-offset, last_counter-offset+1))
+
+    def make_reply(self, action: glitter.Action, err: Optional[str]) -> glitter.ActionRep:
+        if err is None and isinstance(action.req, glitter.FetchStateSnapshotReq):
+            return glitter.StateSnapshotRep(error_msg=None, state_counter=self.state_counter, snapshot=self.get_state_snapshot())
+        if err is None and isinstance(action.req, glitter.FetchEventsReq):
+            events = self.get_recent_events(action.req.first_counter, action.req.last_counter)
+            assert events is not None
+            return glitter.EventsRep(error_msg=None, state_counter=self.state_counter, events=[ev.to_frames() for ev in events])
+        return glitter.ActionRep(error_msg=err, state_counter=self.state_counter)
+
+    async def apply_write_result(self, res: WriteResult) -> Optional[str]:
+        if isinstance(res, str):
+            return res
+
+        self.state_counter += 1
+        await self.emit_event(glitter.Event(res.event_type, self.state_counter, res.event_data, res.event_payload))
+
+        if res.check_after_emit is not None:
+            return res.check_after_emit()
+        return None
+
     async def process_event(self, event: glitter.Event) -> None:
         await super().process_event(event)
         if event.type==glitter.EventType.RELOAD_TRIGGER:
@@ -332,9 +534,17 @@ class Reducer(StateContainerBase):
             if self.tick_updater_task is not None:
                 self.tick_updater_task.cancel()
                 self.tick_updater_task = asyncio.create_task(self._tick_updater_daemon())
+        elif event.type==glitter.EventType.UPDATE_CHALLENGE:
+            self._flag_tables_outdated.set()
 
     async def emit_event(self, event: glitter.Event) -> None:
         self.log('info', 'reducer.emit_event', f'emit event {event.type}')
+
+        # before any await, so that the ring is always consistent with state_counter
+        if self.recent_events and self.recent_events[-1].state_counter+1!=event.state_counter:
+            self.recent_events.clear()
+        self.recent_events.append(event)
+
         await self.process_event(event)
 
         with utils.log_slow(self.log, 'reducer.emit_event', f'emit event {event.type}'):
@@ -349,26 +559,86 @@ class Reducer(StateContainerBase):
         with utils.log_slow(self.log, 'reducer.emit_sync', f'emit sync'):
             await glitter.Event(glitter.EventType.SYNC, self.state_counter, self._game.cur_tick).send(self.event_socket)
 
-    async def _mainloop(self) -> None:
-        self.log('success', 'reducer.mainloop', 'started to receive actions')
-        self.tick_updater_task = asyncio.create_task(self._tick_updater_daemon())
-        self.health_check_task = asyncio.create_task(self._health_check_daemon())
+    @staticmethod
+    def _batch_conflict_key(req: glitter.ActionReq) -> Optional[Tuple[str, Any]]:
+        # actions with the same key should not be in the same batch, because later ones are checked against the game
+        # state, which is not updated until the batch is committed
+        if isinstance(req, glitter.RegUserReq):
+            return 'login_key', req.login_key
+        elif isinstance(req, (glitter.UpdateProfileReq, glitter.AgreeTermReq, glitter.SubmitFlagReq, glitter.SubmitFeedbackReq)):
+            return 'uid', int(req.uid)
+        else:
+            return None
 
-        while True:
+    async def _receive_batch(self) -> List[glitter.Action]:
+        if self._deferred_action is not None:
+            first_action: Optional[glitter.Action] = self._deferred_action
+            self._deferred_action = None
+        else:
+            first_action = await glitter.Action.listen(self.action_socket)
+
+        if first_action is None:
+            return []
+
+        batch = [first_action]
+        conflict_keys: Set[Tuple[str, Any]] = set()
+        if (key := self._batch_conflict_key(first_action.req)) is not None:
+            conflict_keys.add(key)
+
+        # collect more actions that are ready within the group commit window.
+        # a lone action is not delayed, we only wait for more actions if there is already a burst.
+        deadline = time.monotonic() + secret.GLITTER_GROUP_COMMIT_MAX_WAIT_MS/1000
+        while len(batch)<secret.GLITTER_GROUP_COMMIT_MAX_BATCH:
+            timeout_ms = 0 if len(batch)==1 else max(0, int((deadline-time.monotonic())*1000))
             try:
-                action: Optional[glitter.Action] = await glitter.Action.listen(self.action_socket)
-            except zmq.error.Again: # timeout, means no action in this interval
-                await self.emit_sync()
-                continue
-            except Exception as e:
-                self.log('error', 'reducer.mainloop', f'exception during action receive, will try again: {e}')
-                await self.emit_sync()
-                await asyncio.sleep(self.SYNC_INTERVAL_S)
-                continue
+                if not await self.action_socket.poll(timeout_ms):
+                    break
+                action = await glitter.Action.listen(self.action_socket)
+            except Exception as e: # still process and reply to the actions collected so far
+                self.log('error', 'reducer.receive_batch', f'exception during action receive, closing the batch: {e}')
+                break
 
             if action is None:
                 continue
 
+            key = self._batch_conflict_key(action.req)
+            if key is not None:
+                if key in conflict_keys:
+                    self._deferred_action = action # will be the first action of next batch
+                    break
+                conflict_keys.add(key)
+
+            batch.append(action)
+
+        return batch
+
+    async def _process_batch(self, batch: List[glitter.Action]) -> None:
+        write_actions = [action for action in batch if type(action.req) in write_action_listeners]
+        write_results: Dict[glitter.Action, WriteResult] = {}
+
+        # requests are checked against the game state here on the loop, only the db work is sent to the executor
+        prepared: List[Tuple[glitter.Action, WriteFn]] = []
+        for action in write_actions:
+            p = self.prepare_write_action(action)
+            if isinstance(p, str):
+                write_results[action] = p
+            else:
+                prepared.append((action, p))
+
+        if prepared:
+            if len(prepared)>1:
+                self.log('debug', 'reducer.mainloop', f'group commit {len(prepared)} write actions')
+
+            try:
+                staged = await self.run_sql(self.stage_write_actions, [write_fn for _action, write_fn in prepared])
+                for (action, _write_fn), res in zip(prepared, staged):
+                    write_results[action] = res
+            except Exception as e:
+                self.log('critical', 'reducer.mainloop', f'exception during group commit, will report as internal error: {utils.get_traceback(e)}')
+                for action, _write_fn in prepared:
+                    write_results[action] = '内部错误，已记录日志'
+
+        for action in batch:
             if isinstance(action.req, glitter.WorkerHelloReq):
                 self.log('debug', 'reducer.mainloop', f'got worker hello from {action.req.client}')
             elif isinstance(action.req, glitter.WorkerHeartbeatReq):
@@ -379,8 +649,8 @@ class Reducer(StateContainerBase):
             old_counter = self.state_counter
 
             try:
-                if action is None:
-                    err: Optional[str] = 'malformed glitter packet'
+                if action in write_results:
+                    err = await self.apply_write_result(write_results[action])
                 else:
                     err = await self.handle_action(action)
 
@@ -395,13 +665,37 @@ class Reducer(StateContainerBase):
             assert self.state_counter-old_counter in [0, 1], f'action handler incremented state counter {self.state_counter-old_counter} times'
 
             try:
-                if action is not None:
-                    with utils.log_slow(self.log, 'reducer.mainloop', f'reply to action {action.req.type}'):
-                        await action.reply(glitter.ActionRep(error_msg=err, state_counter=self.state_counter),self.action_socket)
+                with utils.log_slow(self.log, 'reducer.mainloop', f'reply to action {action.req.type}'):
+                    await action.reply(self.make_reply(action, err), self.action_socket)
 
                 if not isinstance(action.req, glitter.WorkerHeartbeatReq):
                     await self.emit_sync()
             except Exception as e:
                 self.log('critical', 'reducer.mainloop', f'exception during action reply, will recover: {e}')
                 self.state_counter = 1 # then workers will re-sync themselves
-                continue
\ No newline at end of file
+                self._state_snapshot = None
+                self.recent_events.clear()
+                continue
+
+    async def _mainloop(self) -> None:
+        self.log('success', 'reducer.mainloop', 'started to receive actions')
+        self.tick_updater_task = asyncio.create_task(self._tick_updater_daemon())
+        self.health_check_task = asyncio.create_task(self._health_check_daemon())
+        self.checkpoint_task = asyncio.create_task(self._checkpoint_daemon())
+        self.flag_table_task = asyncio.create_task(self._flag_table_daemon())
+        self._flag_tables_outdated.set()
+
+        while True:
+            try:
+                batch = await self._receive_batch()
+            except zmq.error.Again: # timeout, means no action in this interval
+                await self.emit_sync()
+                continue
+            except Exception as e:
+                self.log('error', 'reducer.mainloop', f'exception during action receive, will try again: {e}')
+                await self.emit_sync()
+                await asyncio.sleep(self.SYNC_INTERVAL_S)
+                continue
+
+            if batch:
+                await self._process_batch(batch)
@@ -3,7 +3,7 @@ import zmq
 from zmq.asyncio import Socket
 import asyncio
 import time
-from typing import Optional
+from typing import Optional, Tuple
 
 from .base import StateContainerBase
 from . import glitter
@@ -16,24 +16,28 @@ class Worker(StateContainerBase):
     HEARTBEAT_THROTTLE_S = 9
     HEARTBEAT_TIMEOUT_S = 7
 
-    def __init__(self, process_name: str, receiving_messages: bool = False):
-        super().__init__(process_name, receiving_messages=receiving_messages)
+    def __init__(self, process_name: str, receiving_messages: bool = False, prewarm_views: bool = True):
+        super().__init__(process_name, receiving_messages=receiving_messages, prewarm_views=prewarm_views)
 
-        self.action_socket: Socket = self.glitter_ctx.socket(zmq.REQ)
+        self.action_socket: Socket = self.glitter_ctx.socket(zmq.DEALER)
         self.event_socket: Socket = self.glitter_ctx.socket(zmq.SUB)
 
-        self.action_socket.setsockopt(zmq.RCVTIMEO, glitter.CALL_TIMEOUT_MS)
+        # recv timeout is handled per request by action_client
         self.action_socket.setsockopt(zmq.SNDTIMEO, glitter.CALL_TIMEOUT_MS)
-        self.action_socket.setsockopt(zmq.REQ_RELAXED, 1)
         self.event_socket.setsockopt(zmq.RCVTIMEO, glitter.SYNC_TIMEOUT_MS)
 
         self.action_socket.connect(secret.GLITTER_ACTION_SOCKET_ADDR)
         self.event_socket.connect(secret.GLITTER_EVENT_SOCKET_ADDR)
         self.event_socket.setsockopt(zmq.SUBSCRIBE, b'')
 
+        self.action_client: glitter.ActionClient = glitter.ActionClient(self.action_socket)
+
         self.state_counter = -1
         self.state_counter_cond: asyncio.Condition = asyncio.Condition()
 
+        # (lo, hi) of events that are received after the sync frame but already included in the state snapshot
+        self.stale_event_counters: Optional[Tuple[int, int]] = None
+
         self.last_heartbeat_time: float = 0
         self._heartbeat_task: Optional[asyncio.Task[None]] = None
 
@@ -43,9 +47,9 @@ class Worker(StateContainerBase):
 
         while True:
             try:
-                hello_res = await glitter.Action(
+                hello_res = await self.action_client.call(
                     glitter.WorkerHelloReq(client=self.process_name, protocol_ver=glitter.PROTOCOL_VER)
-                ).call(self.action_socket)
+                )
             except Exception as e:
                 self.log('error', 'reducer.before_run',
                     f'exception during handshake, will try again: {utils.get_traceback(e)}')
@@ -68,8 +72,10 @@ class Worker(StateContainerBase):
                         break
 
                 self.log('info', 'worker.sync_with_reducer', f'got sync data, tick={event.data}, count={event.state_counter}')
-                self.state_counter = event.state_counter
-                await self.init_game(event.data)
+                if not await self._init_game_from_snapshot(event.state_counter):
+                    self.stale_event_counters = None
+                    await self.init_game(event.data)
+                    self.state_counter = event.state_counter
 
                 async with self.state_counter_cond:
                     self.state_counter_cond.notify_all()
@@ -85,6 +91,54 @@ class Worker(StateContainerBase):
             await asyncio.sleep(self.RECOVER_THROTTLE_S)
         self.game_dirty = False
 
+    async def _init_game_from_snapshot(self, sync_counter: int) -> bool:
+        # bootstrap from the in-memory state of the reducer, so that workers do not load everything from db at once
+        try:
+            with utils.log_slow(self.log, 'worker.init_game_from_snapshot', 'fetch state snapshot'):
+                rep = await self.action_client.call(glitter.FetchStateSnapshotReq(client=self.process_name))
+            if not isinstance(rep, glitter.StateSnapshotRep):
+                raise RuntimeError(f'failed to fetch state snapshot: {rep.error_msg}')
+
+            counter, tick, stores = self.parse_state_snapshot(rep.snapshot)
+        except Exception as e:
+            self.log('warning', 'worker.init_game_from_snapshot', f'cannot use state snapshot, will load from db: {utils.get_traceback(e)}')
+            return False
+
+        if counter<sync_counter:
+            self.log('warning', 'worker.init_game_from_snapshot', f'state snapshot older than sync data, maybe reducer restarted, will load from db: snapshot {counter} sync {sync_counter}')
+            return False
+
+        self.log('info', 'worker.init_game_from_snapshot', f'got state snapshot ({len(rep.snapshot)} bytes), tick={tick}, count={counter}')
+        self.stale_event_counters = (sync_counter, counter)
+        await self.init_game(tick, stores)
+        self.state_counter = counter
+        return True
+
+    async def _replay_events(self, first_counter: int, last_counter: int) -> bool:
+        try:
+            with utils.log_slow(self.log, 'worker.replay_events', f'fetch events {first_counter}~{last_counter}'):
+                rep = await self.action_client.call(glitter.FetchEventsReq(
+                    client=self.process_name, first_counter=first_counter, last_counter=last_counter,
+                ))
+            if not isinstance(rep, glitter.EventsRep):
+                raise RuntimeError(f'failed to fetch events: {rep.error_msg}')
+
+            events = [glitter.Event.from_frames(frames) for frames in rep.events]
+            assert [ev.state_counter for ev in events]==list(range(first_counter, last_counter+1)), 'replayed events are not consecutive'
+        except Exception as e:
+            self.log('error', 'worker.replay_events', f'cannot replay events, will do full sync: {utils.get_traceback(e)}')
+            return False
+
+        self.log('info', 'worker.replay_events', f'replaying {len(events)} events: {first_counter}~{last_counter}')
+        for event in events:
+            await self.process_event(event)
+            self.state_counter = event.state_counter # after the event is applied, see `perform_action`
+
+        async with self.state_counter_cond:
+            self.state_counter_cond.notify_all()
+
+        return True
+
     async def _before_run(self) -> None:
         await super()._before_run()
 
@@ -108,16 +162,29 @@ class Worker(StateContainerBase):
                 await self._sync_with_reducer()
                 continue
 
+            if self.stale_event_counters is not None:
+                lo, hi = self.stale_event_counters
+                if lo<=event.state_counter<=hi:
+                    continue
+                self.stale_event_counters = None
+
             # in rare cases when zeromq reaches high-water-mark, we may lose packets!
-            if event.state_counter not in [self.state_counter, self.state_counter+1]:
-                if event.state_counter<self.state_counter:
-                    self.log('warning', 'worker.mainloop', f'state counter mismatch, maybe reducer restarted, will recover: worker {self.state_counter} reducer {event.state_counter}')
-                else:
-                    self.log('error', 'worker.mainloop', f'state counter mismatch, maybe lost event, will recover: worker {self.state_counter} reducer {event.state_counter}')
+            # sync frames carry no change, so the event with the same counter is also missed.
+            last_missed = event.state_counter if event.type==glitter.EventType.SYNC else event.state_counter-1
+            if last_missed>self.state_counter:
+                self.log('warning', 'worker.mainloop', f'state counter gap, maybe lost event, will replay: worker {self.state_counter} reducer {event.state_counter}')
+                if not await self._replay_events(self.state_counter+1, last_missed):
+                    await self._sync_with_reducer()
+                    continue
+
+            if event.state_counter<self.state_counter:
+                self.log('warning', 'worker.mainloop', f'state counter mismatch, maybe reducer restarted, will recover: worker {self.state_counter} reducer {event.state_counter}')
                 await self._sync_with_reducer()
             else:
-                self.state_counter = event.state_counter
+                # listeners may wait for db, so the counter is only bumped after the event is applied.
+                # otherwise `perform_action` may return before its effect is visible.
                 await self.process_event(event)
+                self.state_counter = event.state_counter
                 async with self.state_counter_cond:
                     self.state_counter_cond.notify_all()
 
@@ -130,7 +197,7 @@ class Worker(StateContainerBase):
             self.log('info', 'worker.perform_action', f'call {req.type}')
 
         with utils.log_slow(self.log, 'worker.perform_action', f'perform action {req.type}'):
-            rep = await glitter.Action(req).call(self.action_socket)
+            rep = await self.action_client.call(req)
 
         if req.type!='WorkerHeartbeatReq':
             self.log('debug', 'worker.perform_action', f'called {req.type}, state counter is {rep.state_counter}')
@@ -29,11 +29,10 @@ async def check_submission(sub: Submission, worker: Worker) -> None:
         if f.type=='static': # cannot check static flag
             continue
 
-        for u in worker.game.users.list:
-            if f.validate_flag(u, sub._store.flag):
-                origin_users.append(u)
-                if f in u.passed_flags.keys():
-                    accepted_origin_users[u] = u.passed_flags[f]
+        for u in await f.users_with_correct_flag(sub._store.flag):
+            origin_users.append(u)
+            if f in u.passed_flags.keys():
+                accepted_origin_users[u] = u.passed_flags[f]
 
     if not origin_users: # genuine wrong submission
         worker.log('debug', 'police.check_submission', f'S#{sub._store.id} seems fine')
@@ -75,7 +74,7 @@ async def check_submission(sub: Submission, worker: Worker) -> None:
     await worker.push_message(f'[POLICE] {msg_text}', f'police:{submitter._store.id}')
 
 async def run_forever() -> None:
-    worker = Worker('police', receiving_messages=True)
+    worker = Worker('police', receiving_messages=True, prewarm_views=False) # views are never served here
     await worker._before_run()
 
     async def task() -> None:
@@ -84,26 +83,29 @@ async def run_forever() -> None:
 
     asyncio.create_task(task())
 
-    message_id = worker.next_message_id
-    while True:
-        async with worker.message_cond:
-            await worker.message_cond.wait_for(lambda: message_id<worker.next_message_id)
-
-            while message_id<worker.next_message_id:
-                msg = worker.local_messages.get(message_id, None)
-                message_id += 1
-
-                if msg is None:
-                    worker.log('error', 'police.police_process', f'lost local message {message_id}, maybe we stucked for a long time?')
-                else:
-                    if msg.get('type', None)=='new_submission':
-                        sub: Submission = msg['submission']
-                        with utils.log_slow(worker.log, 'police.police_process', f'check submission {sub._store.id}', 1):
-                            await check_submission(sub, worker)
-                    elif msg.get('type', None)=='push':
-                        if msg.get('touids', None) is None:
-                            payload = msg['payload']
-                            await worker.push_message(f'[PUSH] {json.dumps(payload, indent=1, ensure_ascii=False)}', None)
+    try:
+        message_id = worker.next_message_id
+        while True:
+            async with worker.message_cond:
+                await worker.message_cond.wait_for(lambda: message_id<worker.next_message_id)
+
+                while message_id<worker.next_message_id:
+                    msg = worker.local_messages.get(message_id, None)
+                    message_id += 1
+
+                    if msg is None:
+                        worker.log('error', 'police.police_process', f'lost local message {message_id}, maybe we stucked for a long time?')
+                    else:
+                        if msg.get('type', None)=='new_submission':
+                            sub: Submission = msg['submission']
+                            with utils.log_slow(worker.log, 'police.police_process', f'check submission {sub._store.id}', 1):
+                                await check_submission(sub, worker)
+                        elif msg.get('type', None)=='push':
+                            if msg.get('touids', None) is None:
+                                payload = msg['payload']
+                                await worker.push_message(f'[PUSH] {json.dumps(payload, indent=1, ensure_ascii=False)}', None)
+    finally:
+        worker.flush_logs()
 
 def police_process() -> None:
     asyncio.run(run_forever())
\ No newline at end of file
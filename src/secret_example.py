@@ -73,12 +73,18 @@ WRITEUP_PATH = pathlib.Path('/path/to/writeups').resolve()
 ATTACHMENT_PATH = pathlib.Path('/path/to/attachments').resolve()
 MEDIA_PATH = pathlib.Path('/path/to/media').resolve()
 SYBIL_LOG_PATH = pathlib.Path('/path/to/anticheat_log').resolve()
+DERIVED_STATE_CHECKPOINT_PATH: Optional[pathlib.Path] = pathlib.Path('/path/to/checkpoint.bin').resolve() # None to disable
+CORRECT_FLAG_TABLE_PATH: Optional[pathlib.Path] = pathlib.Path('/path/to/flag_tables').resolve() # None to disable
 
 #### INTERNAL PORTS
 
 GLITTER_ACTION_SOCKET_ADDR = 'ipc:///path/to/action.sock'
 GLITTER_EVENT_SOCKET_ADDR = 'ipc:///path/to/event.sock'
 
+# the reducer persists all write actions that arrive within this window in one transaction (group commit)
+GLITTER_GROUP_COMMIT_MAX_BATCH = 64 # set to 1 to commit each action separately
+GLITTER_GROUP_COMMIT_MAX_WAIT_MS = 3
+
 N_WORKERS = 4
 
 def WORKER_API_SERVER_ADDR(idx0: int) -> Tuple[str, int]:
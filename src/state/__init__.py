@@ -2,6 +2,8 @@ from __future__ import annotations
 from abc import ABC
 
 class WithGameLifecycle(ABC):
+    __slots__ = () # so that slotted subclasses have no __dict__
+
     def on_tick_change(self) -> None:
         pass
 
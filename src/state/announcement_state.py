@@ -1,9 +1,9 @@
 from __future__ import annotations
-from functools import lru_cache
-from typing import TYPE_CHECKING, List, Optional, Dict, Any
+from typing import TYPE_CHECKING, List, Optional, Dict, Any, Tuple
 
 from .. import utils
 from . import User
+from .cached_view import CachedView, CacheDeps
 
 class Announcements:
     def __init__(self, game: Game, stores: List[AnnouncementStore]):
@@ -11,6 +11,9 @@ class Announcements:
 
         self.list: List[Announcement] = []
 
+        # (announcement id, tick, group) -> rendered content, shared by all announcements
+        self.content_cache: CachedView[Tuple[int, int, Optional[str]], str] = CachedView(game, 'announcement_content')
+
         self.on_store_reload(stores)
 
     def _sort_list(self) -> None:
@@ -19,6 +22,7 @@ class Announcements:
     def on_store_reload(self, stores: List[AnnouncementStore]) -> None:
         self.list = [Announcement(self._game, x) for x in stores]
         self._sort_list()
+        self.content_cache.clear()
 
     def on_store_update(self, id: int, new_store: Optional[AnnouncementStore]) -> None:
         other_anns = [x for x in self.list if x._store.id!=id]
@@ -37,8 +41,11 @@ class Announcements:
             self.list = other_anns+[Announcement(self._game, new_store)]
 
         self._sort_list()
+        self.content_cache.clear() # announcements are rarely updated
 
 class Announcement:
+    __slots__ = ('_game', '_store', 'title', 'timestamp_s')
+
     def __init__(self, game: Game, store: AnnouncementStore):
         self._game: Game = game
         self._store: AnnouncementStore = store
@@ -49,7 +56,6 @@ class Announcement:
     def __repr__(self) -> str:
         return repr(self._store)
 
-    @lru_cache(16)
     def _render_template(self, tick: int, group: Optional[str]) -> str:
         try:
             return utils.render_template(self._store.content_template, {'group': group, 'tick': tick})
@@ -62,9 +68,18 @@ class Announcement:
             'id': self._store.id,
             'title': self.title,
             'timestamp_s': self.timestamp_s,
-            'content': self._render_template(self._game.cur_tick, None if user is None else user._store.group),
+            'content': self.render_content(None if user is None else user._store.group),
         }
 
+    def render_content(self, group: Optional[str], tick: Optional[int] = None) -> str: # tick: the next tick if prewarming
+        at_tick = self._game.cur_tick if tick is None else tick
+
+        def render(deps: CacheDeps) -> str:
+            deps.tick = True # so contents of previous ticks are dropped
+            return self._render_template(at_tick, group)
+
+        return self._game.announcements.content_cache.get((self._store.id, at_tick, group), render, staged=at_tick!=self._game.cur_tick)
+
 if TYPE_CHECKING:
     from . import Game
     from ..store import *
\ No newline at end of file
@@ -1,11 +1,13 @@
 from __future__ import annotations
 from abc import ABC, abstractmethod
-from typing import TYPE_CHECKING, Optional, List, Tuple, Dict, Any
+from typing import TYPE_CHECKING, Optional, List, Tuple, Dict, Any, Iterable
 
 if TYPE_CHECKING:
     from . import *
     ScoreBoardItemType = Tuple[User, int]
 from . import WithGameLifecycle
+from .rank_index import RankView
+from .cached_view import CachedView, CacheDeps
 from ..store import UserStore
 from .. import utils
 
@@ -15,102 +17,136 @@ class Board(WithGameLifecycle, ABC):
         self.name = name
         self.desc = desc
         self._game = game
-        self._rendered_admin: Optional[Dict[str, Any]] = None
-        self._rendered_normal: Optional[Dict[str, Any]] = None
 
-    def get_rendered(self, is_admin: bool) -> Dict[str, Any]:
-        if is_admin:
-            if self._rendered_admin is None:
-                with utils.log_slow(self._game.worker.log, 'board.render', f'render {self.board_type} board (admin) {self.name}'):
-                    self._rendered_admin = self._render(is_admin=True)
+        # is_admin -> rendered board, invalidated by `Game.invalidate_views` according to the deps declared in `_render`
+        self._rendered: CachedView[bool, Dict[str, Any]] = CachedView(game, f'{board_type}:{name}')
 
-            return self._rendered_admin
-        else:
-            if self._rendered_normal is None:
-                with utils.log_slow(self._game.worker.log, 'board.render', f'render {self.board_type} board {self.name}'):
-                    self._rendered_normal = self._render(is_admin=False)
+    def get_rendered(self, is_admin: bool, tick: Optional[int] = None) -> Dict[str, Any]: # tick: the next tick if prewarming
+        at_tick = self._game.cur_tick if tick is None else tick
 
-            return self._rendered_normal
+        def render(deps: CacheDeps) -> Dict[str, Any]:
+            with utils.log_slow(self._game.worker.log, 'board.render', f'render {self.board_type} board{" (admin)" if is_admin else ""} {self.name}'):
+                return self._render(is_admin, at_tick, deps)
+
+        return self._rendered.get(is_admin, render, staged=at_tick!=self._game.cur_tick)
 
     def clear_render_cache(self) -> None:
-        self._rendered_admin = None
-        self._rendered_normal = None
+        self._rendered.clear()
 
     @abstractmethod
-    def _render(self, is_admin: bool) -> Dict[str, Any]:
+    def _render(self, is_admin: bool, tick: int, deps: CacheDeps) -> Dict[str, Any]:
         raise NotImplementedError()
 
-    def on_tick_change(self) -> None:
+    def on_scores_changed(self, users: Iterable[User]) -> None: # scores of these users changed, e.g., by a new submission or a score override
         self.clear_render_cache()
 
 class ScoreBoard(Board):
     MAX_TOPSTAR_USERS = 10
 
-    def __init__(self, name: str, desc: Optional[str], game: Game, group: Optional[List[str]], show_group: bool, max_display_users: int):
+    def __init__(self, name: str, desc: Optional[str], game: Game, group: Optional[List[str]], show_group: bool, max_display_users: int, topstar_history_buckets: Optional[int] = None):
         super().__init__('score', name, desc, game)
 
         self.max_display_users = max_display_users
         self.show_group: bool = show_group
         self.group: Optional[List[str]] = group
-        self.board: List[ScoreBoardItemType] = []
-        self.uid_to_rank: Dict[int, int] = {}
-
-    def _user_is_valid(self, u: User) -> bool:
-        g = self.group
-        if g is None:
-            return True
-        else:
-            return u._store.group in g
-
-    def _update_board(self) -> None:
-        def sorter(x: ScoreBoardItemType) -> Tuple[Any, ...]:
-            user, score = x
-            return (
-                -score,
-                -1 if user.last_succ_submission is None else user.last_succ_submission._store.id,
-            )
-
-        b = [(u, u.tot_score) for u in self._game.users.list if self._user_is_valid(u) and u.tot_score>0]
-        self.board = sorted(b, key=sorter)
-        self.uid_to_rank = {user._store.id: idx+1 for idx, (user, _score) in enumerate(self.board)}
-
-    def _render(self, is_admin: bool) -> Dict[str, Any]:
+        self.topstar_history_buckets: Optional[int] = topstar_history_buckets # resolution of topstar histories, None for full
+
+        # a view of the shared ranking of all users, see `Users.ranking`
+        self.ranking: RankView[ScoreBoardItemType] = game.users.ranking(None).view(group)
+
+        # (uid, is_admin) -> rendered row in `list`
+        self._rendered_rows: CachedView[Tuple[int, bool], Dict[str, Any]] = CachedView(game, f'score_rows:{name}')
+        # uid -> (downsampled) score history in `topstars`
+        self._rendered_histories: CachedView[int, List[Tuple[int, int]]] = CachedView(game, f'score_histories:{name}')
+
+    @property
+    def board(self) -> List[ScoreBoardItemType]: # the whole board, use `self.ranking.top` if only the top is needed
+        return list(self.ranking.iter_values())
+
+    @property
+    def uid_to_rank(self) -> RankView[ScoreBoardItemType]:
+        return self.ranking
+
+    def _effective_challenges(self, tick: int) -> List[Challenge]:
+        return [ch for ch in self._game.challenges.list if ch.is_effective_at(tick)]
+
+    def _last_succ_submission(self, u: User) -> Optional[Submission]:
+        return u.last_succ_submission
+
+    def _is_flag_shown(self, f: Flag) -> bool:
+        return True
+
+    def _render_row(self, u: User, score: int, is_admin: bool, tick: int) -> Dict[str, Any]: # rank is filled in later, so the row is cached across rank changes
+        last = self._last_succ_submission(u)
+        return {
+            'uid': u._store.id,
+            'rank': None,
+            'nickname': u._store.profile.nickname_or_null or '--',
+            'group_disp': u._store.group_disp() if self.show_group else None,
+            'badges': u._store.badges() + (u.admin_badges() if is_admin else []),
+            'score': score,
+            'last_succ_submission_ts': int(last._store.timestamp_ms/1000) if last else None,
+            'challenge_status': {
+                ch._store.key: status
+                for ch in self._effective_challenges(tick)
+                if (status := ch.user_status(u)) != 'untouched'
+            },
+            'flag_status': {
+                f'{f.challenge._store.key}_{f.idx0}': [
+                    int(sub._store.timestamp_ms/1000), # timestamp_s
+                    sub.gained_score(), # gained_score
+                ] for f, sub in u.passed_flags.items() if self._is_flag_shown(f)
+            },
+        }
+
+    def _get_rendered_row(self, u: User, score: int, is_admin: bool, tick: int) -> Dict[str, Any]:
+        def render(deps: CacheDeps) -> Dict[str, Any]:
+            deps.uids.add(u._store.id)
+            deps.tick = True # effective challenges
+            return self._render_row(u, score, is_admin, tick)
+
+        return self._rendered_rows.get((u._store.id, is_admin), render, staged=tick!=self._game.cur_tick)
+
+    def _get_rendered_history(self, u: User) -> List[Tuple[int, int]]:
+        def render(deps: CacheDeps) -> List[Tuple[int, int]]:
+            deps.uids.add(u._store.id)
+            return u.score_history_diff_downsampled(self.topstar_history_buckets)
+
+        return self._rendered_histories.get(u._store.id, render)
+
+    def _render_topstars(self) -> List[Dict[str, Any]]:
+        return [{
+            'uid': u._store.id,
+            'nickname': u._store.profile.nickname_or_null or '--',
+            'history': self._get_rendered_history(u),
+        } for u, _score in self.ranking.top(self.MAX_TOPSTAR_USERS)]
+
+    def _render(self, is_admin: bool, tick: int, deps: CacheDeps) -> Dict[str, Any]:
         self._game.worker.log('debug', 'board.render', f'rendering score board {self.name}')
 
+        challenges = self._effective_challenges(tick)
+        top_users = self.ranking.top(self.max_display_users)
+        topstars = self._render_topstars()
+
+        deps.tick = True
+        deps.challenge_keys.update(ch._store.key for ch in challenges)
+        deps.uids.update(u._store.id for u, _score in top_users)
+        deps.uids.update(u['uid'] for u in topstars)
+
         return {
             'challenges': [{
                 'key': ch._store.key,
                 'title': ch._store.title,
                 'category': ch._store.category,
                 'flags': [f.name for f in ch.flags],
-            } for ch in self._game.challenges.list if ch.cur_effective],
+            } for ch in challenges],
 
-            'list': [{
-                'uid': u._store.id,
-                'rank': idx+1,
-                'nickname': u._store.profile.nickname_or_null or '--',
-                'group_disp': u._store.group_disp() if self.show_group else None,
-                'badges': u._store.badges() + (u.admin_badges() if is_admin else []),
-                'score': score,
-                'last_succ_submission_ts': int(u.last_succ_submission._store.timestamp_ms/1000) if u.last_succ_submission else None,
-                'challenge_status': {
-                    ch._store.key: status
-                    for ch in self._game.challenges.list if ch.cur_effective
-                    if (status := ch.user_status(u)) != 'untouched'
-                },
-                'flag_status': {
-                    f'{f.challenge._store.key}_{f.idx0}': [
-                        int(sub._store.timestamp_ms/1000), # timestamp_s
-                        sub.gained_score(), # gained_score
-                    ] for f, sub in u.passed_flags.items()
-                },
-            } for idx, (u, score) in enumerate(self.board[:self.max_display_users])],
-
-            'topstars': [{
-                'uid': u._store.id,
-                'nickname': u._store.profile.nickname_or_null or '--',
-                'history': u.score_history_diff,
-            } for u, _score in self.board[:self.MAX_TOPSTAR_USERS]],
+            'list': [
+                {**self._get_rendered_row(u, score, is_admin, tick), 'rank': idx+1}
+                for idx, (u, score) in enumerate(top_users)
+            ],
+
+            'topstars': topstars,
 
             'time_range': [
                 self._game.trigger.board_begin_ts,
@@ -118,17 +154,34 @@ class ScoreBoard(Board):
             ],
         }
 
+    def clear_render_cache(self) -> None:
+        super().clear_render_cache()
+        self._rendered_rows.clear()
+        self._rendered_histories.clear()
+
+    def on_scores_changed(self, users: Iterable[User]) -> None:
+        changed_in_board = False
+        for u in users:
+            self._rendered_rows.invalidate((u._store.id, False))
+            self._rendered_rows.invalidate((u._store.id, True))
+            self._rendered_histories.invalidate(u._store.id)
+            if self.group is None or u._store.group in self.group:
+                changed_in_board = True
+
+        if changed_in_board: # ranking may change, so the whole list is affected, but rows of other users are kept
+            super().clear_render_cache()
+
+    # the ranking itself is updated by `Users`
+
     def on_scoreboard_reset(self) -> None:
-        self.board = []
         self.clear_render_cache()
 
     def on_scoreboard_update(self, submission: Submission, in_batch: bool) -> None:
         if not in_batch and submission.matched_flag is not None:
-            self._update_board()
-            self.clear_render_cache()
+            # the submitter and other passed users of this flag (whose score may decay)
+            self.on_scores_changed(submission.matched_flag.passed_users)
 
     def on_scoreboard_batch_update_done(self) -> None:
-        self._update_board()
         self.clear_render_cache()
 
 class CategoryScoreBoard(ScoreBoard):
@@ -136,73 +189,19 @@ class CategoryScoreBoard(ScoreBoard):
         super().__init__(name, desc, game, group, show_group, max_display_users)
 
         self.challenge_category = challenge_category
-        self.last_succ_submission_in_cats: Dict[int, Optional[Submission]] = {}
+        self.ranking = game.users.ranking(challenge_category).view(group)
 
-    def on_scoreboard_update(self, submission: Submission, in_batch: bool) -> None:
-        if submission.matched_flag is not None:
-            assert submission.challenge is not None, 'submission matched flag to no challenge'
-
-            if (
-                submission.challenge._store.category==self.challenge_category # challenge category is good
-                and self._user_is_valid(submission.user) # user group is good
-            ):
-                self.last_succ_submission_in_cats[submission.user._store.id] = submission
-
-        super().on_scoreboard_update(submission, in_batch)
+    def _effective_challenges(self, tick: int) -> List[Challenge]:
+        return [ch for ch in self._game.challenges.list if ch.is_effective_at(tick) and ch._store.category==self.challenge_category]
 
-    def _update_board(self) -> None:
-        def sorter(x: ScoreBoardItemType) -> Tuple[Any, ...]:
-            user, score = x
-            last = self.last_succ_submission_in_cats.get(user._store.id, None)
-            return (
-                -score,
-                -1 if last is None else last._store.id,
-            )
+    def _last_succ_submission(self, u: User) -> Optional[Submission]:
+        return u.last_succ_submission_by_cat.get(self.challenge_category, None)
 
-        # noinspection PyUnboundLocalVariable
-        b = [(u, s) for u in self._game.users.list if self._user_is_valid(u) and (s := u.tot_score_by_cat.get(self.challenge_category, 0)) > 0]
-        self.board = sorted(b, key=sorter)
-        self.uid_to_rank = {user._store.id: idx+1 for idx, (user, _score) in enumerate(self.board)}
-
-    def _render(self, is_admin: bool) -> Dict[str, Any]:
-        self._game.worker.log('debug', 'board.render', f'rendering category score board {self.name}')
-
-        return {
-            'challenges': [{
-                'key': ch._store.key,
-                'title': ch._store.title,
-                'category': ch._store.category,
-                'flags': [f.name for f in ch.flags],
-            } for ch in self._game.challenges.list if ch.cur_effective and ch._store.category==self.challenge_category],
+    def _is_flag_shown(self, f: Flag) -> bool:
+        return f.challenge._store.category==self.challenge_category
 
-            'list': [{
-                'uid': u._store.id,
-                'rank': idx+1,
-                'nickname': u._store.profile.nickname_or_null or '--',
-                'group_disp': u._store.group_disp() if self.show_group else None,
-                'badges': u._store.badges() + (u.admin_badges() if is_admin else []),
-                'score': score,
-                'last_succ_submission_ts': int(last._store.timestamp_ms/1000) if (last := self.last_succ_submission_in_cats.get(u._store.id, None)) else None,
-                'challenge_status': {
-                    ch._store.key: status
-                    for ch in self._game.challenges.list if ch.cur_effective and ch._store.category==self.challenge_category
-                    if (status := ch.user_status(u)) != 'untouched'
-                },
-                'flag_status': {
-                    f'{f.challenge._store.key}_{f.idx0}': [
-                        int(sub._store.timestamp_ms/1000), # timestamp_s
-                        sub.gained_score(), # gained_score
-                    ] for f, sub in u.passed_flags.items() if f.challenge._store.category==self.challenge_category
-                },
-            } for idx, (u, score) in enumerate(self.board[:self.max_display_users])],
-
-            'topstars': [],
-
-            'time_range': [
-                self._game.trigger.board_begin_ts,
-                self._game.trigger.board_end_ts,
-            ],
-        }
+    def _render_topstars(self) -> List[Dict[str, Any]]:
+        return []
 
 class FirstBloodBoard(Board):
     def __init__(self, name: str, desc: Optional[str], game: Game, group: Optional[List[str]], show_group: bool):
@@ -213,16 +212,23 @@ class FirstBloodBoard(Board):
         self.chall_board: Dict[Challenge, Submission] = {}
         self.flag_board: Dict[Flag, Submission] = {}
 
-    def _render(self, is_admin: bool) -> Dict[str, Any]:
+    def _render(self, is_admin: bool, tick: int, deps: CacheDeps) -> Dict[str, Any]:
         self._game.worker.log('debug', 'board.render', f'rendering first blood board {self.name}')
 
+        challenges = [ch for ch in self._game.challenges.list if ch.is_effective_at(tick)]
+
+        deps.tick = True # effective challenges and metadata
+        deps.challenge_keys.update(ch._store.key for ch in challenges)
+        deps.uids.update(sub.user._store.id for sub in self.chall_board.values())
+        deps.uids.update(sub.user._store.id for sub in self.flag_board.values())
+
         return {
             'list': [{
                 'key': ch._store.key,
                 'title': ch._store.title,
                 'category': ch._store.category,
                 'category_color': ch._store.category_color(),
-                'metadata': ch.describe_metadata(self),
+                'metadata': ch.describe_metadata(self, tick),
 
                 'flags': [{
                     'flag_name': None,
@@ -240,7 +246,7 @@ class FirstBloodBoard(Board):
                     'timestamp': int(f_sub._store.timestamp_ms/1000) if f_sub is not None else None,
                 } for f in ch.flags for f_sub in [self.flag_board.get(f, None)]]),
 
-            } for ch in self._game.challenges.list if ch.cur_effective for ch_sub in [self.chall_board.get(ch, None)]],
+            } for ch in challenges for ch_sub in [self.chall_board.get(ch, None)]],
         }
 
     def on_scoreboard_reset(self) -> None:
@@ -248,6 +254,12 @@ class FirstBloodBoard(Board):
         self.flag_board = {}
         self.clear_render_cache()
 
+    def on_scores_changed(self, users: Iterable[User]) -> None:
+        pass # scores are not shown
+
+    def on_scoreboard_batch_update_done(self) -> None:
+        self.clear_render_cache()
+
     def on_scoreboard_update(self, submission: Submission, in_batch: bool) -> None:
         if submission.matched_flag is not None:
             assert submission.challenge is not None, 'submission matched flag to no challenge'
@@ -259,6 +271,7 @@ class FirstBloodBoard(Board):
 
                 if submission.matched_flag not in self.flag_board:
                     self.flag_board[submission.matched_flag] = submission
+                    self.clear_render_cache()
 
                     if not should_skip_push and not passed_all_flags:
                         self._game.worker.emit_local_message({
@@ -275,6 +288,7 @@ class FirstBloodBoard(Board):
 
                 if passed_all_flags and submission.challenge not in self.chall_board:
                     self.chall_board[submission.challenge] = submission
+                    self.clear_render_cache()
 
                     if not should_skip_push:
                         self._game.worker.emit_local_message({
@@ -286,6 +300,4 @@ class FirstBloodBoard(Board):
                                 'challenge': submission.challenge._store.title,
                             },
                             #'togroups': self.group,
-                        })
-
-                self.clear_render_cache()
\ No newline at end of file
+                        })
\ No newline at end of file
@@ -0,0 +1,149 @@
+from __future__ import annotations
+from dataclasses import dataclass, field
+from typing import TYPE_CHECKING, Generic, TypeVar, Dict, Set, Tuple, List, Callable, Iterable, Hashable
+
+if TYPE_CHECKING:
+    from . import Game
+
+K = TypeVar('K', bound=Hashable)
+V = TypeVar('V')
+Dep = TypeVar('Dep', int, str)
+
+@dataclass
+class CacheDeps:
+    # what a cached value is rendered from, filled in by the render function
+    uids: Set[int] = field(default_factory=set)
+    challenge_keys: Set[str] = field(default_factory=set)
+    tick: bool = False
+    policy: bool = False
+
+class _Entries(Generic[K, V]):
+    # cached values with indexes of their deps
+    def __init__(self) -> None:
+        self.values: Dict[K, Tuple[V, CacheDeps]] = {}
+        self.keys_by_uid: Dict[int, Set[K]] = {}
+        self.keys_by_challenge: Dict[str, Set[K]] = {}
+
+    def put(self, key: K, value: V, deps: CacheDeps) -> None:
+        self.pop(key)
+        self.values[key] = (value, deps)
+        for uid in deps.uids:
+            self.keys_by_uid.setdefault(uid, set()).add(key)
+        for ch_key in deps.challenge_keys:
+            self.keys_by_challenge.setdefault(ch_key, set()).add(key)
+
+    def pop(self, key: K) -> bool: # -> whether it existed
+        entry = self.values.pop(key, None)
+        if entry is None:
+            return False
+
+        _value, deps = entry
+        for uid in deps.uids:
+            _discard(self.keys_by_uid, uid, key)
+        for ch_key in deps.challenge_keys:
+            _discard(self.keys_by_challenge, ch_key, key)
+        return True
+
+    def keys_depending_on(self, uids: List[int], challenge_keys: List[str], tick: bool, policy: bool) -> Set[K]:
+        keys: Set[K] = set()
+        if not self.values:
+            return keys
+
+        for uid in uids:
+            keys.update(self.keys_by_uid.get(uid, ()))
+        for ch_key in challenge_keys:
+            keys.update(self.keys_by_challenge.get(ch_key, ()))
+        if tick or policy:
+            keys.update(k for k, (_v, deps) in self.values.items() if (tick and deps.tick) or (policy and deps.policy))
+        return keys
+
+class CachedView(Generic[K, V]):
+    # cached values that are only dropped when something they depend on is changed (see `Game.invalidate_views`).
+    # values of the next tick can be rendered in advance into a staging area, see `Game.prewarm_tick`.
+
+    def __init__(self, game: Game, name: str):
+        self.name = name
+
+        self._live: _Entries[K, V] = _Entries()
+        self._staged: _Entries[K, V] = _Entries()
+
+        self.n_hit: int = 0
+        self.n_miss: int = 0
+        self.n_invalidated: int = 0
+        self.n_prewarmed: int = 0
+
+        game.cached_views.append(self)
+
+    def __len__(self) -> int:
+        return len(self._live.values)
+
+    def get(self, key: K, render: Callable[[CacheDeps], V], staged: bool = False) -> V: # staged: render for the next tick
+        if staged:
+            entry = self._staged.values.get(key, None)
+            if entry is None:
+                # live values not depending on the tick are also valid in the next tick
+                live_entry = self._live.values.get(key, None)
+                if live_entry is not None and not (live_entry[1].tick or live_entry[1].policy):
+                    return live_entry[0]
+        else:
+            entry = self._live.values.get(key, None)
+
+        if entry is not None:
+            self.n_hit += 1
+            return entry[0]
+
+        if staged:
+            self.n_prewarmed += 1
+        else:
+            self.n_miss += 1
+
+        deps = CacheDeps()
+        value = render(deps)
+        (self._staged if staged else self._live).put(key, value, deps)
+
+        return value
+
+    def invalidate(self, key: K) -> None:
+        if self._live.pop(key):
+            self.n_invalidated += 1
+        self._staged.pop(key)
+
+    def clear(self) -> None:
+        self.n_invalidated += len(self._live.values)
+        self._live = _Entries()
+        self._staged = _Entries()
+
+    def on_change(self, *, uids: Iterable[int] = (), challenge_keys: Iterable[str] = (), tick: bool = False, policy: bool = False) -> None:
+        uids = list(uids)
+        challenge_keys = list(challenge_keys)
+
+        for key in self._live.keys_depending_on(uids, challenge_keys, tick, policy):
+            self._live.pop(key)
+            self.n_invalidated += 1
+        # staged values are rendered for the next tick, so they are kept on tick changes (see `commit_staged`)
+        for key in self._staged.keys_depending_on(uids, challenge_keys, False, policy):
+            self._staged.pop(key)
+
+    def commit_staged(self) -> None: # after the tick is changed to the staged one
+        for key, (value, deps) in self._staged.values.items():
+            self._live.put(key, value, deps)
+        self._staged = _Entries()
+
+    def discard_staged(self) -> None:
+        self._staged = _Entries()
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            'size': len(self._live.values),
+            'hit': self.n_hit,
+            'miss': self.n_miss,
+            'invalidated': self.n_invalidated,
+            'prewarmed': self.n_prewarmed,
+        }
+
+def _discard(index: Dict[Dep, Set[K]], dep: Dep, key: K) -> None:
+    keys = index.get(dep, None)
+    if keys is not None:
+        keys.discard(key)
+        if not keys:
+            del index[dep]
@@ -1,11 +1,11 @@
 from __future__ import annotations
-from functools import lru_cache
-from typing import TYPE_CHECKING, List, Dict, Optional, Set, Union, Literal, Any
+from typing import TYPE_CHECKING, List, Dict, Optional, Set, Tuple, Union, Literal, Any, Iterable
 
 if TYPE_CHECKING:
     from . import Game, Submission, User
     from ..store import *
 from . import WithGameLifecycle, Flag, Board, FirstBloodBoard, Trigger
+from .cached_view import CachedView, CacheDeps
 from ..store import UserStore
 from .. import utils
 
@@ -18,6 +18,14 @@ class Challenges(WithGameLifecycle):
         self.chall_by_id: Dict[int, Challenge] = {}
         self.chall_by_key: Dict[str, Challenge] = {}
 
+        # (challenge key, tick, group) -> rendered description, shared by all challenges
+        self.desc_cache: CachedView[Tuple[str, int, Optional[str]], str] = CachedView(game, 'challenge_desc')
+
+        # challenge key -> touched users sorted by their score in it, see `Challenge.touched_users_sorted`
+        self.touched_users_cache: CachedView[str, List[TouchedUser]] = CachedView(game, 'touched_users')
+        # (challenge key, is_admin) -> serialized response of the touched users list, rendered by the api
+        self.touched_users_resp_cache: CachedView[Tuple[str, bool], bytes] = CachedView(game, 'touched_users_resp')
+
         self.on_store_reload(stores)
 
     def _after_chall_changed(self) -> None:
@@ -25,28 +33,73 @@ class Challenges(WithGameLifecycle):
         self.chall_by_id = {ch._store.id: ch for ch in self.list}
         self.chall_by_key = {ch._store.key: ch for ch in self.list}
 
+    def _index_chall(self, ch: Challenge) -> None:
+        self.chall_by_id[ch._store.id] = ch
+        self.chall_by_key[ch._store.key] = ch
+
+    def _unindex_chall(self, ch: Challenge, store: ChallengeStore) -> None: # store: the one `ch` was indexed with
+        if self.chall_by_id.get(store.id, None) is ch:
+            del self.chall_by_id[store.id]
+        if self.chall_by_key.get(store.key, None) is ch:
+            del self.chall_by_key[store.key]
+
     def on_store_reload(self, stores: List[ChallengeStore]) -> None:
         self._stores = stores
         self.list = [Challenge(self._game, store) for store in stores]
         self._after_chall_changed()
+        self.desc_cache.clear()
         self._game.need_reloading_scoreboard = True
 
     def on_store_update(self, id: int, new_store: Optional[ChallengeStore]) -> None:
-        old_chall: Optional[Challenge] = ([x for x in self.list if x._store.id==id]+[None])[0]
-        other_challs = [x for x in self.list if x._store.id!=id]
+        # indexes are updated in place, and `list` is only re-sorted if the order may change
+        old_chall = self.chall_by_id.get(id, None)
+        old_store = None if old_chall is None else old_chall._store
+        changed_keys = ([] if old_store is None else [old_store.key]) + ([] if new_store is None else [new_store.key])
 
         if new_store is None: # remove
-            self.list = other_challs
+            if old_chall is not None and old_store is not None:
+                self.list.remove(old_chall)
+                self._unindex_chall(old_chall, old_store)
             self._game.need_reloading_scoreboard = True
         elif old_chall is None: # add
-            self.list = other_challs+[Challenge(self._game, new_store)]
+            new_chall = Challenge(self._game, new_store)
+            self.list.append(new_chall)
+            if len(self.list)>1 and self.list[-2]._store.sorting_index>new_store.sorting_index:
+                self.list.sort(key=lambda x: x._store.sorting_index)
+            self._index_chall(new_chall)
             self._game.need_reloading_scoreboard = True
         else: # modify
+            assert old_store is not None
             old_chall.on_store_reload(new_store)
+            self._unindex_chall(old_chall, old_store)
+            self._index_chall(old_chall)
+            if old_store.sorting_index!=new_store.sorting_index:
+                self.list.sort(key=lambda x: x._store.sorting_index)
 
-        self._after_chall_changed()
+        self._game.invalidate_views(challenge_keys=changed_keys) # if chall name or metadata changed
+
+    def on_user_added(self, user: User) -> None:
+        for ch in self.list:
+            for f in ch.flags:
+                f.on_user_added(user)
 
-        self._game.clear_boards_render_cache()  # if chall name or metadata changed
+    def on_user_removed(self, user: User) -> None:
+        for ch in self.list:
+            for f in ch.flags:
+                f.on_user_removed(user)
+
+    def clear_correct_flag_indexes(self) -> None: # after all users are reloaded
+        for ch in self.list:
+            for f in ch.flags:
+                f.clear_correct_flag_index()
+
+    def on_scores_changed(self, ch: Challenge, users: Iterable[User]) -> None: # these users' scores in this challenge changed
+        key = ch._store.key
+        self.touched_users_cache.invalidate(key)
+        self.touched_users_resp_cache.invalidate((key, False))
+        self.touched_users_resp_cache.invalidate((key, True))
+        # total scores of these users are also shown in other challenges they touched
+        self.touched_users_resp_cache.on_change(uids=[u._store.id for u in users])
 
     def on_tick_change(self) -> None:
         for ch in self.list:
@@ -55,12 +108,30 @@ class Challenges(WithGameLifecycle):
     def on_scoreboard_reset(self) -> None:
         for ch in self.list:
             ch.on_scoreboard_reset()
+        self.touched_users_cache.clear()
+        self.touched_users_resp_cache.clear()
 
     def on_scoreboard_update(self, submission: Submission, in_batch: bool) -> None:
         if submission.challenge is not None:
             submission.challenge.on_scoreboard_update(submission, in_batch)
 
+            if not in_batch and submission.matched_flag is not None:
+                # the submitter and other passed users of this flag (whose score may decay)
+                self.on_scores_changed(submission.challenge, submission.matched_flag.passed_users)
+
+    def on_scoreboard_batch_update_done(self) -> None:
+        self.touched_users_cache.clear()
+        self.touched_users_resp_cache.clear()
+
+TouchedUser = Tuple['User', List[Optional['Submission']]] # passing submission of each flag, or None
+
 class Challenge(WithGameLifecycle):
+    __slots__ = (
+        '_game', '_store', 'cur_effective', 'flags', 'attachments',
+        'passed_users', 'touched_users', 'tot_base_score', 'tot_cur_score',
+    )
+    __hash__ = object.__hash__ # by identity, as challenges are keys of `User.passed_challs`
+
     def __init__(self, game: Game, store: ChallengeStore):
         self._game: Game = game
         self._store: ChallengeStore = store
@@ -83,7 +154,10 @@ class Challenge(WithGameLifecycle):
 
         if store.key!=self._store.key:
             for f in self.flags:
-                f.correct_flag.cache_clear()
+                f.clear_correct_flag_cache()
+            self._game.need_reloading_scoreboard = True
+
+        if store.category!=self._store.category: # category boards only depend on their own challenges
             self._game.need_reloading_scoreboard = True
 
         self._store = store
@@ -93,10 +167,8 @@ class Challenge(WithGameLifecycle):
             self.flags = [Flag(self._game, x, self, i) for i, x in enumerate(store.flags)]
             self._game.need_reloading_scoreboard = True
 
-        self._render_template.cache_clear()
         self.on_tick_change()
 
-    @lru_cache(16)
     def _render_template(self, tick: int, group: Optional[str]) -> str:
         try:
             return utils.render_template(self._store.desc_template, {'group': group, 'tick': tick})
@@ -105,10 +177,23 @@ class Challenge(WithGameLifecycle):
             return '<i>（模板渲染失败）</i>'
 
     def render_desc(self, user: User) -> str:
-        return self._render_template(self._game.cur_tick, user._store.group)
+        return self.render_desc_for_group(user._store.group)
+
+    def render_desc_for_group(self, group: Optional[str], tick: Optional[int] = None) -> str: # tick: the next tick if prewarming
+        at_tick = self._game.cur_tick if tick is None else tick
+
+        def render(deps: CacheDeps) -> str:
+            deps.challenge_keys.add(self._store.key)
+            deps.tick = True # so descs of previous ticks are dropped
+            return self._render_template(at_tick, group)
+
+        return self._game.challenges.desc_cache.get((self._store.key, at_tick, group), render, staged=at_tick!=self._game.cur_tick)
+
+    def is_effective_at(self, tick: int) -> bool:
+        return tick >= self._store.effective_after
 
     def on_tick_change(self) -> None:
-        self.cur_effective = self._game.cur_tick >= self._store.effective_after
+        self.cur_effective = self.is_effective_at(self._game.cur_tick)
 
         for flag in self.flags:
             flag.on_tick_change()
@@ -126,9 +211,10 @@ class Challenge(WithGameLifecycle):
         assert submission.challenge is not None and submission.challenge._store.id==self._store.id # always true as delegated from Challenges
 
         if submission.matched_flag is not None:
-            submission.matched_flag.on_scoreboard_update(submission, in_batch)
+            flag = submission.matched_flag
+            flag.on_scoreboard_update(submission, in_batch)
 
-            self._update_tot_score()
+            self.tot_cur_score += flag.cur_score - flag.prev_score
             self.touched_users.add(submission.user)
 
             all_passed = all(submission.user in flag.passed_users for flag in self.flags)
@@ -136,6 +222,9 @@ class Challenge(WithGameLifecycle):
             if all_passed:
                 self.passed_users.add(submission.user)
 
+    def on_flag_score_recalc(self) -> None:
+        self._update_tot_score()
+
     def _update_tot_score(self) -> None:
         self.tot_base_score = 0
         self.tot_cur_score = 0
@@ -144,6 +233,28 @@ class Challenge(WithGameLifecycle):
             self.tot_base_score += flag.base_score
             self.tot_cur_score += flag.cur_score
 
+    def touched_users_sorted(self) -> List[TouchedUser]: # by score in this challenge, then by the last passing time
+        def render(deps: CacheDeps) -> List[TouchedUser]:
+            deps.challenge_keys.add(self._store.key) # flags may be changed
+
+            users: List[Tuple[Tuple[int, int], TouchedUser]] = []
+            for u in self.touched_users:
+                subs: List[Optional[Submission]] = []
+                tot_score = 0
+                last_sub_ts = 0
+                for f in self.flags:
+                    sub = u.passed_flags.get(f, None)
+                    if sub is not None:
+                        last_sub_ts = max(last_sub_ts, sub._store.timestamp_ms)
+                        tot_score += sub.gained_score()
+                    subs.append(sub)
+                users.append(((-tot_score, last_sub_ts), (u, subs)))
+
+            users.sort(key=lambda x: x[0])
+            return [item for _sort_key, item in users]
+
+        return self._game.challenges.touched_users_cache.get(self._store.key, render)
+
     def user_status(self, user: Optional[User]) -> str:
         if user:
             if user in self.passed_users:
@@ -158,13 +269,14 @@ class Challenge(WithGameLifecycle):
                 return True
         return False
 
-    def describe_metadata(self, board: Optional[Board]) -> Dict[str, Any]: # board=null if not in a board context (e.g., in game portal)
+    def describe_metadata(self, board: Optional[Board], tick: Optional[int] = None) -> Dict[str, Any]: # board=null if not in a board context (e.g., in game portal)
+        at_tick = self._game.cur_tick if tick is None else tick
         m = {} if self._store.chall_metadata is None else self._store.chall_metadata
         is_eligible_board = isinstance(board, FirstBloodBoard) and (board.group==['pku'] or board.group==['thu'])
 
         return {
             'first_blood_award_eligible': m.get('first_blood_award_eligible', False) and (is_eligible_board or board is None),
-            'author': None if self._game.cur_tick<Trigger.TRIGGER_BOARD_END else m.get('author', None),
+            'author': None if at_tick<Trigger.TRIGGER_BOARD_END else m.get('author', None),
         }
 
     def __repr__(self) -> str:
@@ -0,0 +1,175 @@
+from __future__ import annotations
+import asyncio
+import concurrent.futures
+import hashlib
+import multiprocessing
+import os
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from pathlib import Path
+from typing import TYPE_CHECKING, Any, Callable, Dict, List, Optional, Tuple
+
+if TYPE_CHECKING:
+    from . import Flag, User
+from ..store import UserStore, ChallengeStore
+from .. import utils
+from .. import secret
+
+# dynamic flags are generated by `flag.py` in the attachment dir, which may read files relative to it.
+# generators run in a process pool, so they can chdir to their dir without affecting the server.
+
+N_PROCESSES = 2
+GEN_TIMEOUT_S = 10 # per user in a batch
+GEN_BATCH_SIZE = 200 # users per pool call in `gen_flags`
+
+_pool: Optional[ProcessPoolExecutor] = None
+_pool_lock = threading.Lock() # `gen_flags` is also called from executor threads, e.g., when building flag tables
+
+GenResult = Tuple[Optional[str], Optional[str]] # (flag, traceback if the generator raised)
+
+class GeneratorPoolError(Exception): # the pool is broken or timed out, so the result is unknown, rather than the generator failed
+    pass
+
+# generators are called as `flag(user, flag)`. game state objects cannot be sent to the pool, so they get these
+# stand-ins instead of `User` and `Flag`. the contract is:
+# - user: `_store` (the `UserStore` row), `get_partition` and `get_partitions`
+# - flag: `_store` (the descriptor), `idx0`, `type`, `val`, `name`, `base_score`, and `challenge._store`
+# game state (e.g., `user.tot_score` or `flag.cur_score`) is not available, as it changes without regenerating flags.
+
+class _DynFlagView:
+    __slots__ = ()
+
+    def __getattr__(self, name: str) -> Any: # only called for missing attributes
+        raise AttributeError(f'{name!r} is not available to dynamic flag generators, see the contract in src/state/dyn_flag.py')
+
+class DynFlagUser(_DynFlagView):
+    __slots__ = ('_store',)
+
+    def __init__(self, store: UserStore):
+        self._store = store
+
+    # same as `User`, as they only depend on the user id and the challenge key
+
+    def get_partition(self, ch: DynFlagChallenge, n_part: int) -> int:
+        from .user_state import User
+        return User.get_partition(self, ch, n_part) # type: ignore
+
+    def get_partitions(self, ch: DynFlagChallenge, n_parts: List[int]) -> List[int]:
+        from .user_state import User
+        return User.get_partitions(self, ch, n_parts) # type: ignore
+
+class DynFlagChallenge(_DynFlagView):
+    __slots__ = ('_store',)
+
+    def __init__(self, store: ChallengeStore):
+        self._store = store
+
+class DynFlagFlag(_DynFlagView):
+    __slots__ = ('_store', 'challenge', 'idx0', 'type', 'val', 'name', 'base_score')
+
+    def __init__(self, flag: Flag):
+        self._store: Dict[str, Any] = flag._store
+        self.challenge = DynFlagChallenge(flag.challenge._store)
+        self.idx0 = flag.idx0
+        self.type = flag.type
+        self.val = flag.val
+        self.name = flag.name
+        self.base_score = flag.base_score
+
+def _get_pool() -> ProcessPoolExecutor:
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            # spawn instead of fork, because the server process has other threads (e.g., sql executors)
+            _pool = ProcessPoolExecutor(max_workers=N_PROCESSES, mp_context=multiprocessing.get_context('spawn'))
+        return _pool
+
+def _drop_pool(pool: ProcessPoolExecutor) -> None: # a new one will be created for the next call
+    global _pool
+    with _pool_lock:
+        if _pool is pool:
+            _pool = None
+
+    # processes stuck in a generator would never exit by themselves
+    for proc in list((getattr(pool, '_processes', None) or {}).values()):
+        proc.terminate()
+    pool.shutdown(wait=False, cancel_futures=True)
+
+def script_digest(flag: Flag) -> str: # flags also change when the generator is changed
+    assert isinstance(flag.val, str)
+    script = secret.ATTACHMENT_PATH / flag.val / 'flag.py'
+    return hashlib.sha256(script.read_bytes()).hexdigest() if script.is_file() else ''
+
+def _submit(flag: Flag, users: List[User]) -> Tuple[ProcessPoolExecutor, List[Future[List[GenResult]]], float]: # -> (pool, futures, timeout)
+    assert isinstance(flag.val, str)
+    mod_path = str(secret.ATTACHMENT_PATH / flag.val)
+    flag_view = DynFlagFlag(flag)
+    pool = _get_pool()
+
+    try:
+        futs = [
+            pool.submit(_run_generator, mod_path, [DynFlagUser(u._store) for u in users[i:i+GEN_BATCH_SIZE]], flag_view)
+            for i in range(0, len(users), GEN_BATCH_SIZE)
+        ]
+    except BrokenProcessPool as e:
+        _drop_pool(pool)
+        raise GeneratorPoolError(repr(e)) from e
+
+    # batches are run in parallel
+    timeout = GEN_TIMEOUT_S * min(len(users), GEN_BATCH_SIZE) * (1 + (len(futs)-1)//N_PROCESSES)
+    return pool, futs, timeout
+
+def gen_flags(flag: Flag, users: List[User]) -> List[GenResult]: # blocking, in bulk
+    pool, futs, timeout = _submit(flag, users)
+
+    try:
+        _done, not_done = concurrent.futures.wait(futs, timeout)
+        if not_done:
+            raise TimeoutError(f'generator timed out after {timeout}s')
+        return [res for fut in futs for res in fut.result()]
+    except (BrokenProcessPool, TimeoutError) as e:
+        _drop_pool(pool)
+        raise GeneratorPoolError(repr(e)) from e
+
+async def gen_flags_async(flag: Flag, users: List[User]) -> List[GenResult]: # same as `gen_flags`, without blocking the loop
+    pool, futs, timeout = _submit(flag, users)
+
+    try:
+        rets = await asyncio.wait_for(asyncio.gather(*[asyncio.wrap_future(fut) for fut in futs]), timeout)
+        return [res for ret in rets for res in ret]
+    except (BrokenProcessPool, asyncio.TimeoutError) as e:
+        _drop_pool(pool)
+        raise GeneratorPoolError(repr(e)) from e
+
+# below are run in the pool processes
+
+_generators: Dict[str, Tuple[int, Callable[[DynFlagUser, DynFlagFlag], str]]] = {} # mod path -> (mtime_ns, generator)
+
+def _run_generator(mod_path: str, users: List[DynFlagUser], flag: DynFlagFlag) -> List[GenResult]:
+    # errors of the generator are returned per user, so that they are told apart from errors of the pool
+    try:
+        os.chdir(mod_path)
+
+        # each module is loaded once, and reloaded if it is changed
+        script = Path(mod_path) / 'flag.py'
+        mtime = script.stat().st_mtime_ns
+        cached = _generators.get(mod_path, None)
+        if cached is None or cached[0]!=mtime:
+            gen_mod = utils.load_module(script)
+            cached = _generators[mod_path] = (mtime, gen_mod.flag)
+    except Exception as e:
+        tb = utils.get_traceback(e)
+        return [(None, tb) for _ in users]
+
+    gen_fn = cached[1]
+    ret: List[GenResult] = []
+    for user in users:
+        try:
+            out_flag = gen_fn(user, flag)
+            assert isinstance(out_flag, str), f'gen_fn must return a str, got {type(out_flag)}'
+        except Exception as e:
+            ret.append((None, utils.get_traceback(e)))
+        else:
+            ret.append((out_flag, None))
+    return ret
@@ -1,15 +1,16 @@
 from __future__ import annotations
 import hashlib
 import string
-from functools import lru_cache
-from typing import TYPE_CHECKING, Set, Dict, Any, Union, List, Callable, Tuple, Optional, assert_never
+import time
+from typing import TYPE_CHECKING, Set, Dict, Any, Union, List, Tuple, Optional, Iterable, assert_never
 
 if TYPE_CHECKING:
     from . import Game, Challenge, User, Submission
 from . import WithGameLifecycle
+from .dyn_flag import GenResult, GeneratorPoolError, gen_flags, gen_flags_async
+from .flag_table import FlagTable, flag_version, open_table
 from ..store import ChallengeStore, FlagType
 from .. import utils
-from .. import secret
 
 def leet_flag(flag: str, uid: int, salt: str) -> str:
     uid = int(hashlib.sha256(f'{uid}-{salt}'.encode()).hexdigest(), 16)
@@ -34,19 +35,29 @@ def leet_flag(flag: str, uid: int, salt: str) -> str:
 
     return 'flag{'+rcont+'}'
 
-def dyn_flag(flag: Flag, user: User) -> str:
-    assert isinstance(flag.val, str)
-    mod_path = secret.ATTACHMENT_PATH / flag.val
+_decay_factors: List[float] = [] # index: number of passed users
 
-    with utils.chdir(mod_path):
-        gen_mod = utils.load_module(mod_path / 'flag.py')
-        gen_fn: Callable[[User, Flag], str] = gen_mod.flag
-        out_flag = gen_fn(user, flag)
-        assert isinstance(out_flag, str), f'gen_fn must return a str, got {type(out_flag)}'
+def decay_factor(n_users: int) -> float:
+    while len(_decay_factors)<=n_users:
+        _decay_factors.append(.3 + .7 * (.99**len(_decay_factors)))
+    return _decay_factors[n_users]
 
-    return out_flag
+CORRECT_FLAG_CACHE_SIZE = 200000
+FAILED_FLAG = '😅FAIL' # shown as the correct flag if it cannot be calculated, never accepted
+FLAG_TABLE_RECHECK_S = 10 # how often to look for the table of a flag if it is not built yet
+
+# (flag version, uid) -> correct flag, shared by all non-static flags.
+# keyed by plain values instead of `Flag` and `User`, so that the old game is not kept alive after reloading.
+_correct_flag_cache: utils.LruCache[Tuple[str, int], str] = utils.LruCache(CORRECT_FLAG_CACHE_SIZE)
 
 class Flag(WithGameLifecycle):
+    __slots__ = (
+        '_game', '_store', 'challenge', 'idx0', 'type', 'val', 'name', 'base_score',
+        'cur_score', 'prev_score', 'score_history', 'passed_users', 'passed_users_for_score_calculation',
+        '_version', '_table', '_table_checked_at', '_users_by_correct_flag', '_unindexed_users',
+    )
+    __hash__ = object.__hash__ # by identity, as flags are keys of `User.passed_flags`
+
     def __init__(self, game: Game, descriptor: Dict[str, Any], chall: Challenge, idx0: int):
         self._game: Game = game
         self._store: Dict[str, Any] = descriptor
@@ -59,23 +70,116 @@ class Flag(WithGameLifecycle):
         self.base_score: int = descriptor['base_score']
 
         self.cur_score: int = 0
+        self.prev_score: int = 0 # before the last submission, so that passed users can update their score by delta
         self.score_history: List[Tuple[int, int]] = []
 
         self.passed_users: Set[User] = set()
         self.passed_users_for_score_calculation: Set[User] = set()
 
+        self._version: Optional[str] = None # see `version`
+        self._table: Optional[FlagTable] = None # see `flag_table`, opened on first use
+        self._table_checked_at: float = -FLAG_TABLE_RECHECK_S
+
+        # correct flag -> users, to find where a wrong flag comes from (see `users_with_correct_flag`).
+        # built on first use, and new users are only indexed on the next lookup.
+        self._users_by_correct_flag: Optional[Dict[str, List[User]]] = None
+        self._unindexed_users: List[User] = []
+
     def _calc_cur_score(self) -> int:
         u = len(self.passed_users_for_score_calculation)
-        return int(self.base_score * (.3 + .7 * (.99**u)))
+        return int(self.base_score * decay_factor(u))
 
     def _update_cur_score(self, sub: Submission) -> None:
+        self.prev_score = self.cur_score
         new_score = self._calc_cur_score()
         if self.cur_score != new_score:
             self.cur_score = new_score
             self.score_history.append((sub._store.id, new_score))
 
-    @lru_cache(maxsize=None)
     def correct_flag(self, user: User) -> str:
+        flag = self._get_correct_flag(user)
+        return FAILED_FLAG if flag is None else flag
+
+    def _get_correct_flag(self, user: User) -> Optional[str]: # -> None if failed
+        if self.type=='static':
+            assert isinstance(self.val, str)
+            return self.val
+
+        flag = self._cached_correct_flag(user)
+        if flag is None:
+            # dynamic flags are usually warmed by `warm_correct_flags` before, so this rarely blocks
+            flag = self._calc_correct_flag(user)
+            if flag is not None: # failures are not cached, so they are retried next time
+                _correct_flag_cache.put((self.version, user._store.id), flag)
+        return flag
+
+    def _cached_correct_flag(self, user: User) -> Optional[str]:
+        flag = _correct_flag_cache.get((self.version, user._store.id))
+        if flag is None:
+            table = self._get_table()
+            flag = table.get(user._store.id) if table is not None else None # table hits are not cached, as they are already cheap
+        return flag
+
+    async def warm_correct_flags(self, users: Iterable[User]) -> None:
+        # generate missing dynamic flags in bulk without blocking the loop, so that `correct_flag` hits the cache later
+        if self.type!='dynamic':
+            return
+
+        version = self.version
+        missing = [u for u in users if self._cached_correct_flag(u) is None]
+        if not missing:
+            return
+
+        try:
+            results = await gen_flags_async(self, missing)
+        except GeneratorPoolError as e:
+            self._game.worker.log('error', 'flag.warm_correct_flags', f'generator pool failed for {repr(self)}, will retry later: {e}')
+            return
+
+        for u, flag in zip(missing, self._check_gen_results(missing, results)):
+            if flag is not None:
+                _correct_flag_cache.put((version, u._store.id), flag)
+
+    @property
+    def version(self) -> str: # of the correct flags, computed on first use, see `flag_table.flag_version`
+        if self._version is None:
+            self._version = flag_version(self)
+        return self._version
+
+    def _get_table(self) -> Optional[FlagTable]:
+        if self._table is None:
+            now = time.monotonic()
+            if now-self._table_checked_at>=FLAG_TABLE_RECHECK_S:
+                self._table_checked_at = now
+                try:
+                    self._table = open_table(self)
+                except Exception as e:
+                    self._game.worker.log('error', 'flag._get_table', f'error opening flag table of {repr(self)}: {utils.get_traceback(e)}')
+        return self._table
+
+    def clear_correct_flag_cache(self) -> None:
+        self._version = None # old entries are no longer hit, and will be evicted
+        self._table = None
+        self._table_checked_at = -FLAG_TABLE_RECHECK_S
+        self.clear_correct_flag_index()
+
+    def _check_gen_results(self, users: List[User], results: List[GenResult]) -> List[Optional[str]]:
+        ret = []
+        for u, (flag, tb) in zip(users, results):
+            if tb is not None:
+                self._game.worker.log('error', 'flag.correct_flag', f'error in generator of flag {repr(self)} for U#{u._store.id}: {tb}')
+            ret.append(flag)
+        return ret
+
+    def _calc_correct_flag(self, user: User) -> Optional[str]: # -> None if failed
+        if self.type=='dynamic': # blocking, see `warm_correct_flags`
+            try:
+                results = gen_flags(self, [user])
+            except GeneratorPoolError as e:
+                self._game.worker.log('error', 'flag.correct_flag', f'generator pool failed for {repr(self)}: {e}')
+                return None
+            return self._check_gen_results([user], results)[0]
+
         try:
             if self.type=='static':
                 assert isinstance(self.val, str)
@@ -94,21 +198,70 @@ class Flag(WithGameLifecycle):
                 assert isinstance(self.val, list)
                 return self.val[user.get_partition(self.challenge, len(self.val))]
 
-            elif self.type=='dynamic':
-                return dyn_flag(self, user)
-
             else:
                 assert_never(self.type)  # for mypy type checking
 
         except Exception as e:
             self._game.worker.log('error', 'flag.correct_flag', f'error calculating flag {repr(self)} for U#{user._store.id}: {utils.get_traceback(e)}')
-            return '😅FAIL'
+            return None
 
     def validate_flag(self, user: User, flag: str) -> bool:
-        return flag==self.correct_flag(user)
+        return flag==self._get_correct_flag(user)
+
+    async def users_with_correct_flag(self, flag: str) -> List[User]:
+        if self._users_by_correct_flag is None:
+            self._users_by_correct_flag = {}
+            self._unindexed_users = list(self._game.users.list)
+
+        if self._unindexed_users:
+            # dynamic flags are generated in bulk (or read from the flag table), instead of one pool call per user
+            await self.warm_correct_flags(list(self._unindexed_users))
+
+            # the index may be changed meanwhile, so look at it again
+            if self._users_by_correct_flag is None:
+                return await self.users_with_correct_flag(flag)
+
+            remaining = []
+            for u in self._unindexed_users:
+                # never blocks on the pool, users whose flags are still unknown are retried on the next lookup
+                correct_flag = self._cached_correct_flag(u) if self.type=='dynamic' else self._calc_correct_flag(u)
+                if correct_flag is None:
+                    remaining.append(u)
+                else:
+                    self._users_by_correct_flag.setdefault(correct_flag, []).append(u)
+            self._unindexed_users = remaining
+
+        return self._users_by_correct_flag.get(flag, [])
+
+    def clear_correct_flag_index(self) -> None:
+        self._users_by_correct_flag = None
+        self._unindexed_users = []
+
+    def on_user_added(self, user: User) -> None:
+        if self._users_by_correct_flag is not None:
+            self._unindexed_users.append(user)
+
+    def on_user_removed(self, user: User) -> None:
+        if self._users_by_correct_flag is not None:
+            if user in self._unindexed_users:
+                self._unindexed_users.remove(user)
+            else:
+                for users in self._users_by_correct_flag.values(): # rare, so scan instead of generating the flag again
+                    if user in users:
+                        users.remove(user)
+                        break
+
+    def recalc_score(self) -> None:
+        # replay the passing submissions, after their score-related properties are changed
+        subs = sorted([u.passed_flags[self] for u in self.passed_users], key=lambda s: s._store.id)
+
+        self.on_scoreboard_reset()
+        for sub in subs:
+            self.on_scoreboard_update(sub, True)
 
     def on_scoreboard_reset(self) -> None:
         self.cur_score = self.base_score
+        self.prev_score = self.base_score
         self.score_history = [(0, self.base_score)]
 
         self.passed_users = set()
@@ -0,0 +1,98 @@
+from __future__ import annotations
+import bisect
+import hashlib
+import json
+import mmap
+import os
+import struct
+from pathlib import Path
+from typing import TYPE_CHECKING, List, Optional
+
+if TYPE_CHECKING:
+    from . import Flag, User
+from . import dyn_flag
+from .. import secret
+
+# correct flags of a non-static flag for all users, computed in bulk and shared by all processes that build a `Game`.
+# each table is named by the version of its flag, so a changed flag never hits an old table.
+# layout (little endian): header, sorted uids (int64), offsets into the blob (uint64, n+1 of them), utf-8 blob.
+
+TABLE_VER = 1
+_MAGIC = b'GSFLAGT%d'%TABLE_VER
+_HEADER = struct.Struct('<8sQ') # magic, n
+
+def flag_version(flag: Flag) -> str:
+    return hashlib.sha256(json.dumps([
+        TABLE_VER,
+        flag.challenge._store.key,
+        flag.idx0,
+        flag._store,
+        dyn_flag.script_digest(flag) if flag.type=='dynamic' else '',
+    ], sort_keys=True, ensure_ascii=False).encode('utf-8')).hexdigest()
+
+def table_path(flag: Flag) -> Optional[Path]:
+    base = secret.CORRECT_FLAG_TABLE_PATH
+    if base is None or flag.type=='static':
+        return None
+    return base / f'{flag.version}.bin'
+
+class FlagTable:
+    __slots__ = ('_mm', '_uids', '_offsets', '_blob_start')
+
+    def __init__(self, path: Path):
+        with path.open('rb') as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, n = _HEADER.unpack_from(self._mm, 0)
+        if magic!=_MAGIC:
+            raise ValueError(f'bad flag table: {path}')
+
+        uids_start = _HEADER.size
+        offsets_start = uids_start + 8*n
+        self._blob_start = offsets_start + 8*(n+1)
+        self._uids = memoryview(self._mm)[uids_start:offsets_start].cast('q')
+        self._offsets = memoryview(self._mm)[offsets_start:self._blob_start].cast('Q')
+
+    def __len__(self) -> int:
+        return len(self._uids)
+
+    def get(self, uid: int) -> Optional[str]:
+        i = bisect.bisect_left(self._uids, uid)
+        if i==len(self._uids) or self._uids[i]!=uid:
+            return None # e.g., users registered after the table is built
+        return self._mm[self._blob_start+self._offsets[i] : self._blob_start+self._offsets[i+1]].decode('utf-8')
+
+def open_table(flag: Flag) -> Optional[FlagTable]:
+    path = table_path(flag)
+    if path is None or not path.is_file():
+        return None
+    return FlagTable(path)
+
+def build_table(flag: Flag, users: List[User], path: Path) -> int: # -> number of rows
+    users = sorted(users, key=lambda u: u._store.id)
+    if flag.type=='dynamic':
+        # pool errors are raised instead, so that no table is written
+        flags = flag._check_gen_results(users, dyn_flag.gen_flags(flag, users))
+    else:
+        flags = [flag._calc_correct_flag(u) for u in users] # not `correct_flag`, as its cache is not thread-safe
+
+    # failed users are left out, so their flags are calculated (and retried) on lookup
+    rows = [(u, f) for u, f in zip(users, flags) if f is not None]
+    users = [u for u, _f in rows]
+
+    blobs = [f.encode('utf-8') for _u, f in rows]
+    offsets = [0]
+    for b in blobs:
+        offsets.append(offsets[-1]+len(b))
+
+    # write to a temp file first, so that readers never see a partial table
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_suffix(f'.tmp{os.getpid()}')
+    with tmp_path.open('wb') as f:
+        f.write(_HEADER.pack(_MAGIC, len(users)))
+        f.write(struct.pack(f'<{len(users)}q', *[u._store.id for u in users]))
+        f.write(struct.pack(f'<{len(offsets)}Q', *offsets))
+        f.write(b''.join(blobs))
+    os.replace(tmp_path, path)
+
+    return len(users)
@@ -17,6 +17,7 @@ class GamePolicy(WithGameLifecycle):
     def on_store_reload(self, stores: List[GamePolicyStore]) -> None:
         self._stores = sorted(stores, key=lambda x: x.effective_after)
         self.on_tick_change()
+        self._game.invalidate_views(policy=True)
         self._game.need_reloading_scoreboard = True
 
     def get_policy_at_tick(self, tick: int) -> GamePolicyStore:
@@ -1,9 +1,11 @@
 from __future__ import annotations
-from typing import TYPE_CHECKING, List, Dict
+from typing import TYPE_CHECKING, List, Dict, Any, Iterable, Iterator, Optional
 
 if TYPE_CHECKING:
     from ..logic.base import StateContainerBase
 from . import WithGameLifecycle, Submission, Trigger, GamePolicy, Announcements, Challenges, Users, Board, ScoreBoard, FirstBloodBoard, CategoryScoreBoard
+from .cached_view import CachedView
+from .submission_table import SubmissionTable
 from ..store import *
 
 class Game(WithGameLifecycle):
@@ -22,7 +24,10 @@ class Game(WithGameLifecycle):
 
         self.cur_tick: int = cur_tick
         self.need_reloading_scoreboard: bool = True
-        self.submissions: Dict[int, Submission] = {}
+        self.submission_table: SubmissionTable = SubmissionTable() # all submission stores, filled by the worker
+        self.submissions: Dict[int, Submission] = {} # only those in the scoreboard
+        self.cached_views: List[CachedView[Any, Any]] = [] # registered on creation, see `invalidate_views`
+        self.prewarmed_tick: Optional[int] = None # the tick whose views are staged, see `prewarm_tick`
 
         self.trigger: Trigger = Trigger(self, trigger_stores)
         self.policy: GamePolicy = GamePolicy(self, game_policy_stores)
@@ -30,28 +35,66 @@ class Game(WithGameLifecycle):
         self.challenges: Challenges = Challenges(self, challenge_stores)
         self.users: Users = Users(self, user_stores)
         self.boards: Dict[str, Board] = {
-            'score_pku': ScoreBoard('北京大学排名', None, self, ['pku'], False, 100),
-            'score_thu': ScoreBoard('清华大学排名', None, self, ['thu'], False, 100),
-            'score_other': ScoreBoard('其他选手排名', '其他选手不参与评奖，但符合要求的可申请领取成绩证明和纪念品', self, ['other'], False, 100),
+            'score_pku': ScoreBoard('北京大学排名', None, self, ['pku'], False, 100, 500),
+            'score_thu': ScoreBoard('清华大学排名', None, self, ['thu'], False, 100, 500),
+            'score_other': ScoreBoard('其他选手排名', '其他选手不参与评奖，但符合要求的可申请领取成绩证明和纪念品', self, ['other'], False, 100, 200),
             'first_pku': FirstBloodBoard('北京大学一血榜', None, self, ['pku'], False),
             'first_thu': FirstBloodBoard('清华大学一血榜', None, self, ['thu'], False),
             'first_other': FirstBloodBoard('其他选手一血榜', '题目一血与奖项无关，仅供参考', self, ['other'], False),
             'binary_score_pku': CategoryScoreBoard('北京大学 Binary 分类排名', '仅计入 Binary 分类题目，前三名预计可获得比特之星奖', self, ['pku'], False, 30, 'Binary'),
             'binary_score_thu': CategoryScoreBoard('清华大学 Binary 分类排名', '仅计入 Binary 分类题目，前三名预计可获得比特之星奖', self, ['thu'], False, 30, 'Binary'),
-            'score_all': ScoreBoard('总排名', '总排名与校内奖项无关，仅供参考', self, UserStore.TOT_BOARD_GROUPS, True, 200),
+            'score_all': ScoreBoard('总排名', '总排名与校内奖项无关，仅供参考', self, UserStore.TOT_BOARD_GROUPS, True, 200, 200),
             'first_all': FirstBloodBoard('总一血榜', '题目一血与奖项无关，仅供参考', self, UserStore.TOT_BOARD_GROUPS, True),
-            'banned': ScoreBoard('封神榜', 'R.I.P.', self, ['banned'], True, 200),
+            'banned': ScoreBoard('封神榜', 'R.I.P.', self, ['banned'], True, 200, 100),
         } if use_boards else {}
 
         self.n_corr_submission: int = 0
 
     def on_tick_change(self) -> None:
+        self.invalidate_views(tick=True)
+
+        # views of this tick may be rendered in advance, swap them in at once
+        for v in self.cached_views:
+            if self.prewarmed_tick==self.cur_tick:
+                v.commit_staged()
+            else:
+                v.discard_staged()
+        self.prewarmed_tick = None
+
         self.policy.on_tick_change()
         self.challenges.on_tick_change()
         self.users.on_tick_change()
         for b in self.boards.values():
             b.on_tick_change()
 
+    def prewarm_tick(self, tick: int) -> Iterator[None]:
+        # render boards, challenge descs and announcements of the next tick into the staging area before it comes, so
+        # they are not rendered by requests right after the tick change. the game itself stays at the current tick.
+        # yields between steps so that the worker can serve requests. staged views are still invalidated by changes meanwhile.
+        if tick==self.cur_tick:
+            return
+        self.prewarmed_tick = tick
+
+        groups: List[Optional[str]] = list(UserStore.GROUPS.keys())
+
+        for b in list(self.boards.values()):
+            b.get_rendered(False, tick)
+            yield
+            if self.prewarmed_tick!=tick: # the tick is changed or the game is reloaded meanwhile
+                return
+
+        for ch in list(self.challenges.list):
+            if ch.is_effective_at(tick):
+                for group in groups:
+                    ch.render_desc_for_group(group, tick)
+            yield
+            if self.prewarmed_tick!=tick:
+                return
+
+        for ann in self.announcements.list:
+            for group in [None, *groups]: # None for guests
+                ann.render_content(group, tick)
+
     def on_scoreboard_reset(self) -> None:
         self.submissions = {}
         self.n_corr_submission = 0
@@ -90,6 +133,50 @@ class Game(WithGameLifecycle):
         for b in self.boards.values():
             b.on_scoreboard_batch_update_done()
 
-    def clear_boards_render_cache(self) -> None:
+    def on_submission_override_update(self, store: SubmissionStore) -> bool:
+        # handle changes of score overrides without reloading the scoreboard.
+        # returns False for other changes, and the caller should reload the scoreboard instead.
+        sub = self.submissions.get(store.id, None)
+        if sub is None:
+            return False
+
+        old = sub._store
+        if (old.user_id, old.challenge_key, old.flag, old.timestamp_ms)!=(store.user_id, store.challenge_key, store.flag, store.timestamp_ms):
+            return False
+
+        old_counts_in_score = old.percentage_override_or_null is None
+        self.submission_table.set(store) # updates `sub._store` (i.e., `old`) in place
+
+        flag = sub.matched_flag
+        if flag is None: # no score gained anyway
+            return True
+
+        self.log('debug', 'game.on_submission_override_update', f'update overrides of submission #{store.id}')
+
+        if old_counts_in_score!=(store.percentage_override_or_null is None):
+            # whether it counts in flag score calculation is changed, so scores of all passed users are affected
+            flag.recalc_score()
+            flag.challenge.on_flag_score_recalc()
+            changed_users = list(flag.passed_users)
+        else:
+            changed_users = [sub.user]
+
+        for u in changed_users:
+            u.on_passed_score_changed()
+        self.users.update_rankings(changed_users)
+        self.challenges.on_scores_changed(flag.challenge, changed_users)
+
         for b in self.boards.values():
-            b.clear_render_cache()
\ No newline at end of file
+            b.on_scores_changed(changed_users)
+
+        return True
+
+    def invalidate_views(self, *, uids: Iterable[int] = (), challenge_keys: Iterable[str] = (), tick: bool = False, policy: bool = False) -> None:
+        # drop cached views that depend on any of these changed entities
+        uids = list(uids)
+        challenge_keys = list(challenge_keys)
+        for v in self.cached_views:
+            v.on_change(uids=uids, challenge_keys=challenge_keys, tick=tick, policy=policy)
+
+    def cached_view_stats(self) -> Dict[str, Dict[str, int]]:
+        return {v.name: v.stats() for v in self.cached_views}
\ No newline at end of file
@@ -0,0 +1,188 @@
+from __future__ import annotations
+import random
+import itertools
+from typing import Generic, TypeVar, Optional, Dict, List, Tuple, Any, Iterator, Union, Collection
+
+V = TypeVar('V')
+D = TypeVar('D')
+SortKey = Tuple[Any, ...]
+
+class _Node(Generic[V]):
+    __slots__ = ('key', 'value', 'tag', 'prio', 'size', 'count_by_tag', 'left', 'right')
+
+    def __init__(self, key: Tuple[SortKey, int], value: V, tag: str):
+        self.key = key
+        self.value = value
+        self.tag = tag
+        self.prio = random.random()
+        self.size = 1
+        self.count_by_tag: Dict[str, int] = {tag: 1}
+        self.left: Optional[_Node[V]] = None
+        self.right: Optional[_Node[V]] = None
+
+    def update(self) -> None:
+        self.size = 1
+        self.count_by_tag = {self.tag: 1}
+        for ch in (self.left, self.right):
+            if ch is not None:
+                self.size += ch.size
+                for tag, cnt in ch.count_by_tag.items():
+                    self.count_by_tag[tag] = self.count_by_tag.get(tag, 0) + cnt
+
+def _count(t: Optional[_Node[V]], tags: Optional[Collection[str]]) -> int: # tags=None for all nodes
+    if t is None:
+        return 0
+    if tags is None:
+        return t.size
+    return sum(t.count_by_tag.get(tag, 0) for tag in tags)
+
+def _split(t: Optional[_Node[V]], key: Tuple[SortKey, int]) -> Tuple[Optional[_Node[V]], Optional[_Node[V]]]: # -> (< key, >= key)
+    if t is None:
+        return None, None
+    if t.key<key:
+        t.right, r = _split(t.right, key)
+        t.update()
+        return t, r
+    else:
+        l, t.left = _split(t.left, key)
+        t.update()
+        return l, t
+
+def _merge(a: Optional[_Node[V]], b: Optional[_Node[V]]) -> Optional[_Node[V]]: # all keys in a < all keys in b
+    if a is None:
+        return b
+    if b is None:
+        return a
+    if a.prio>b.prio:
+        a.right = _merge(a.right, b)
+        a.update()
+        return a
+    else:
+        b.left = _merge(a, b.left)
+        b.update()
+        return b
+
+def _remove(t: Optional[_Node[V]], key: Tuple[SortKey, int]) -> Optional[_Node[V]]:
+    assert t is not None, 'key not in rank index'
+    if t.key==key:
+        return _merge(t.left, t.right)
+    if key<t.key:
+        t.left = _remove(t.left, key)
+    else:
+        t.right = _remove(t.right, key)
+    t.update()
+    return t
+
+class RankIndex(Generic[V]):
+    # order-statistic tree (treap) over ids, ordered by (sort key, id).
+    # repositioning an id and looking up its rank are O(log n), so the board need not be re-sorted for each change.
+    # each id also has a tag (e.g., user group), and `view` gives the ranking of ids with some tags in the same time.
+
+    def __init__(self) -> None:
+        self._root: Optional[_Node[V]] = None
+        self._key_by_id: Dict[int, SortKey] = {}
+        self._tag_by_id: Dict[int, str] = {}
+
+    def clear(self) -> None:
+        self._root = None
+        self._key_by_id = {}
+        self._tag_by_id = {}
+
+    def __len__(self) -> int:
+        return len(self._key_by_id)
+
+    def __contains__(self, id: object) -> bool:
+        return id in self._key_by_id
+
+    def key_of(self, id: int) -> Optional[SortKey]:
+        return self._key_by_id.get(id, None)
+
+    def tag_of(self, id: int) -> Optional[str]:
+        return self._tag_by_id.get(id, None)
+
+    def set(self, id: int, key: SortKey, value: V, tag: str = '') -> None:
+        old_key = self._key_by_id.get(id, None)
+        if old_key is not None:
+            self._root = _remove(self._root, (old_key, id))
+
+        l, r = _split(self._root, (key, id))
+        self._root = _merge(_merge(l, _Node((key, id), value, tag)), r)
+        self._key_by_id[id] = key
+        self._tag_by_id[id] = tag
+
+    def remove(self, id: int) -> None:
+        old_key = self._key_by_id.pop(id, None)
+        if old_key is not None:
+            self._root = _remove(self._root, (old_key, id))
+            del self._tag_by_id[id]
+
+    def view(self, tags: Optional[Collection[str]]) -> RankView[V]:
+        return RankView(self, tags)
+
+    def _rank(self, id: int, tags: Optional[Collection[str]]) -> Optional[int]: # 1-based, among ids with these tags
+        key = self._key_by_id.get(id, None)
+        if key is None or (tags is not None and self._tag_by_id[id] not in tags):
+            return None
+
+        full_key = (key, id)
+        n_less = 0
+        t = self._root
+        while t is not None:
+            if t.key<full_key:
+                n_less += _count(t.left, tags) + (1 if tags is None or t.tag in tags else 0)
+                t = t.right
+            elif t.key==full_key:
+                return n_less + _count(t.left, tags) + 1
+            else:
+                t = t.left
+
+        raise RuntimeError('rank index is inconsistent')
+
+    def _iter_values(self, tags: Optional[Collection[str]]) -> Iterator[V]: # in rank order, among ids with these tags
+        stack: List[_Node[V]] = []
+        t = self._root
+        while True:
+            while t is not None and _count(t, tags)>0: # skip subtrees without any matching id
+                stack.append(t)
+                t = t.left
+            if not stack:
+                break
+            t = stack.pop()
+            if tags is None or t.tag in tags:
+                yield t.value
+            t = t.right
+
+    def rank(self, id: int) -> Optional[int]: # 1-based
+        return self._rank(id, None)
+
+    def get(self, id: int, default: D) -> Union[int, D]: # so it can be used as an `uid_to_rank` dict
+        r = self.rank(id)
+        return default if r is None else r
+
+    def iter_values(self) -> Iterator[V]: # in rank order
+        return self._iter_values(None)
+
+    def top(self, n: int) -> List[V]:
+        return list(itertools.islice(self.iter_values(), max(n, 0)))
+
+class RankView(Generic[V]):
+    # ranking of ids with some tags in a shared `RankIndex`, e.g., a board for some user groups
+    def __init__(self, index: RankIndex[V], tags: Optional[Collection[str]]):
+        self._index = index
+        self._tags = tags
+
+    def __len__(self) -> int:
+        return _count(self._index._root, self._tags)
+
+    def rank(self, id: int) -> Optional[int]: # 1-based
+        return self._index._rank(id, self._tags)
+
+    def get(self, id: int, default: D) -> Union[int, D]:
+        r = self.rank(id)
+        return default if r is None else r
+
+    def iter_values(self) -> Iterator[V]: # in rank order
+        return self._index._iter_values(self._tags)
+
+    def top(self, n: int) -> List[V]:
+        return list(itertools.islice(self.iter_values(), max(n, 0)))
@@ -2,9 +2,11 @@ from __future__ import annotations
 from typing import TYPE_CHECKING, Optional
 
 class Submission:
-    def __init__(self, game: Game, store: SubmissionStore):
+    __slots__ = ('_game', '_store', 'user', 'challenge', 'valid_flag', 'duplicate_submission', 'matched_flag')
+
+    def __init__(self, game: Game, store: SubmissionRow):
         self._game: Game = game
-        self._store: SubmissionStore = store
+        self._store: SubmissionRow = store # a view of `game.submission_table`, so that it is updated in place
 
         # foreign key constraint on SubmissionStore ensured user always exist
         self.user: User = self._game.users.user_by_id[self._store.user_id]
@@ -12,23 +14,29 @@ class Submission:
         # challenge be None if it is deleted later
         self.challenge: Optional[Challenge] = self._game.challenges.chall_by_key.get(self._store.challenge_key, None)
 
-        self.duplicate_submission: bool = False # CORRECTLY answering a flag for the second time
-        self.matched_flag: Optional[Flag] = self._find_matched_flag()
+        # the first flag that accepts this submission, regardless of whether it is passed before.
+        # the validation is skipped if the valid flag is known from a checkpoint.
+        valid_flag_hint = self._store.valid_flag_hint
+        self.valid_flag: Optional[Flag] = self._find_valid_flag() if valid_flag_hint is None else self._flag_by_idx0(valid_flag_hint)
+
+        self.duplicate_submission: bool = self.valid_flag is not None and self.user in self.valid_flag.passed_users # CORRECTLY answering a flag for the second time
+        self.matched_flag: Optional[Flag] = None if self.duplicate_submission else self.valid_flag
 
-    def _find_matched_flag(self) -> Optional[Flag]:
+    def _find_valid_flag(self) -> Optional[Flag]:
         if self.challenge is None:
             return None
 
         for flag in self.challenge.flags:
             if flag.validate_flag(self.user, self._store.flag):
-                if self.user in flag.passed_users:
-                    self.duplicate_submission = True
-                    return None
-                else:
-                    return flag
+                return flag
 
         return None
 
+    def _flag_by_idx0(self, idx0: int) -> Optional[Flag]:
+        if self.challenge is None or idx0<0:
+            return None
+        return self.challenge.flags[idx0]
+
     def gained_score(self) -> int:
         if self.matched_flag is None:
             return 0
@@ -40,4 +48,4 @@ class Submission:
 
 if TYPE_CHECKING:
     from . import Game, Challenge, Flag, User
-    from ..store import *
\ No newline at end of file
+    from .submission_table import SubmissionRow
\ No newline at end of file
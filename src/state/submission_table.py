@@ -0,0 +1,155 @@
+from __future__ import annotations
+from array import array
+from typing import Dict, List, Optional, Iterator
+
+from ..store import SubmissionStore
+
+_NULL = -2**63 # for nullable int columns
+_NO_HINT = -2 # for `valid_flag_hint`
+
+class SubmissionTable:
+    # all submissions in memory, stored by columns instead of ORM objects (which take ~1KB each).
+    # a row is kept in place when the submission is updated, so `SubmissionRow` views see the change.
+
+    def __init__(self) -> None:
+        self._id = array('q')
+        self._user_id = array('q')
+        self._challenge_key_idx = array('i') # into `_challenge_keys`
+        self._flag: List[str] = []
+        self._timestamp_ms = array('q')
+        self._score_override = array('q')
+        self._percentage_override = array('q')
+        self._valid_flag_hint = array('h') # idx0 of the valid flag (-1 if none) from a checkpoint, or _NO_HINT
+
+        self._challenge_keys: List[str] = []
+        self._challenge_key_idx_by_key: Dict[str, int] = {}
+
+        self._row_by_id: Dict[int, int] = {} # in insertion order, removed rows are left unused
+
+    def __len__(self) -> int:
+        return len(self._row_by_id)
+
+    def __contains__(self, id: object) -> bool:
+        return id in self._row_by_id
+
+    def __iter__(self) -> Iterator[SubmissionRow]: # in insertion order
+        for row in self._row_by_id.values():
+            yield SubmissionRow(self, row)
+
+    def _intern_challenge_key(self, key: str) -> int:
+        idx = self._challenge_key_idx_by_key.get(key, None)
+        if idx is None:
+            idx = self._challenge_key_idx_by_key[key] = len(self._challenge_keys)
+            self._challenge_keys.append(key)
+        return idx
+
+    def set(self, store: SubmissionStore) -> SubmissionRow: # insert or update
+        row = self._row_by_id.get(store.id, None)
+        ch_idx = self._intern_challenge_key(store.challenge_key)
+        score_override = _NULL if store.score_override_or_null is None else store.score_override_or_null
+        percentage_override = _NULL if store.percentage_override_or_null is None else store.percentage_override_or_null
+
+        if row is None:
+            row = self._row_by_id[store.id] = len(self._id)
+            self._id.append(store.id)
+            self._user_id.append(store.user_id)
+            self._challenge_key_idx.append(ch_idx)
+            self._flag.append(store.flag)
+            self._timestamp_ms.append(store.timestamp_ms)
+            self._score_override.append(score_override)
+            self._percentage_override.append(percentage_override)
+            self._valid_flag_hint.append(_NO_HINT)
+        else:
+            self._user_id[row] = store.user_id
+            self._challenge_key_idx[row] = ch_idx
+            self._flag[row] = store.flag
+            self._timestamp_ms[row] = store.timestamp_ms
+            self._score_override[row] = score_override
+            self._percentage_override[row] = percentage_override
+            self._valid_flag_hint[row] = _NO_HINT
+
+        return SubmissionRow(self, row)
+
+    def remove(self, id: int) -> None:
+        row = self._row_by_id.pop(id, None)
+        if row is not None:
+            self._flag[row] = '' # free the string, the other columns are small
+
+    def get(self, id: int) -> Optional[SubmissionRow]:
+        row = self._row_by_id.get(id, None)
+        return None if row is None else SubmissionRow(self, row)
+
+    def set_valid_flag_hint(self, id: int, idx0: int) -> None:
+        self._valid_flag_hint[self._row_by_id[id]] = idx0
+
+    def clear_valid_flag_hints(self) -> None:
+        self._valid_flag_hint = array('h', [_NO_HINT]) * len(self._id)
+
+class SubmissionRow:
+    # a view of a row in `SubmissionTable`, with the same fields as `SubmissionStore`
+    __slots__ = ('_table', '_row')
+
+    def __init__(self, table: SubmissionTable, row: int):
+        self._table = table
+        self._row = row
+
+    @property
+    def id(self) -> int:
+        return self._table._id[self._row]
+
+    @property
+    def user_id(self) -> int:
+        return self._table._user_id[self._row]
+
+    @property
+    def challenge_key(self) -> str:
+        return self._table._challenge_keys[self._table._challenge_key_idx[self._row]]
+
+    @property
+    def flag(self) -> str:
+        return self._table._flag[self._row]
+
+    @property
+    def timestamp_ms(self) -> int:
+        return self._table._timestamp_ms[self._row]
+
+    @property
+    def score_override_or_null(self) -> Optional[int]:
+        v = self._table._score_override[self._row]
+        return None if v==_NULL else v
+
+    @property
+    def percentage_override_or_null(self) -> Optional[int]:
+        v = self._table._percentage_override[self._row]
+        return None if v==_NULL else v
+
+    @property
+    def valid_flag_hint(self) -> Optional[int]:
+        v = self._table._valid_flag_hint[self._row]
+        return None if v==_NO_HINT else v
+
+    def tweak_score(self, flag_score: int) -> int: # same as `SubmissionStore.tweak_score`
+        # reads the columns directly, as it is called for every passed user when a flag decays
+        score_override = self._table._score_override[self._row]
+        if score_override!=_NULL:
+            return score_override
+
+        percentage_override = self._table._percentage_override[self._row]
+        if percentage_override!=_NULL:
+            return int(flag_score * percentage_override / 100)
+
+        return flag_score
+
+    def to_store(self) -> SubmissionStore: # a detached row, e.g., for state snapshots
+        return SubmissionStore.from_snapshot({
+            'id': self.id,
+            'user_id': self.user_id,
+            'challenge_key': self.challenge_key,
+            'flag': self.flag,
+            'timestamp_ms': self.timestamp_ms,
+            'score_override_or_null': self.score_override_or_null,
+            'percentage_override_or_null': self.percentage_override_or_null,
+        })
+
+    def __repr__(self) -> str:
+        return f'[SubmissionRow #{self.id}]'
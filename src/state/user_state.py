@@ -1,11 +1,13 @@
 from __future__ import annotations
 import hashlib
-from typing import TYPE_CHECKING, List, Optional, Dict, Tuple
+from array import array
+from typing import TYPE_CHECKING, List, Optional, Dict, Tuple, Iterable
 
 if TYPE_CHECKING:
     from . import Game, Submission, Flag, Challenge
     from ..store import *
 from . import WithGameLifecycle
+from .rank_index import RankIndex, SortKey
 from ..state import ScoreBoard
 from ..store import UserStore
 
@@ -20,59 +22,123 @@ class Users(WithGameLifecycle):
         self.user_by_auth_token: Dict[str, User] = {}
         self.user_by_token: Dict[str, User] = {}
 
+        # shared by all score boards, which are views of some groups (see `ranking`)
+        self.rankings: Dict[Optional[str], RankIndex[Tuple[User, int]]] = {}
+
         self.on_store_reload(stores)
 
+    def ranking(self, category: Optional[str]) -> RankIndex[Tuple[User, int]]:
+        # users ordered by the score in a challenge category (or total score if None).
+        # only the rankings that are requested (by boards) are maintained.
+        if category not in self.rankings:
+            self.rankings[category] = RankIndex()
+            self.update_rankings(self.list)
+        return self.rankings[category]
+
+    def update_rankings(self, users: Iterable[User]) -> None: # after scores of these users are changed
+        for category, ranking in self.rankings.items():
+            for u in users:
+                uid = u._store.id
+                key = u.rank_key(category)
+                if key is None:
+                    ranking.remove(uid)
+                elif key!=ranking.key_of(uid) or u._store.group!=ranking.tag_of(uid):
+                    ranking.set(uid, key, (u, -key[0]), u._store.group)
+
     def _update_aux_dicts(self) -> None:
         self.user_by_id = {u._store.id: u for u in self.list}
         self.user_by_login_key = {u._store.login_key: u for u in self.list}
         self.user_by_auth_token = {u._store.auth_token: u for u in self.list if u._store.auth_token is not None}
         self.user_by_token = {u._store.token: u for u in self.list if u._store.token is not None}
 
+    def _index_user(self, u: User) -> None:
+        self.user_by_id[u._store.id] = u
+        self.user_by_login_key[u._store.login_key] = u
+        if u._store.auth_token is not None:
+            self.user_by_auth_token[u._store.auth_token] = u
+        if u._store.token is not None:
+            self.user_by_token[u._store.token] = u
+
+    def _unindex_user(self, u: User, store: UserStore) -> None: # store: the one `u` was indexed with
+        if self.user_by_id.get(store.id, None) is u:
+            del self.user_by_id[store.id]
+        if self.user_by_login_key.get(store.login_key, None) is u:
+            del self.user_by_login_key[store.login_key]
+        if store.auth_token is not None and self.user_by_auth_token.get(store.auth_token, None) is u:
+            del self.user_by_auth_token[store.auth_token]
+        if store.token is not None and self.user_by_token.get(store.token, None) is u:
+            del self.user_by_token[store.token]
+
     def on_store_reload(self, stores: List[UserStore]) -> None:
         self._stores = stores
         self.list = [User(self._game, x) for x in self._stores]
         self._update_aux_dicts()
+        self._game.challenges.clear_correct_flag_indexes()
         self._game.need_reloading_scoreboard = True
 
     def on_store_update(self, id: int, new_store: Optional[UserStore]) -> bool:
+        # indexes are updated in place, so that registrations and profile updates do not scan all users
         reload_frontend = False
 
-        # noinspection PyTypeChecker
-        old_user: Optional[User] = ([x for x in self.list if x._store.id==id]+[None])[0]
-        other_users = [x for x in self.list if x._store.id!=id]
+        old_user = self.user_by_id.get(id, None)
 
         if new_store is None: # remove
-            self.list = other_users
+            if old_user is not None:
+                self.list.remove(old_user) # O(n), but rare and the scoreboard is reloaded anyway
+                self._unindex_user(old_user, old_user._store)
+                self._game.challenges.on_user_removed(old_user)
             self._game.need_reloading_scoreboard = True
         elif old_user is None:  # add
-            self.list = other_users+[User(self._game, new_store)]
+            new_user = User(self._game, new_store)
+            self.list.append(new_user)
+            self._index_user(new_user)
+            self._game.challenges.on_user_added(new_user)
             # no need to reload scoreboard, because newly added user does not have any submissions yet
         else: # modify
+            old_store = old_user._store
             reload_frontend = old_user.on_store_reload(new_store)
+            self._unindex_user(old_user, old_store)
+            self._index_user(old_user)
 
-        self._update_aux_dicts()
-
-        if old_user is not None and old_user.tot_score>0:  # maybe on the board but profile changed
-            self._game.clear_boards_render_cache()
+        self._game.invalidate_views(uids=[id]) # only views showing this user
 
         return reload_frontend
 
     def on_scoreboard_reset(self) -> None:
         for user in self.list:
             user.on_scoreboard_reset()
+        for ranking in self.rankings.values():
+            ranking.clear()
 
     def on_scoreboard_update(self, submission: Submission, in_batch: bool) -> None:
         submission.user.on_scoreboard_update(submission, in_batch)
 
+        if not in_batch and submission.matched_flag is not None:
+            # only the submitter and other passed users of this flag (whose score may decay) are changed
+            self.update_rankings(submission.matched_flag.passed_users)
+
     def on_scoreboard_batch_update_done(self) -> None:
         for user in self.list:
             user.on_scoreboard_batch_update_done()
+        for ranking in self.rankings.values():
+            ranking.clear()
+        self.update_rankings(self.list)
 
 class ScoreHistory:
+    # kept for every user once built, so the diffs are packed in an array instead of a list of tuples
+    __slots__ = ('last_ts', 'last_score', '_diff')
+
     def __init__(self) -> None:
         self.last_ts = 0
         self.last_score = 0
-        self.diff: List[Tuple[int, int]] = [] # (ts_delta, score_delta)
+        self._diff = array('q') # ts_delta, score_delta, ts_delta, score_delta, ...
+
+    def __len__(self) -> int:
+        return len(self._diff)//2
+
+    @property
+    def diff(self) -> List[Tuple[int, int]]: # (ts_delta, score_delta)
+        return list(zip(self._diff[0::2], self._diff[1::2]))
 
     def append(self, ts: int, score: int) -> None:
         score_diff = score-self.last_score
@@ -81,17 +147,60 @@ class ScoreHistory:
 
         ts_diff = ts-self.last_ts
 
-        if self.diff and ts_diff==0: # same ts, modify prev diff
-            prev_ts_diff, prev_score_diff = self.diff[-1]
-            self.diff[-1] = (prev_ts_diff, prev_score_diff+score_diff)
+        if self._diff and ts_diff==0: # same ts, modify prev diff
+            prev_score_diff = self._diff[-1]
+            if prev_score_diff+score_diff==0: # back to the previous score, so the point is dropped
+                ts -= self._diff[-2]
+                del self._diff[-2:]
+            else:
+                self._diff[-1] = prev_score_diff+score_diff
         else: # append a new diff
-            self.diff.append((ts_diff, score_diff))
+            self._diff.append(ts_diff)
+            self._diff.append(score_diff)
 
         self.last_ts = ts
         self.last_score = score
 
+    def downsample(self, begin_ts: int, end_ts: int, n_buckets: int) -> List[Tuple[int, int]]: # same format as `diff`
+        # keep the last point in each of `n_buckets` time buckets over [begin_ts, end_ts], so the step shape and the
+        # final score are kept. points out of the range are put into the first or the last bucket.
+        if len(self)<=n_buckets or end_ts<=begin_ts:
+            return self.diff
+
+        width = (end_ts-begin_ts)/n_buckets
+        out: List[Tuple[int, int]] = []
+        out_ts = 0
+        out_score = 0
+
+        ts = 0
+        score = 0
+        cur_bucket = -1
+        for i in range(0, len(self._diff), 2):
+            bucket = min(n_buckets-1, max(0, int((ts+self._diff[i]-begin_ts)//width)))
+            if bucket!=cur_bucket and i>0 and score!=out_score: # emit the last point of the previous bucket
+                out.append((ts-out_ts, score-out_score))
+                out_ts = ts
+                out_score = score
+
+            cur_bucket = bucket
+            ts += self._diff[i]
+            score += self._diff[i+1]
+
+        if score!=out_score:
+            out.append((ts-out_ts, score-out_score))
+
+        return out
+
 class User(WithGameLifecycle):
     WRITEUP_REQUIRED_RANKS = {'pku': 33, 'thu': 33}
+    VERIFY_SCORE_DELTAS = False # check incrementally updated scores and histories against a full recalculation, for debugging
+
+    __slots__ = (
+        '_game', '_store',
+        'passed_flags', 'passed_challs', 'succ_submissions', 'last_succ_submission_by_cat', 'submissions',
+        'tot_score', 'tot_score_by_cat', '_score_history',
+    )
+    __hash__ = object.__hash__ # by identity, as users are put in sets like `Flag.passed_users`
 
     def __init__(self, game: Game, store: UserStore):
         self._game: Game = game
@@ -100,10 +209,12 @@ class User(WithGameLifecycle):
         self.passed_flags: Dict[Flag, Submission] = {}
         self.passed_challs: Dict[Challenge, Submission] = {}
         self.succ_submissions: List[Submission] = []
+        self.last_succ_submission_by_cat: Dict[str, Submission] = {}
         self.submissions: List[Submission] = []
         self.tot_score: int = 0
         self.tot_score_by_cat: Dict[str, int] = {}
 
+        # built on first use (see `score_history`), then appended incrementally on live submissions
         self._score_history: Optional[ScoreHistory] = None
 
         self.on_store_reload(self._store)
@@ -121,11 +232,12 @@ class User(WithGameLifecycle):
         self.passed_flags = {}
         self.passed_challs = {}
         self.succ_submissions = []
+        self.last_succ_submission_by_cat = {}
         self.submissions = []
 
-        self._score_history = None # delay initialize to first use
+        self._score_history = None
 
-        self._update_tot_score(None)
+        self._recalc_tot_score()
 
     def on_scoreboard_update(self, submission: Submission, in_batch: bool) -> None:
         assert submission._store.user_id==self._store.id # always true as delegated from Users
@@ -140,33 +252,72 @@ class User(WithGameLifecycle):
                 self.passed_challs[ch] = submission
 
             self.succ_submissions.append(submission)
+            self.last_succ_submission_by_cat[ch._store.category] = submission
 
+            # in batch, totals are recalculated at the end, and histories are built on first use.
+            # so visiting every passed user on each decay is only done for live submissions.
             if not in_batch:
-                # update tot score of all passed users because their score might have changed
-                for u in submission.matched_flag.passed_users:
-                    u._update_tot_score(submission)
+                # other passed users of this flag are affected if its score decays
+                flag = submission.matched_flag
+                cat = ch._store.category
+                ts = submission._store.timestamp_ms//1000
 
+                self._add_score(cat, submission.gained_score(), ts)
+
+                if flag.prev_score!=flag.cur_score: # decayed
+                    cur_score = flag.cur_score
+                    prev_score = flag.prev_score
+                    for u in flag.passed_users:
+                        if u is not self:
+                            tweak = u.passed_flags[flag]._store.tweak_score
+                            u._add_score(cat, tweak(cur_score) - tweak(prev_score), ts)
 
     def on_scoreboard_batch_update_done(self) -> None:
-        self._update_tot_score(None)
+        self._recalc_tot_score()
+
+    def on_passed_score_changed(self) -> None:
+        # past scores are changed (e.g., by score overrides), so the history cannot be updated incrementally
+        self._recalc_tot_score()
+        self._score_history = None
 
-    def _update_tot_score(self, score_updating_sub: Optional[Submission]) -> None:
-        self.tot_score = 0
-        self.tot_score_by_cat = {}
+    def _calc_tot_score(self) -> Tuple[int, Dict[str, int]]:
+        tot_score = 0
+        tot_score_by_cat: Dict[str, int] = {}
 
         for f, sub in self.passed_flags.items():
             cat = f.challenge._store.category
             score = sub.gained_score()
 
-            self.tot_score += score
+            tot_score += score
+            tot_score_by_cat[cat] = tot_score_by_cat.get(cat, 0) + score
+
+        return tot_score, tot_score_by_cat
+
+    def _recalc_tot_score(self) -> None:
+        self.tot_score, self.tot_score_by_cat = self._calc_tot_score()
+
+    def _add_score(self, cat: str, delta: int, ts: int) -> None: # ts: of the submission that changes the score
+        self.tot_score += delta
+        self.tot_score_by_cat[cat] = self.tot_score_by_cat.get(cat, 0) + delta
+
+        if self.VERIFY_SCORE_DELTAS:
+            expected = self._calc_tot_score()
+            if (self.tot_score, self.tot_score_by_cat)!=expected:
+                self._game.log('error', 'user.add_score', f'incremental score mismatch for U#{self._store.id}: got {self.tot_score} {self.tot_score_by_cat}, expected {expected[0]} {expected[1]}')
+                self.tot_score, self.tot_score_by_cat = expected
+
+        if self._score_history is None: # not built yet, and will include this change when built
+            return
 
-            old = self.tot_score_by_cat.get(cat, 0)
-            self.tot_score_by_cat[cat] = old + score
+        self._score_history.append(ts, self.tot_score)
 
-        if score_updating_sub is not None and self._score_history is not None:
-            self._score_history.append(score_updating_sub._store.timestamp_ms//1000, self.tot_score)
+        if self.VERIFY_SCORE_DELTAS:
+            expected_history = self._calc_score_history()
+            if self._score_history.diff!=expected_history.diff:
+                self._game.log('error', 'user.add_score', f'incremental score history mismatch for U#{self._store.id}: got {self._score_history.diff}, expected {expected_history.diff}')
+                self._score_history = expected_history
 
-    def _recalc_score_history(self) -> None:
+    def _calc_score_history(self) -> ScoreHistory: # from flag score histories
         events = []
         for f, sub in self.passed_flags.items():
             pass_sub_id = sub._store.id
@@ -190,29 +341,57 @@ class User(WithGameLifecycle):
 
         events.sort(key=lambda x: x[0])
 
-        self._score_history = ScoreHistory()
+        history = ScoreHistory()
         tot_score = 0
         for sid, score_delta in events:
             time_s = self._game.submissions[sid]._store.timestamp_ms//1000
             tot_score += score_delta
 
-            self._score_history.append(time_s, tot_score)
+            history.append(time_s, tot_score)
+
+        return history
 
     @property
     def last_succ_submission(self) -> Optional[Submission]:
         return self.succ_submissions[-1] if len(self.succ_submissions)>0 else None
 
+    def rank_key(self, category: Optional[str]) -> Optional[SortKey]: # None if not on the board
+        if category is None:
+            score = self.tot_score
+            last = self.last_succ_submission
+        else:
+            score = self.tot_score_by_cat.get(category, 0)
+            last = self.last_succ_submission_by_cat.get(category, None)
+
+        if score<=0:
+            return None
+        return (
+            -score,
+            -1 if last is None else last._store.id,
+        )
+
     @property
     def last_submission(self) -> Optional[Submission]:
         return self.submissions[-1] if len(self.submissions)>0 else None
 
     @property
-    def score_history_diff(self) -> List[Tuple[int, int]]:
+    def score_history(self) -> ScoreHistory:
+        # only built for users whose histories are shown (e.g., topstars), as replaying flag histories for all users is
+        # slow in a scoreboard reload
         if self._score_history is None:
-            self._recalc_score_history()
-            assert self._score_history is not None
+            self._score_history = self._calc_score_history()
+        return self._score_history
+
+    @property
+    def score_history_diff(self) -> List[Tuple[int, int]]:
+        return self.score_history.diff
+
+    def score_history_diff_downsampled(self, n_buckets: Optional[int]) -> List[Tuple[int, int]]: # None for the full history
+        if n_buckets is None:
+            return self.score_history_diff
 
-        return self._score_history.diff
+        trigger = self._game.trigger
+        return self.score_history.downsample(trigger.board_begin_ts, trigger.board_end_ts, n_buckets)
 
     def check_login(self) -> Optional[Tuple[str, str]]:
         if not self._store.enabled:
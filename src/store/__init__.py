@@ -1,15 +1,48 @@
 from sqlalchemy import Column, Integer
-from sqlalchemy.orm import declarative_base, Mapped
+from sqlalchemy.orm import declarative_base, class_mapper, Mapped
+from sqlalchemy.orm.attributes import set_committed_value
+from typing import Any, ClassVar, Dict, List, Type, TypeVar
 
 class _SqlBase:
     __allow_unmapped__ = True
 
 SqlBase = declarative_base(cls=_SqlBase)
 
+_T = TypeVar('_T', bound='Table')
+
 class Table(SqlBase):
     __abstract__ = True
     id: Mapped[int] = Column(Integer, primary_key=True)
 
+    # eagerly loaded relationships, which are included in the snapshot
+    SNAPSHOT_RELATIONSHIPS: ClassVar[List[str]] = []
+
+    def to_snapshot(self) -> Dict[str, Any]: # json-serializable
+        mapper = class_mapper(type(self))
+        ret = {attr.key: getattr(self, attr.key) for attr in mapper.column_attrs}
+
+        for key in self.SNAPSHOT_RELATIONSHIPS:
+            rel = getattr(self, key)
+            ret[key] = None if rel is None else rel.to_snapshot()
+
+        return ret
+
+    @classmethod
+    def from_snapshot(cls: Type[_T], snapshot: Dict[str, Any]) -> _T:
+        # build a detached row, as if it is loaded from the db (without triggering validators or defaults)
+        mapper = class_mapper(cls)
+        obj: _T = mapper.class_manager.new_instance()
+
+        for attr in mapper.column_attrs:
+            set_committed_value(obj, attr.key, snapshot[attr.key])
+
+        for key in cls.SNAPSHOT_RELATIONSHIPS:
+            rel = snapshot[key]
+            rel_cls: Type[Table] = mapper.relationships[key].mapper.class_
+            set_committed_value(obj, key, None if rel is None else rel_cls.from_snapshot(rel))
+
+        return obj
+
 from .announcement_store import AnnouncementStore
 from .challenge_store import ChallengeStore, FlagType
 from .game_policy_store import GamePolicyStore
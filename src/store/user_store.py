@@ -33,6 +33,8 @@ class UserStore(Table):
     terms_agreed = Column(Boolean, nullable=False, default=False)
     last_feedback_ms = Column(BigInteger, nullable=True)
 
+    SNAPSHOT_RELATIONSHIPS = ['profile']
+
     GROUPS = {
         'pku': '北京大学',
         'thu': '清华大学',
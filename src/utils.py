@@ -15,14 +15,16 @@ import pytz
 import traceback
 import asyncio
 import secrets
+import contextvars
 from pathlib import Path
 import os
 import sys
 import psutil
 import re
 import jinja2
+from collections import OrderedDict
 from contextlib import contextmanager
-from typing import Union, Callable, Dict, Any, Iterator, Literal
+from typing import Union, Callable, Dict, Any, Iterator, Literal, Tuple, List, Generic, TypeVar, Hashable, Optional
 
 LogLevel = Literal['debug', 'info', 'warning', 'error', 'critical', 'success']
 
@@ -112,15 +114,26 @@ def fix_zmq_asyncio_windows() -> None:
         except AttributeError:
             pass
 
+# time spent waiting for db in each enclosing `log_slow` block of the current task
+_db_wait_counters: contextvars.ContextVar[Tuple[List[float], ...]] = contextvars.ContextVar('_db_wait_counters', default=())
+
+def count_db_wait(seconds: float) -> None:
+    for counter in _db_wait_counters.get():
+        counter[0] += seconds
+
 @contextmanager
 def log_slow(logger: Callable[[LogLevel, str, str], None], module: str, func: str, threshold: float = 0.3) -> Iterator[None]:
+    db_wait = [0.]
+    token = _db_wait_counters.set(_db_wait_counters.get() + (db_wait,))
     t1 = time.monotonic()
     try:
         yield
     finally:
         t2 = time.monotonic()
+        _db_wait_counters.reset(token)
         if t2-t1 > threshold:
-            logger('warning', module, f'took {t2-t1:.2f}s to {func}')
+            db_info = f' ({db_wait[0]:.2f}s waiting for db)' if db_wait[0]>0 else ''
+            logger('warning', module, f'took {t2-t1:.2f}s to {func}{db_info}')
 
 @contextmanager
 def chdir(wd: Union[str, Path]) -> Iterator[None]:
@@ -167,3 +180,29 @@ def load_module(file_path: Path) -> ModuleType:
     mod = importlib.util.module_from_spec(spec)
     spec.loader.exec_module(mod)
     return mod
+
+K = TypeVar('K', bound=Hashable)
+V = TypeVar('V')
+
+class LruCache(Generic[K, V]):
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._d: OrderedDict[K, V] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._d)
+
+    def get(self, k: K) -> Optional[V]:
+        v = self._d.get(k, None)
+        if v is not None:
+            self._d.move_to_end(k)
+        return v
+
+    def put(self, k: K, v: V) -> None:
+        self._d[k] = v
+        self._d.move_to_end(k)
+        if len(self._d)>self.maxsize:
+            self._d.popitem(last=False)
+
+    def clear(self) -> None:
+        self._d.clear()